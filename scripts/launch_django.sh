@@ -10,6 +10,12 @@ python manage.py makemigrations
 echo "Run migrate"
 python manage.py migrate
 
+echo "Fill the denormalized stores of new competitions and new fields"
+python manage.py rebuild_daily_points --missing
+python manage.py rebuild_leaderboards
+python manage.py rebuild_feed --missing
+python manage.py rebuild_points_start_datetime
+
 if [ $DEBUG == "true" ] || [ $DEBUG == "True" ]; then
 	echo "Run Django Server";
 	python ./manage.py runserver 0.0.0.0:8000;
@@ -0,0 +1,133 @@
+import base64, datetime, json
+
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+
+
+FEED_PAGE_SIZE = 50
+FEED_MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(start_datetime, workout_id):
+    """ opaque cursor of a feed entry - keyset (workout start_datetime, workout id) """
+    return base64.urlsafe_b64encode(json.dumps([start_datetime.isoformat(), workout_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """ (start_datetime, workout id) of a cursor - raises ValueError if it is invalid """
+    try:
+        start_datetime, workout_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(start_datetime), int(workout_id)
+    except (TypeError, ValueError, UnicodeDecodeError, base64.binascii.Error) as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
+
+
+def _sum(values):
+    values = [i for i in values if i is not None]
+    return sum(values) if len(values) > 0 else None
+
+
+def _scope(queryset, prefix, competitions=None, user_id=None, start_datetime=None, workouts=None):
+    """ filter FeedEntry (prefix '') or Points (prefix 'workout__') by the refresh scope """
+    if user_id is not None:
+        queryset = queryset.filter(**{f'{prefix}user': user_id})
+    if start_datetime is not None:
+        queryset = queryset.filter(**{f'{prefix}start_datetime__gte': start_datetime})
+    if workouts is not None:
+        queryset = queryset.filter(workout__in=workouts)
+    return queryset
+
+
+def refresh_feed(competitions=None, user_id=None, start_datetime=None, workouts=None):
+    """ rewrite the feed entries of the workouts in scope from their points - and trim the timelines to settings.FEED_TIMELINE_LENGTH """
+    Points = apps.get_model('competition', 'Points')
+    FeedEntry = apps.get_model('competition', 'FeedEntry')
+
+    feed_entries = _scope(FeedEntry.objects.all(), '', user_id=user_id, start_datetime=start_datetime, workouts=workouts)
+    points = _scope(Points.objects.all(), 'workout__', user_id=user_id, start_datetime=start_datetime, workouts=workouts)
+    points = points.annotate(competition=Coalesce('goal__competition', 'award__competition'))
+    if competitions is not None:
+        competitions = list(competitions)
+        feed_entries = feed_entries.filter(competition__in=competitions)
+        points = points.filter(competition__in=competitions)
+
+    rows = points.values(
+        'competition', 'workout', 'workout__user', 'workout__user__username', 'workout__user__strava_allow_follow', 'workout__sport_type',
+        'workout__start_datetime', 'workout__duration', 'workout__steps', 'workout__strava_id',
+        'id', 'goal', 'goal__name', 'award', 'award__name', 'points_capped', 'points_raw',
+    ).order_by('competition', 'workout', 'goal', 'award', 'id')
+
+    entries = {}
+    for i in rows:
+        entry = entries.setdefault((i['competition'], i['workout']), {
+            'workout__user': i['workout__user'],
+            'workout__user__username': i['workout__user__username'],
+            'workout__user__strava_allow_follow': i['workout__user__strava_allow_follow'],
+            'workout': i['workout'],
+            'workout__sport_type': i['workout__sport_type'],
+            'workout__start_datetime': i['workout__start_datetime'],
+            'workout__duration': i['workout__duration'],
+            'workout__steps': i['workout__steps'],
+            'workout__strava_id': i['workout__strava_id'],
+            'award': None,
+            'details': [],
+        })
+        entry['details'].append({key: i[key] for key in ('workout', 'id', 'goal', 'goal__name', 'award', 'award__name', 'points_capped', 'points_raw')})
+        if i['award'] is not None:
+            entry['award'] = i['award']
+    for entry in entries.values():
+        entry['points_capped'] = _sum(i['points_capped'] for i in entry['details'])
+        entry['points_raw'] = _sum(i['points_raw'] for i in entry['details'])
+
+    with transaction.atomic(savepoint=False):
+        feed_entries.delete()
+        FeedEntry.objects.bulk_create([
+            FeedEntry(competition_id=competition, workout_id=workout, user_id=entry['workout__user'], start_datetime=entry['workout__start_datetime'], data=entry)
+            for (competition, workout), entry in entries.items()
+        ], batch_size=500)
+        # only timelines with new entries can grow beyond the limit
+        trim_feed({competition for competition, _ in entries.keys()})
+    return len(entries)
+
+
+def trim_feed(competitions):
+    """ delete the feed entries of the competitions beyond the newest settings.FEED_TIMELINE_LENGTH """
+    FeedEntry = apps.get_model('competition', 'FeedEntry')
+    for competition in competitions:
+        timeline = FeedEntry.objects.filter(competition=competition)
+        oldest_kept = timeline.order_by('-start_datetime', '-workout').values_list('start_datetime', 'workout')[settings.FEED_TIMELINE_LENGTH - 1:settings.FEED_TIMELINE_LENGTH]
+        if len(oldest_kept) > 0:
+            start_datetime, workout_id = oldest_kept[0]
+            timeline.filter(Q(start_datetime__lt=start_datetime) | Q(start_datetime=start_datetime, workout__lt=workout_id)).delete()
+
+
+def get_feed(competition, limit=FEED_PAGE_SIZE, cursor=None, since=None):
+    """ timeline of a competition newest first - the page older than cursor, or the entries newer than since """
+    FeedEntry = apps.get_model('competition', 'FeedEntry')
+
+    timeline = FeedEntry.objects.filter(competition=competition)
+    if since is not None:
+        # oldest entries after since first - the client keeps polling with latest while has_newer
+        start_datetime, workout_id = decode_cursor(since)
+        timeline = timeline.filter(Q(start_datetime__gt=start_datetime) | Q(start_datetime=start_datetime, workout__gt=workout_id)).order_by('start_datetime', 'workout')
+    else:
+        if cursor is not None:
+            start_datetime, workout_id = decode_cursor(cursor)
+            timeline = timeline.filter(Q(start_datetime__lt=start_datetime) | Q(start_datetime=start_datetime, workout__lt=workout_id))
+        timeline = timeline.order_by('-start_datetime', '-workout')
+
+    entries = list(timeline.values_list('start_datetime', 'workout', 'data')[:limit + 1])
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    if since is not None:
+        entries.reverse()
+
+    return {
+        'results': [data for _, _, data in entries],
+        'next': encode_cursor(*entries[-1][:2]) if has_more and since is None else None,
+        'latest': encode_cursor(*entries[0][:2]) if len(entries) > 0 else since,
+        'has_newer': has_more and since is not None,
+    }
@@ -0,0 +1,18 @@
+# filters.py
+import django_filters
+from django.db.models import Q
+from .models import Points
+
+class PointsFilter(django_filters.FilterSet):
+    start_datetime__gte = django_filters.IsoDateTimeFilter(field_name='start_datetime', lookup_expr='gte')
+    start_datetime__lt = django_filters.IsoDateTimeFilter(field_name='start_datetime', lookup_expr='lt')
+    sport_type = django_filters.CharFilter(field_name='workout__sport_type')
+    sport_type__in = django_filters.BaseInFilter(field_name='workout__sport_type')
+    competition = django_filters.NumberFilter(method='filter_competition')
+
+    def filter_competition(self, queryset, name, value):
+        return queryset.filter(Q(goal__competition=value) | Q(award__competition=value))
+
+    class Meta:
+        model = Points
+        fields = ['goal', 'award', 'workout']
@@ -0,0 +1,283 @@
+from functools import lru_cache
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Sum, Count, F, Q, FilteredRelation, FloatField, Window
+from django.db.models.functions import Cast, Greatest, Rank, RowNumber
+from django.utils.module_loading import import_string
+
+
+LEADERBOARD_KINDS = ('user', 'team')
+
+
+def _team_memberships(competition_id, user_ids=None):
+    """ (user_id, team_id) pairs of the teams of a competition """
+    CustomUser = apps.get_model('custom_user', 'CustomUser')
+    memberships = CustomUser.my_teams.through.objects.filter(team__competition=competition_id)
+    if user_ids is not None:
+        memberships = memberships.filter(customuser__in=user_ids)
+    return list(memberships.values_list('customuser', 'team'))
+
+
+class BaseLeaderboard:
+    """ Individual and team totals of a competition ranked by capped points - teams by points per active member like the stats """
+
+    tracks_deltas = False  # whether apply_deltas needs to be called with the points_capped changes
+
+    def apply_deltas(self, competition_id, deltas):
+        """ add the points_capped changes of a competition - dict user_id -> delta """
+        pass
+
+    def rebuild(self, competition_id):
+        """ reconcile the totals of a competition with the Points table """
+        pass
+
+    def top(self, competition_id, n, kind='user'):
+        """ first n entries - list of dicts with id, points and rank (ties share a rank) """
+        raise NotImplementedError
+
+    def rank(self, competition_id, member_id, kind='user'):
+        """ entry of one user / team - None if it has no points """
+        raise NotImplementedError
+
+    def ranks(self, competition_id, member_ids, kind='user'):
+        """ entries of several users / teams - those without points are left out """
+        return [i for i in (self.rank(competition_id, member_id, kind=kind) for member_id in member_ids) if i is not None]
+
+    def position(self, competition_id, member_id, kind='user'):
+        """ 0-based position of one user / team in the ranking - None if it has no points """
+        raise NotImplementedError
+
+    def around(self, competition_id, member_id, n, kind='user'):
+        """ entry of one user / team with its n neighbours above and below """
+        raise NotImplementedError
+
+    def page(self, competition_id, offset, limit, kind='user'):
+        """ limit entries starting at the 0-based position offset """
+        raise NotImplementedError
+
+    def count(self, competition_id, kind='user'):
+        """ number of ranked users / teams """
+        raise NotImplementedError
+
+    def rebuild_on_commit(self, competition_ids):
+        """ rebuild once the membership changes of the current transaction are committed """
+        if self.tracks_deltas:
+            competition_ids = set(competition_ids)
+            transaction.on_commit(lambda: [self.rebuild(i) for i in competition_ids])
+
+
+class DatabaseLeaderboard(BaseLeaderboard):
+    """ ranks straight from the DailyPoints rollup with window functions - nothing to maintain """
+
+    def _totals(self, competition_id, kind):
+        DailyPoints = apps.get_model('competition', 'DailyPoints')
+        daily_points = DailyPoints.objects.filter(competition=competition_id)
+        if kind == 'user':
+            return daily_points.values(member=F('user')).annotate(points=Cast(Sum('points_capped'), FloatField()))
+        return (
+            daily_points
+            .annotate(competition_team=FilteredRelation('user__my_teams', condition=Q(user__my_teams__competition=competition_id)))
+            .filter(competition_team__isnull=False)
+            .values(member=F('competition_team'))
+            .annotate(points=Cast(Sum('points_capped'), FloatField()) / Greatest(Count('user', distinct=True, filter=Q(points_capped__gt=0)), 1))
+        )
+
+    def _ranked(self, competition_id, kind):
+        return self._totals(competition_id, kind).annotate(
+            rank=Window(Rank(), order_by=F('points').desc()),
+            position=Window(RowNumber(), order_by=[F('points').desc(), F('member').asc()]),
+        ).order_by('position')
+
+    def ranked_members(self, competition_id, member_ids, kind='user'):
+        """ rows (member, points, rank, position) of some members - the totals of all members are ranked before picking them """
+        member_ids = list(member_ids)
+        if len(member_ids) == 0:
+            return []
+        # a filter on the member in the ORM would be applied before the window functions and rank only those rows
+        sql, params = self._ranked(competition_id, kind).query.sql_with_params()
+        columns = ['member', 'points', 'rank', 'position']
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT {", ".join(connection.ops.quote_name(i) for i in columns)} FROM ({sql}) ranked WHERE {connection.ops.quote_name("member")} IN ({", ".join(["%s"] * len(member_ids))})',
+                list(params) + member_ids,
+            )
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    @staticmethod
+    def _entry(row):
+        return {'id': row['member'], 'points': round(row['points'], 2), 'rank': row['rank']}
+
+    def top(self, competition_id, n, kind='user'):
+        return self.page(competition_id, 0, n, kind=kind)
+
+    def rank(self, competition_id, member_id, kind='user'):
+        rows = self.ranked_members(competition_id, [member_id], kind=kind)
+        return self._entry(rows[0]) if len(rows) > 0 else None
+
+    def ranks(self, competition_id, member_ids, kind='user'):
+        return [self._entry(i) for i in self.ranked_members(competition_id, member_ids, kind=kind)]
+
+    def position(self, competition_id, member_id, kind='user'):
+        rows = self.ranked_members(competition_id, [member_id], kind=kind)
+        return rows[0]['position'] - 1 if len(rows) > 0 else None
+
+    def around(self, competition_id, member_id, n, kind='user'):
+        rows = self.ranked_members(competition_id, [member_id], kind=kind)
+        if len(rows) == 0:
+            return []
+        return [self._entry(i) for i in self._ranked(competition_id, kind).filter(position__gte=rows[0]['position'] - n, position__lte=rows[0]['position'] + n)]
+
+    def page(self, competition_id, offset, limit, kind='user'):
+        return [self._entry(i) for i in self._ranked(competition_id, kind)[offset:offset + limit]]
+
+    def count(self, competition_id, kind='user'):
+        return self._totals(competition_id, kind).count()
+
+
+class RedisLeaderboard(BaseLeaderboard):
+    """ Redis sorted sets per competition updated with points_capped deltas - scores in cents to stay exact """
+
+    tracks_deltas = True
+
+    # KEYS: user sorted set, team sorted set, team sum hash, team active member hash
+    # ARGV: repeated user_id, delta in cents, number of teams, team ids...
+    APPLY_SCRIPT = """
+        local i = 1
+        while i <= #ARGV do
+            local delta = tonumber(ARGV[i + 1])
+            local total = tonumber(redis.call('ZINCRBY', KEYS[1], delta, ARGV[i]))
+            local active_change = 0
+            if total - delta <= 0 and total > 0 then active_change = 1 end
+            if total - delta > 0 and total <= 0 then active_change = -1 end
+            for j = 1, tonumber(ARGV[i + 2]) do
+                local team = ARGV[i + 2 + j]
+                local team_total = tonumber(redis.call('HINCRBY', KEYS[3], team, delta))
+                local team_active = tonumber(redis.call('HINCRBY', KEYS[4], team, active_change))
+                redis.call('ZADD', KEYS[2], team_total / math.max(team_active, 1), team)
+            end
+            i = i + 3 + tonumber(ARGV[i + 2])
+        end
+    """
+
+    def __init__(self, connection=None):
+        if connection is None:
+            from django_redis import get_redis_connection
+            connection = get_redis_connection('default')
+        self.connection = connection
+        self._apply = connection.register_script(self.APPLY_SCRIPT)
+
+    @staticmethod
+    def keys(competition_id):
+        return [f'leaderboard:{competition_id}:{i}' for i in ('user', 'team', 'team_total', 'team_active')]
+
+    def apply_deltas(self, competition_id, deltas):
+        deltas = {user_id: round(float(delta) * 100) for user_id, delta in deltas.items() if round(float(delta) * 100) != 0}
+        if len(deltas) == 0:
+            return
+        user_teams = {}
+        for user_id, team_id in _team_memberships(competition_id, user_ids=list(deltas.keys())):
+            user_teams.setdefault(user_id, []).append(team_id)
+
+        args = []
+        for user_id, delta in deltas.items():
+            args.extend([user_id, delta, len(user_teams.get(user_id, []))] + user_teams.get(user_id, []))
+        self._apply(keys=self.keys(competition_id), args=args)
+
+    def rebuild(self, competition_id):
+        Points = apps.get_model('competition', 'Points')
+        user_totals = {
+            i['workout__user']: round(float(i['total']) * 100)
+            for i in Points.objects.filter(Q(goal__competition=competition_id) | Q(award__competition=competition_id), workout__user__my_competitions=competition_id).values('workout__user').annotate(total=Sum('points_capped'))
+            if i['total'] is not None
+        }
+        team_totals, team_active = {}, {}
+        for user_id, team_id in _team_memberships(competition_id):
+            team_totals[team_id] = team_totals.get(team_id, 0) + user_totals.get(user_id, 0)
+            team_active[team_id] = team_active.get(team_id, 0) + (1 if user_totals.get(user_id, 0) > 0 else 0)
+
+        # build the new sets next to the live ones and swap them in one transaction
+        keys = self.keys(competition_id)
+        new_values = [
+            user_totals,
+            {team_id: total / max(team_active[team_id], 1) for team_id, total in team_totals.items()},
+            team_totals,
+            team_active,
+        ]
+        pipe = self.connection.pipeline(transaction=True)
+        for idx, (key, values) in enumerate(zip(keys, new_values)):
+            if len(values) == 0:
+                pipe.delete(key)
+            elif idx < 2:
+                pipe.delete(f'{key}:rebuild')
+                pipe.zadd(f'{key}:rebuild', values)
+                pipe.rename(f'{key}:rebuild', key)
+            else:
+                pipe.delete(f'{key}:rebuild')
+                pipe.hset(f'{key}:rebuild', mapping=values)
+                pipe.rename(f'{key}:rebuild', key)
+        pipe.execute()
+
+    def _entries(self, key, start, rows):
+        """ competition ranking of a slice of the sorted set starting at index start """
+        entries = []
+        for idx, (member, score) in enumerate(rows):
+            if len(entries) > 0 and score == entries[-1]['score']:
+                rank = entries[-1]['rank']
+            elif idx == 0:
+                rank = self.connection.zcount(key, f'({score}', '+inf') + 1
+            else:
+                rank = start + idx + 1
+            entries.append({'id': int(member), 'score': score, 'rank': rank})
+        return [{'id': i['id'], 'points': round(i['score'] / 100, 2), 'rank': i['rank']} for i in entries]
+
+    def _key(self, competition_id, kind):
+        return self.keys(competition_id)[LEADERBOARD_KINDS.index(kind)]
+
+    def top(self, competition_id, n, kind='user'):
+        return self.page(competition_id, 0, n, kind=kind)
+
+    def rank(self, competition_id, member_id, kind='user'):
+        key = self._key(competition_id, kind)
+        score = self.connection.zscore(key, member_id)
+        if score is None:
+            return None
+        return {'id': int(member_id), 'points': round(score / 100, 2), 'rank': self.connection.zcount(key, f'({score}', '+inf') + 1}
+
+    def ranks(self, competition_id, member_ids, kind='user'):
+        key = self._key(competition_id, kind)
+        member_ids = list(member_ids)
+        pipe = self.connection.pipeline(transaction=False)
+        for member_id in member_ids:
+            pipe.zscore(key, member_id)
+        scores = [(member_id, score) for member_id, score in zip(member_ids, pipe.execute()) if score is not None]
+        for _, score in scores:
+            pipe.zcount(key, f'({score}', '+inf')
+        return [{'id': int(member_id), 'points': round(score / 100, 2), 'rank': higher + 1} for (member_id, score), higher in zip(scores, pipe.execute())]
+
+    def position(self, competition_id, member_id, kind='user'):
+        return self.connection.zrevrank(self._key(competition_id, kind), member_id)
+
+    def around(self, competition_id, member_id, n, kind='user'):
+        key = self._key(competition_id, kind)
+        idx = self.connection.zrevrank(key, member_id)
+        if idx is None:
+            return []
+        start = max(idx - n, 0)
+        return self._entries(key, start, self.connection.zrevrange(key, start, idx + n, withscores=True))
+
+    def page(self, competition_id, offset, limit, kind='user'):
+        key = self._key(competition_id, kind)
+        if limit <= 0:
+            return []
+        return self._entries(key, offset, self.connection.zrevrange(key, offset, offset + limit - 1, withscores=True))
+
+    def count(self, competition_id, kind='user'):
+        return self.connection.zcard(self._key(competition_id, kind))
+
+
+@lru_cache(maxsize=None)
+def get_leaderboard():
+    """ leaderboard backend configured in settings.LEADERBOARD_BACKEND """
+    return import_string(settings.LEADERBOARD_BACKEND)()
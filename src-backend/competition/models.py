@@ -1,15 +1,19 @@
 import time, re, random
 from decimal import Decimal
 
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.core.validators import MinLengthValidator, RegexValidator
 from django.core.exceptions import ValidationError
+from rest_framework.utils.encoders import JSONEncoder
 
 from workouts.models import Workout, SPORT_TYPE_GROUPS, SPORT_TYPES
 from custom_user.models import CustomUser
+from custom_user.point_recalc import refresh_daily_points
 from .scorer import trigger_goal_change, trigger_competition_change
+from .leaderboard import get_leaderboard
+from .stats import bump_stats_version
 
 # Create your models here.
 COMPETITION_METRCIS = [
@@ -134,6 +138,13 @@ class Team(models.Model):
         return f"{self.competition} - Team: {self.name}"
 
 
+@receiver([post_save, post_delete], sender=Team)
+def team_changed_handler(sender, instance, **kwargs):
+    """ teams are part of the competition stats and the team leaderboard """
+    bump_stats_version([instance.competition_id])
+    get_leaderboard().rebuild_on_commit([instance.competition_id])
+
+
 class ActivityGoal(models.Model):
     """Activity goals in Competition - user will earn points for each rule/category"""
 
@@ -218,6 +229,7 @@ class Points(models.Model):
 
     points_raw = models.DecimalField(null=False, max_digits=10, decimal_places=2)
     points_capped = models.DecimalField(null=True, max_digits=10, decimal_places=2)
+    start_datetime = models.DateTimeField(null=True, blank=True)  # copy of the workout's - keyset of the points list
 
     class Meta:
         verbose_name = "Points"
@@ -225,7 +237,81 @@ class Points(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['goal', 'award', 'workout'], name='unique_goal_award_workout')
         ]
+        indexes = [
+            models.Index(fields=['start_datetime', 'id'], name='points_keyset'),
+        ]
+
+    def __str__(self):
+        """str print-out of model entry"""
+        return f"{self.award if self.goal is None else self.goal} - {self.points_raw}"
+
+    def save(self, *args, **kwargs):
+        """ keep the copy of the workout's start_datetime """
+        self.start_datetime = self.workout.start_datetime
+        return super().save(*args, **kwargs)
+
+
+@receiver(post_save, sender=Points)
+def award_points_saved_handler(sender, instance, **kwargs):
+    """ award points are part of the daily points rollup - goal points are rolled up by the point recalc """
+    if instance.award_id is not None:
+        refresh_daily_points(awards=Award.objects.filter(pk=instance.award_id), user_id=instance.workout.user_id)
+
+
+@receiver(post_delete, sender=Points)
+def award_points_deleted_handler(sender, instance, **kwargs):
+    """ rolled up once the transaction is committed - a cascading delete of the award or workout has to be finished first """
+    if instance.award_id is not None:
+        award_id = instance.award_id
+        transaction.on_commit(lambda: refresh_daily_points(awards=Award.objects.filter(pk=award_id)))
+
+
+class DailyPoints(models.Model):
+    """Rollup of a user's capped points per goal or award and local day - rebuilt by the point recalc, read by the stats"""
+
+    competition = models.ForeignKey(Competition, on_delete=models.CASCADE, null=False, blank=False)
+    goal = models.ForeignKey(ActivityGoal, on_delete=models.CASCADE, null=True, blank=True)
+    award = models.ForeignKey(Award, on_delete=models.CASCADE, null=True, blank=True)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=False, blank=False)
+    day = models.DateField(null=False)  # in settings.TIME_ZONE
+
+    points_capped = models.DecimalField(null=False, default=0, max_digits=12, decimal_places=2)
+
+    class Meta:
+        verbose_name = "Daily Points"
+        verbose_name_plural = "Daily Points"
+        constraints = [
+            models.UniqueConstraint(fields=['goal', 'award', 'user', 'day'], name='unique_goal_award_user_day')
+        ]
+        indexes = [
+            models.Index(fields=['competition', 'day'], name='dailypoints_competition_day'),
+        ]
+
+    def __str__(self):
+        """str print-out of model entry"""
+        return f"{self.award if self.goal is None else self.goal} - {self.user} {self.day}: {self.points_capped}"
+
+
+class FeedEntry(models.Model):
+    """Pre-serialized feed entry of a workout in a competition - written with its points, trimmed to settings.FEED_TIMELINE_LENGTH per competition"""
+
+    competition = models.ForeignKey(Competition, on_delete=models.CASCADE, null=False, blank=False)
+    workout = models.ForeignKey(Workout, on_delete=models.CASCADE, null=False, blank=False)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=False, blank=False)
+    start_datetime = models.DateTimeField(null=False)  # copy of the workout's - keyset of the feed
+
+    data = models.JSONField(null=False, encoder=JSONEncoder)  # serialized like the API response
+
+    class Meta:
+        verbose_name = "Feed Entry"
+        verbose_name_plural = "Feed Entries"
+        constraints = [
+            models.UniqueConstraint(fields=['competition', 'workout'], name='unique_competition_workout')
+        ]
+        indexes = [
+            models.Index(fields=['competition', 'start_datetime', 'workout'], name='feedentry_competition_keyset'),
+        ]
 
     def __str__(self):
         """str print-out of model entry"""
-        return f"{self.award if self.goal is None else self.goal} - {self.points_raw}"
\ No newline at end of file
+        return f"{self.competition} - {self.workout}"
@@ -1,7 +1,15 @@
 import datetime
 from django.apps import apps
+from django.db import transaction
+from django.db.models import F, Func, Value, Case, When, Min, Subquery, OuterRef, FloatField, DecimalField
+from django.db.models.functions import Cast, Coalesce, Round
 
-from custom_user.point_recalc import trigger_recalc_points
+from custom_user.point_recalc import trigger_recalc_points, refresh_daily_points
+from custom_user.recalc_queue import get_recalc_queue
+from .feed import refresh_feed
+from .leaderboard import get_leaderboard
+from .side_effects import pending_side_effects, changed_metrics
+from .stats import bump_stats_version
 
 
 def _calculate_points_raw(goal, workout, user):
@@ -33,139 +41,194 @@ def _calculate_points_raw(goal, workout, user):
     return points * 100
 
 
+class DurationSeconds(Func):
+    """ seconds of a DurationField as float - database equivalent of duration.total_seconds() """
+    output_field = FloatField()
+
+    def as_sql(self, compiler, connection, **extra_context):
+        # SQLite stores durations as microseconds
+        return super().as_sql(compiler, connection, template='(%(expressions)s / 1000000.0)', **extra_context)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, template='EXTRACT(EPOCH FROM %(expressions)s)::double precision', **extra_context)
+
+
+def _points_raw_expression(metric, goal='goal', workout='workout', user='workout__user'):
+    """ database equivalent of _calculate_points_raw for goals of one metric - field paths are relative to the queried model """
+    def decimal(path, decimal_places=2):
+        # SQLite keeps decimals as unquantized REAL - round like the DecimalField does when loading the row
+        return Cast(Round(F(path), decimal_places), FloatField())
+
+    goal_target = decimal(f'{goal}__goal')
+
+    if metric == 'min':
+        points = DurationSeconds(F(f'{workout}__duration')) / Value(60.0) / goal_target
+    elif metric == 'num':
+        points = Value(1.0) / goal_target
+    elif metric == 'kcal':
+        points = decimal(f'{workout}__kcal') / (goal_target * decimal(f'{user}__scaling_kcal', 4))
+    elif metric == 'km':
+        points = decimal(f'{workout}__distance') / (goal_target * decimal(f'{user}__scaling_distance', 4))
+    elif metric == 'kj':
+        points = decimal(f'{workout}__kcal') * Value(4.18) / (goal_target * decimal(f'{user}__scaling_kcal', 4))
+    else:
+        raise ValueError(f'Unknown goal metric {metric}')
+    return Coalesce(points, Value(0.0)) * Value(100.0)
+
+
+def _update_points_raw(points):
+    """ recalculate points_raw of a Points queryset with a single UPDATE - points_capped is reset until the next point cap recalc """
+    Points = apps.get_model('competition', 'Points')
+    ActivityGoal = apps.get_model('competition', 'ActivityGoal')
+
+    # UPDATE can't reference joined fields directly - evaluate the expression in a subquery on the same row
+    points_raw = Case(*[When(goal__metric=metric, then=_points_raw_expression(metric)) for metric, _ in ActivityGoal._meta.get_field('metric').choices])
+    points_raw = Subquery(Points.objects.filter(pk=OuterRef('pk')).annotate(points_raw_new=Round(Cast(points_raw, DecimalField(max_digits=10, decimal_places=2)), 2)).values('points_raw_new'))
+    return points.filter(goal__isnull=False).update(points_raw=points_raw, points_capped=points_raw)
+
+
+def _copy_start_datetime(points):
+    """ copy the start_datetime of the workouts onto a Points queryset with a single UPDATE """
+    Workout = apps.get_model('workouts', 'Workout')
+    return points.update(start_datetime=Subquery(Workout.objects.filter(pk=OuterRef('workout')).values('start_datetime')))
+
+
+def _create_points(goals, workouts, recalc=True):
+    """ add the point entries of many workouts for many goals at once and request one point cap recalc per (user, goal) """
+    Points = apps.get_model('competition', 'Points')
+
+    goals = list(goals)
+    existing = set(Points.objects.filter(goal__in=goals, workout__in=workouts.values('pk')).values_list('goal', 'workout'))
+    workouts = list(workouts.select_related('user'))
+
+    points_lst = []
+    recalc_requests = {}
+    for goal in goals:
+        for workout in workouts:
+            if (goal.pk, workout.pk) in existing or (goal.count_steps_as_walks is False and workout.sport_type == 'Steps'):
+                continue
+            points = _calculate_points_raw(goal=goal, workout=workout, user=workout.user)
+            points_lst.append(Points(goal=goal, workout=workout, points_raw=points, points_capped=points, start_datetime=workout.start_datetime))
+            key = (workout.user_id, goal.pk)
+            recalc_requests[key] = min(recalc_requests.get(key, workout.start_datetime), workout.start_datetime)
+
+    # existing points are filtered out above as unique_goal_award_workout does not catch duplicates with award NULL
+    Points.objects.bulk_create(points_lst, batch_size=500, ignore_conflicts=True)
+    refresh_feed(competitions={goal.competition_id for goal in goals}, workouts={i.workout_id for i in points_lst})
+    if recalc:
+        get_recalc_queue().enqueue_on_commit([(user_id, goal_id, start_datetime) for (user_id, goal_id), start_datetime in recalc_requests.items()])
+    return len(points_lst)
+
+
 def trigger_workout_delete(instance):
-    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
-    for points in instance.points_set.all():
-        RecalcRequest(user=instance.user, goal=points.goal, start_datetime=instance.start_datetime).save()
+    effects = pending_side_effects()
+    for goal_id in instance.points_set.filter(goal__isnull=False).values_list('goal', flat=True):
+        effects.recalc(instance.user_id, goal_id, instance.start_datetime)
+    if instance.sport_type in ['Run', 'Walk']:
+        # steps of the day get the deleted walk / run back
+        effects.reconcile_steps(instance.user_id, [instance.start_datetime])
     print(f"Workout ({instance.pk}) deletion triggered point cap recalc - after {instance.start_datetime.isoformat()}")
 
-    trigger_recalc_points()
-
 
 def trigger_workout_change(instance, new, changes):
-
-    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
+    """ queue the points, steps and recalc work of a saved workout - runs once at the end of the outermost side_effects_atomic block """
+    effects = pending_side_effects()
 
     if new:
         # newly created workout - add point entries
-        Points = apps.get_model('competition', 'Points')
-        start_datetime = datetime.datetime.strptime(instance.start_datetime, '%Y-%m-%dT%H:%M:%SZ') if type(instance.start_datetime) is str else instance.start_datetime
-        for competition in instance.user.my_competitions.filter(start_date__lte=start_datetime, end_date__gte=start_datetime):
-            for goal in competition.activitygoal_set.all():
-                if goal.count_steps_as_walks or instance.sport_type != 'Steps':
-                    points = _calculate_points_raw(goal=goal, workout=instance, user=instance.user)
-                    Points(goal=goal, workout=instance, points_raw=points, points_capped=points).save()
-                    RecalcRequest(user=instance.user, goal=goal, start_datetime=start_datetime).save()
+        effects.workout_created(instance)
     else:
-        # updated existing workout
-        # check if relevant field was changed
-        metric_change_lst = []
-        if 'start_datetime' in changes:
-            metric_change_lst.extend(['min', 'num', 'kcal', 'km', 'kj'])
-        if 'duration' in changes:
-            metric_change_lst.extend(['min'])
-        if 'kcal' in changes:
-            metric_change_lst.extend(['kcal', 'kj'])
-        if 'distance' in changes:
-            metric_change_lst.extend(['km'])
-
-        recalc_start_datetime = changes.get('start_datetime', [instance.start_datetime])[0]
-        for recalc_points, recalc_goal in [(i, i.goal) for i in instance.points_set.all() if i.goal.metric in metric_change_lst]:
-            points = _calculate_points_raw(goal=recalc_goal, workout=instance, user=instance.user)
-            setattr(recalc_points, 'points_raw', points)
-            setattr(recalc_points, 'points_capped', points)
-            recalc_points.save()
-            RecalcRequest(user=instance.user, goal=recalc_goal, start_datetime=recalc_start_datetime).save()
+        # updated existing workout - points of the metrics of the changed fields
+        effects.workout_changed(instance, changes)
 
+    # if workout is run or walk and steps were recorded on the same day, update steps to avoid double counting
+    sport_types = set(changes.get('sport_type', [instance.sport_type]))
+    if len(sport_types & {'Run', 'Walk'}) > 0 and (new or 'sport_type' in changes or len(changed_metrics(changes)) > 0):
+        effects.reconcile_steps(instance.user_id, changes.get('start_datetime', [instance.start_datetime]))
     print(f"Workout ({instance.pk}) update triggered point cap recalc - {'NEW ENTRY' if new else 'EXISTING CHANGED'}" + ("" if new else f" - {changes}"))
 
-    trigger_recalc_points()
-
 
 def trigger_goal_change(instance, new, changes):
-    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
-    Points = apps.get_model('competition', 'Points')
+    recalc_queue = get_recalc_queue()
     Workout = apps.get_model('workouts', 'Workout')
+    competition_workouts = Workout.objects.filter(start_datetime__gte=instance.competition.start_date, start_datetime__lte=instance.competition.end_date + datetime.timedelta(days=1), user__in=instance.competition.user.all())
     if new:
         # newly created goal - add point entries
-        workout_lst = Workout.objects.filter(start_datetime__gte=instance.competition.start_date, start_datetime__lte=instance.competition.end_date + datetime.timedelta(days=1), user__in=instance.competition.user.all())
-        if instance.count_steps_as_walks is False:
-            workout_lst = workout_lst.exclude(sport_type='Steps')
-        for workout in workout_lst:
-            points = _calculate_points_raw(goal=instance, workout=workout, user=workout.user)
-            Points(goal=instance, workout=workout, points_raw=points, points_capped=points).save()
-            RecalcRequest(user=workout.user, goal=instance, start_datetime=workout.start_datetime).save()
+        _create_points(goals=[instance], workouts=competition_workouts)
     else:
         # updated existing workout
         # check if relevant field was changed
-        _ = changes.pop('name', None)
+        if changes.pop('name', None) is not None:
+            refresh_feed(competitions=[instance.competition_id])
         if len(changes) > 0:
             if 'count_steps_as_walks' in changes:
                 # add steps
                 if changes['count_steps_as_walks'][1]:
-                    for workout in Workout.objects.filter(start_datetime__gte=instance.competition.start_date, start_datetime__lte=instance.competition.end_date + datetime.timedelta(days=1), user__in=instance.competition.user.all(), sport_type='Steps'):
-                        points = _calculate_points_raw(goal=instance, workout=workout, user=workout.user)
-                        Points(goal=instance, workout=workout, points_raw=points, points_capped=points).save()
+                    _create_points(goals=[instance], workouts=competition_workouts.filter(sport_type='Steps'), recalc=False)
                 # remove steps
                 else:
-                    for point in instance.points_set.filter(workout__sport_type='Steps'):
-                        point.delete()
-            for user in instance.competition.user.all():
-                RecalcRequest(user=user, goal=instance, start_datetime=instance.competition.start_date).save()
+                    instance.points_set.filter(workout__sport_type='Steps').delete()
+            if 'goal' in changes or 'metric' in changes:
+                _update_points_raw(instance.points_set.all())
+            recalc_queue.enqueue_on_commit([(user_id, instance.pk, instance.competition.start_date) for user_id in instance.competition.user.all().values_list('pk', flat=True)])
 
-    trigger_recalc_points()
+    bump_stats_version([instance.competition_id])
+    transaction.on_commit(trigger_recalc_points)
 
 
 def trigger_competition_change(instance, new, changes):
     Points = apps.get_model('competition', 'Points')
-    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
+    recalc_queue = get_recalc_queue()
+    ScorerCheckpoint = apps.get_model('custom_user', 'ScorerCheckpoint')
+    DailyPoints = apps.get_model('competition', 'DailyPoints')
+    FeedEntry = apps.get_model('competition', 'FeedEntry')
     Workout = apps.get_model('workouts', 'Workout')
 
+    # name, dates, ... are part of the stats
+    bump_stats_version([instance.pk])
+
     # newly created competitions are ignored as only relevant if new goals are created
     # only catching changes of the start_date and end_date below
 
     if 'start_date' in changes:
         if changes['start_date'][1] < changes['start_date'][0]:
             # add point entries before changes['start_date'][0] till [1]
-            for goal in instance.activitygoal_set.all():
-                for workout in Workout.objects.filter(start_datetime__gte=changes['start_date'][1], start_datetime__lte=changes['start_date'][0], user__in=instance.user.all()):
-                    points = _calculate_points_raw(goal=goal, workout=workout, user=workout.user)
-                    Points(goal=goal, workout=workout, points_raw=points, points_capped=points).save()
-                    RecalcRequest(user=workout.user, goal=goal, start_datetime=workout.start_datetime).save()
+            _create_points(goals=instance.activitygoal_set.all(), workouts=Workout.objects.filter(start_datetime__gte=changes['start_date'][1], start_datetime__lte=changes['start_date'][0], user__in=instance.user.all()))
             print(f"Competition ({instance.pk}) start_date was extended from {changes['start_date'][0]} to {changes['start_date'][1]} triggering point cap recalc")
         else:
             # remove point entries before changes['start_date'][1]
             points_to_delete = Points.objects.filter(goal__competition=instance, workout__start_datetime__lt=changes['start_date'][1])
-            CustomUser = apps.get_model('custom_user', 'CustomUser')
-            ActivityGoal = apps.get_model('competition', 'ActivityGoal')
-            for user in [CustomUser.objects.get(pk=i) for i in set(points_to_delete.values_list('workout__user', flat=True))]:
-                for goal in [ActivityGoal.objects.get(pk=i) for i in set(points_to_delete.values_list('goal', flat=True))]:
-                    RecalcRequest(user=user, goal=goal, start_datetime=changes['start_date'][1]).save()
+            recalc_queue.enqueue_on_commit([(user_id, goal_id, changes['start_date'][1]) for user_id, goal_id in points_to_delete.values_list('workout__user', 'goal').distinct()])
             points_to_delete.delete()
+            ScorerCheckpoint.objects.filter(goal__competition=instance, day__lt=changes['start_date'][1]).delete()
+            DailyPoints.objects.filter(competition=instance, day__lt=changes['start_date'][1]).delete()
+            FeedEntry.objects.filter(competition=instance, start_datetime__lt=changes['start_date'][1]).delete()
+            get_leaderboard().rebuild_on_commit([instance.pk])
             print(f"Competition ({instance.pk}) start_date was shortened from {changes['start_date'][0]} to {changes['start_date'][1]} triggering point cap recalc")
 
-        trigger_recalc_points
+        transaction.on_commit(trigger_recalc_points)
 
     if 'end_date' in changes:
         if changes['end_date'][1] > changes['end_date'][0]:
             # add point entries after changes['end_date'][0] till [1]
-            for goal in instance.activitygoal_set.all():
-                for workout in Workout.objects.filter(start_datetime__gte=changes['end_date'][0] + datetime.timedelta(days=1), start_datetime__lte=changes['end_date'][1] + datetime.timedelta(days=1), user__in=instance.user.all()):
-                    points = _calculate_points_raw(goal=goal, workout=workout, user=workout.user)
-                    Points(goal=goal, workout=workout, points_raw=points, points_capped=points).save()
-                    RecalcRequest(user=workout.user, goal=goal, start_datetime=workout.start_datetime).save()
+            _create_points(goals=instance.activitygoal_set.all(), workouts=Workout.objects.filter(start_datetime__gte=changes['end_date'][0] + datetime.timedelta(days=1), start_datetime__lte=changes['end_date'][1] + datetime.timedelta(days=1), user__in=instance.user.all()))
             print(f"Competition ({instance.pk}) end_date was extended from {changes['end_date'][0]} to {changes['end_date'][1]} triggering point cap recalc")
         else:
             # remove point entries after changes['end_date'][1]
             Points.objects.filter(goal__competition=instance, workout__start_datetime__gt=changes['end_date'][1]).delete()
+            ScorerCheckpoint.objects.filter(goal__competition=instance, day__gt=changes['end_date'][1]).delete()
+            refresh_daily_points(goals=instance.activitygoal_set.all(), start_datetime=changes['end_date'][1])
             print(f"Competition ({instance.pk}) end_date was shortened from {changes['end_date'][0]} to {changes['end_date'][1]} NOT triggering point cap recalc")
 
-        trigger_recalc_points()
+        transaction.on_commit(trigger_recalc_points)
 
 
 def trigger_user_change(instance, new, changes):
     Points = apps.get_model('competition', 'Points')
-    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
+    recalc_queue = get_recalc_queue()
+    ScorerCheckpoint = apps.get_model('custom_user', 'ScorerCheckpoint')
+    DailyPoints = apps.get_model('competition', 'DailyPoints')
+    FeedEntry = apps.get_model('competition', 'FeedEntry')
 
     # check if user leaves or joins a competition
     if 'my_competitions' in changes:
@@ -174,31 +237,34 @@ def trigger_user_change(instance, new, changes):
             # add/join competition
             Workout = apps.get_model('workouts', 'Workout')
             Competition = apps.get_model('competition', 'Competition')
-            for competition in Competition.objects.filter(pk__in=changes['my_competitions'][1]):
+            for competition in Competition.objects.filter(pk__in=changes['my_competitions'][1]).prefetch_related('activitygoal_set'):
                 workout_lst = Workout.objects.filter(user=instance, start_datetime__gte=competition.start_date, start_datetime__lte=competition.end_date + datetime.timedelta(days=1))
-                for goal in competition.activitygoal_set.all():
-                    for workout in workout_lst:
-                        points = _calculate_points_raw(goal=goal, workout=workout, user=instance)
-                        Points(goal=goal, workout=workout, points_raw=points, points_capped=points).save()
-                    RecalcRequest(user=instance, goal=goal, start_datetime=competition.start_date).save()
+                _create_points(goals=competition.activitygoal_set.all(), workouts=workout_lst)
             print(f"User ({instance.pk}) join competitions {changes['my_competitions'][1]} triggering point cap recalc")
         else:
             # remove/leave competition
             Points.objects.filter(goal__competition__in=changes['my_competitions'][0], workout__user=instance).delete()
+            ScorerCheckpoint.objects.filter(goal__competition__in=changes['my_competitions'][0], user=instance).delete()
+            DailyPoints.objects.filter(competition__in=changes['my_competitions'][0], user=instance).delete()
+            FeedEntry.objects.filter(competition__in=changes['my_competitions'][0], user=instance).delete()
+            get_leaderboard().rebuild_on_commit(changes['my_competitions'][0])
             print(f"User ({instance.pk}) left competitions {changes['my_competitions'][0]} NOT triggering point cap recalc")
 
-        trigger_recalc_points()
+        bump_stats_version(changes['my_competitions'][0] or changes['my_competitions'][1])
+        transaction.on_commit(trigger_recalc_points)
+
+    # user details shown in the stats of the user's competitions
+    if any(i in changes for i in ('username', 'strava_allow_follow', 'strava_athlete_id')):
+        bump_stats_version(instance.my_competitions.values_list('pk', flat=True))
+    if any(i in changes for i in ('username', 'strava_allow_follow')):
+        refresh_feed(competitions=instance.my_competitions.values_list('pk', flat=True), user_id=instance.pk)
 
     # check if equalizing / scaling factors were changed
     if 'scaling_distance' in changes or 'scaling_kcal' in changes:
         goal_metrics = (['km'] if 'scaling_distance' in changes else []) + (['kcal', 'kj'] if 'scaling_kcal' in changes else [])
         recalc_points = Points.objects.filter(goal__metric__in=goal_metrics, workout__user=instance)
 
-        for recalc_point in recalc_points:
-            points = _calculate_points_raw(goal=recalc_point.goal, workout=recalc_point.workout, user=instance)
-            setattr(recalc_point, 'points_raw', points)
-            setattr(recalc_point, 'points_capped', points)
-            recalc_point.save()
-            RecalcRequest(user=instance, goal=recalc_point.goal, start_datetime=recalc_point.workout.start_datetime).save()
+        _update_points_raw(recalc_points)
+        recalc_queue.enqueue_on_commit([(instance.pk, goal_id, start_datetime) for goal_id, start_datetime in recalc_points.values_list('goal').annotate(start_datetime=Min('workout__start_datetime'))])
 
         print(f"User ({instance.pk}) scaling factors {goal_metrics} changed triggering point cap recalc")
@@ -16,8 +16,8 @@ class CompetitionSerializer(serializers.ModelSerializer):
         read_only_fields = ['join_code', 'user', 'user_info']
 
     def get_user_info(self, obj):
-        # Assuming `obj.user` is a ManyToMany or related manager
-        users = obj.user.all().order_by('username') if hasattr(obj.user, 'all') else [obj.user]
+        # Assuming `obj.user` is a ManyToMany or related manager - sorted here to use the users prefetched by the viewset
+        users = sorted(obj.user.all(), key=lambda u: (u.username or '', u.id)) if hasattr(obj.user, 'all') else [obj.user]
         return [{'id': u.id, 'username': u.username} for u in users]
 
 
@@ -31,15 +31,15 @@ class TeamSerializer(serializers.ModelSerializer):
         read_only_fields = ['user', 'user_info', 'my']
 
     def get_user_info(self, obj):
-        # Assuming `obj.user` is a ManyToMany or related manager
-        users = obj.user.all().order_by('username') if hasattr(obj.user, 'all') else [obj.user]
+        # Assuming `obj.user` is a ManyToMany or related manager - sorted here to use the users prefetched by the viewset
+        users = sorted(obj.user.all(), key=lambda u: (u.username or '', u.id)) if hasattr(obj.user, 'all') else [obj.user]
         return [{'id': u.id, 'username': u.username} for u in users]
 
     def get_my(self, obj):
         # if it is the user's team
         request = self.context.get('request')
         if request and hasattr(request, "user"):
-            return obj.user.filter(id=request.user.id).exists()
+            return any(u.id == request.user.id for u in obj.user.all())
         return False
 
 
@@ -0,0 +1,163 @@
+import datetime, threading
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from custom_user.point_recalc import trigger_recalc_points
+from custom_user.recalc_queue import get_recalc_queue
+from .feed import refresh_feed
+
+
+# metrics whose points depend on a changed workout field
+FIELD_METRICS = {
+    'start_datetime': ['min', 'num', 'kcal', 'km', 'kj'],
+    'duration': ['min'],
+    'kcal': ['kcal', 'kj'],
+    'distance': ['km'],
+}
+
+
+def changed_metrics(changes):
+    """ goal metrics affected by the changed fields of a workout """
+    return {metric for field, metric_lst in FIELD_METRICS.items() if field in changes for metric in metric_lst}
+
+
+class WorkoutSideEffects:
+    """ points, steps and recalc work of the workout writes of one side_effects_atomic block - deduplicated and flushed once before it ends """
+
+    def __init__(self):
+        self.new_workouts = set()  # workout ids that need their point entries
+        self.changed_workouts = {}  # workout id -> [changed metrics, earliest start_datetime to recalc from]
+        self.moved_workouts = set()  # workout ids whose start_datetime has to be copied onto their points
+        self.steps_days = set()  # (user_id, day) whose steps have to be reconciled with the walks and runs
+        self.recalc_requests = {}  # (user_id, goal_id) -> earliest start_datetime
+        self.feed_workouts = set()  # workout ids whose feed entries have to be refreshed
+
+    def workout_created(self, workout):
+        self.new_workouts.add(workout.pk)
+
+    def workout_changed(self, workout, changes):
+        if 'start_datetime' in changes:
+            self.moved_workouts.add(workout.pk)
+        metrics = changed_metrics(changes)
+        if len(metrics) > 0:
+            start_datetime = min(changes.get('start_datetime', [workout.start_datetime]))
+            entry = self.changed_workouts.setdefault(workout.pk, [set(), start_datetime])
+            entry[0].update(metrics)
+            entry[1] = min(entry[1], start_datetime)
+        self.feed_workouts.add(workout.pk)
+
+    def reconcile_steps(self, user_id, days):
+        self.steps_days.update((user_id, timezone.localtime(i).date() if isinstance(i, datetime.datetime) else i) for i in days)
+
+    def recalc(self, user_id, goal_id, start_datetime):
+        key = (user_id, goal_id)
+        self.recalc_requests[key] = min(self.recalc_requests.get(key, start_datetime), start_datetime)
+
+    def _reconcile_steps(self):
+        """ recompute the steps on the days of changed walks and runs in bulk - one aggregate for all days """
+        Workout = apps.get_model('workouts', 'Workout')
+
+        condition = Q()
+        for user_id in {i[0] for i in self.steps_days}:
+            condition |= Q(user=user_id, start_datetime__date__in=[day for user, day in self.steps_days if user == user_id])
+        steps_lst = list(Workout.objects.filter(condition, sport_type='Steps').select_related('user'))
+        if len(steps_lst) == 0:
+            return
+
+        recorded_lst = Workout.objects.filter(condition, sport_type__in=['Walk', 'Run']).annotate(day=TruncDate('start_datetime')).values('user', 'day', 'sport_type').annotate(duration=Sum('duration')).order_by()
+        recorded = {(i['user'], i['day'], i['sport_type']): i['duration'] for i in recorded_lst}
+
+        changed_lst = []
+        for steps in steps_lst:
+            day = timezone.localtime(steps.start_datetime).date()
+            steps.distance, steps.kcal = None, None
+            steps.set_defaults(
+                float(steps.user.scaling_kcal), float(steps.user.scaling_distance),
+                recorded_walks=recorded.get((steps.user_id, day, 'Walk'), datetime.timedelta(0)),
+                recorded_runs=recorded.get((steps.user_id, day, 'Run'), datetime.timedelta(0)),
+            )
+            changes = steps.get_changed_fields()
+            if len(changes) > 0:
+                self.workout_changed(steps, changes)
+                steps._original = steps._dict()
+                changed_lst.append(steps)
+        Workout.objects.bulk_update(changed_lst, ['distance', 'duration', 'kcal', 'start_datetime', 'intensity_category'], batch_size=500)
+
+    def _create_points(self):
+        """ point entries of the new workouts - one bulk insert per competition """
+        from .scorer import _create_points
+        Workout = apps.get_model('workouts', 'Workout')
+        CustomUser = apps.get_model('custom_user', 'CustomUser')
+
+        new_lst = list(Workout.objects.filter(pk__in=self.new_workouts).values_list('user', 'start_datetime'))
+        for user_id in {i[0] for i in new_lst}:
+            days = [timezone.localtime(start_datetime).date() for user, start_datetime in new_lst if user == user_id]
+            competitions = CustomUser(pk=user_id).my_competitions.filter(start_date__lte=max(days), end_date__gte=min(days)).prefetch_related('activitygoal_set')
+            for competition in competitions:
+                workouts = Workout.objects.filter(pk__in=self.new_workouts, user=user_id, start_datetime__date__gte=competition.start_date, start_datetime__date__lte=competition.end_date)
+                if _create_points(goals=competition.activitygoal_set.all(), workouts=workouts, recalc=False) > 0:
+                    start_datetime = min(start_datetime for user, start_datetime in new_lst if user == user_id and competition.start_date <= timezone.localtime(start_datetime).date() <= competition.end_date)
+                    for goal in competition.activitygoal_set.all():
+                        self.recalc(user_id, goal.pk, start_datetime)
+        self.feed_workouts -= self.new_workouts
+
+    def _update_points(self):
+        """ points_raw of the changed workouts - one UPDATE per set of changed metrics """
+        from .scorer import _update_points_raw
+        Points = apps.get_model('competition', 'Points')
+
+        changed = {pk: entry for pk, entry in self.changed_workouts.items() if pk not in self.new_workouts}
+        for metrics in {frozenset(i[0]) for i in changed.values()}:
+            workout_ids = [pk for pk, entry in changed.items() if entry[0] == metrics]
+            points = Points.objects.filter(workout__in=workout_ids, goal__metric__in=metrics)
+            for workout_id, user_id, goal_id in points.filter(goal__isnull=False).values_list('workout', 'workout__user', 'goal'):
+                self.recalc(user_id, goal_id, changed[workout_id][1])
+            _update_points_raw(points)
+
+    def flush(self):
+        """ run the collected work once inside the transaction - steps first as their changes feed into the points """
+        if len(self.steps_days) > 0:
+            self._reconcile_steps()
+        if len(self.new_workouts) > 0:
+            self._create_points()
+        if len(self.changed_workouts) > 0:
+            self._update_points()
+        if len(self.moved_workouts - self.new_workouts) > 0:
+            from .scorer import _copy_start_datetime
+            _copy_start_datetime(apps.get_model('competition', 'Points').objects.filter(workout__in=self.moved_workouts - self.new_workouts))
+        if len(self.feed_workouts) > 0:
+            refresh_feed(workouts=self.feed_workouts)
+        if len(self.recalc_requests) > 0:
+            get_recalc_queue().enqueue_on_commit([(user_id, goal_id, start_datetime) for (user_id, goal_id), start_datetime in self.recalc_requests.items()])
+            transaction.on_commit(trigger_recalc_points)
+
+
+# collectors of the open side_effects_atomic blocks of this thread - the innermost last
+_pending = threading.local()
+
+
+@contextmanager
+def side_effects_atomic():
+    """ transaction.atomic for workout writes - their side effects are collected and flushed at the end of the outermost block, before it commits """
+    blocks = _pending.__dict__.setdefault('blocks', [])
+    with transaction.atomic():
+        blocks.append(WorkoutSideEffects() if len(blocks) == 0 else blocks[-1])
+        try:
+            yield blocks[-1]
+            if len(blocks) == 1:
+                blocks[0].flush()
+        finally:
+            blocks.pop()
+
+
+def pending_side_effects():
+    """ side effects collector of the current transaction - has to be called inside side_effects_atomic """
+    blocks = getattr(_pending, 'blocks', [])
+    if len(blocks) == 0:
+        raise RuntimeError('Workout side effects have to be collected inside side_effects_atomic.')
+    return blocks[-1]
@@ -1,12 +1,44 @@
-import datetime
+import datetime, time
 
-from django.conf import settings
 from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
 from rest_framework.response import Response
 from rest_framework import status
 
-from django.db.models import Sum, Count, ExpressionWrapper, DurationField, F, Q, IntegerField
-from django.db.models.functions import TruncDay, Now, ExtractDay
+from django.db.models import Sum, Q, FilteredRelation
+
+from .leaderboard import get_leaderboard
+
+
+STATS_CACHE_TIMEOUT = 60 * 60 * 24  # seconds - entries of old versions simply expire
+
+
+def _stats_version_key(competition):
+    return f'competition_stats_version_{competition}'
+
+
+def bump_stats_version(competitions):
+    """ invalidate the cached stats of the competitions once the current transaction is committed """
+    # a new timestamp instead of incr - an evicted version can't fall back to an older one
+    keys = [_stats_version_key(i) for i in set(competitions)]
+    if len(keys) > 0:
+        transaction.on_commit(lambda: cache.set_many({key: time.time_ns() for key in keys}, None))
+
+
+def get_cached_competition_stats(competition, last_seven_days=False):
+    """ get_competition_stats shared by all members - computed once per data version and local day """
+    version = cache.get_or_set(_stats_version_key(competition), time.time_ns, None)
+    cache_key = f'competition_stats_{competition}_{version}_{timezone.localdate().isoformat()}_{"7d" if last_seven_days else "all"}'
+
+    stats = cache.get(cache_key)
+    if stats is None:
+        stats = get_competition_stats(competition, last_seven_days=last_seven_days)
+        if isinstance(stats, Response):
+            return stats
+        cache.set(cache_key, stats, STATS_CACHE_TIMEOUT)
+    return stats
 
 
 def _add_rank(data, key, enhance_dict, id_field, rank_field='rank', reverse=True):
@@ -32,78 +64,47 @@ def _add_rank(data, key, enhance_dict, id_field, rank_field='rank', reverse=True
 def get_competition_stats(competition, last_seven_days=False):
     CustomUser = apps.get_model('custom_user', 'CustomUser')
     Competition = apps.get_model('competition', 'Competition')
-    Points = apps.get_model('competition', 'Points')
-    Team = apps.get_model('competition', 'Team')
+    DailyPoints = apps.get_model('competition', 'DailyPoints')
 
     # Custom query logic
     try:
-        competition_obj = Competition.objects.get(id=competition)
+        competition_obj = Competition.objects.prefetch_related('activitygoal_set', 'team_set__user').get(id=competition)
     except Competition.DoesNotExist:
         return Response({"detail": "Competition not found."}, status=status.HTTP_404_NOT_FOUND)
-    all_points = Points.objects.filter(Q(award__competition__id=competition) | Q(goal__competition_id=competition))
+    all_points = DailyPoints.objects.filter(competition=competition)
 
     if last_seven_days:
         today = datetime.date.today()
         last_sunday = today - datetime.timedelta(days=today.weekday() + 1) if today.weekday() != 6 else today
         monday_before = last_sunday - datetime.timedelta(days=6)
-        all_points = all_points.filter(workout__start_datetime__gte=monday_before, workout__start_datetime__lt=last_sunday + datetime.timedelta(days=1))
-
-    # For SQLite
-    if settings.DATABASES.get('default', {}).get('ENGINE') == 'django.db.backends.sqlite3':
-        all_points_date = (
-            all_points
-            .annotate(date=TruncDay('workout__start_datetime'))
-            .annotate(tmp_today=TruncDay(Now()))
-            .annotate(tmp_start_date=TruncDay(F('workout__start_datetime')))
-            .annotate(days_ago=ExpressionWrapper((F('tmp_today') - F('tmp_start_date')) / 86_400_000_000, output_field=IntegerField()))
-        )
-    # For Postgres
-    else:
-        all_points_date = (
-            all_points
-            .annotate(date=TruncDay('workout__start_datetime'))
-            .annotate(days_ago_duration=ExpressionWrapper(TruncDay(Now()) - TruncDay(F('workout__start_datetime')), output_field=DurationField()))
-            .annotate(days_ago=ExtractDay(F('days_ago_duration')))
-        )
-    tmp_all = (
-        all_points_date
-        .values('days_ago')
-        .annotate(total=Sum('points_capped'))
-        .values('days_ago', 'total')
-        .order_by('-days_ago')
-    )
-    timeseries_all = {}
-    for i in tmp_all:
-        days_ago = i.pop('days_ago')
-        timeseries_all[days_ago] = i
-
-    tmp_user = (
-        all_points_date
-        .values('days_ago', 'workout__user__id')
-        .annotate(total=Sum('points_capped'))
-        .order_by('-days_ago')
-    )
-    timeseries_user = {}
-    for i in tmp_user:
-        user_id = i.pop('workout__user__id')
-        days_ago = i.pop('days_ago')
-        if user_id not in timeseries_user:
-            timeseries_user[user_id] = {}
-        timeseries_user[user_id][days_ago] = i
-
-    tmp_team = (
-        all_points_date
-        .values('days_ago', 'workout__user__my_teams')
+        all_points = all_points.filter(day__gte=monday_before, day__lte=last_sunday)
+
+    # one row per (day, user, team of this competition) - pivoted into the timeseries and leaderboards below
+    points_lst = (
+        all_points
+        .annotate(competition_team=FilteredRelation('user__my_teams', condition=Q(user__my_teams__competition=competition)))
+        .values('day', 'user', 'competition_team')
         .annotate(total=Sum('points_capped'))
-        .order_by('-days_ago')
+        .order_by('day', 'user', 'competition_team')
     )
-    timeseries_team = {}
-    for i in tmp_team:
-        team_id = i.pop('workout__user__my_teams')
-        days_ago = i.pop('days_ago')
-        if team_id not in timeseries_team:
-            timeseries_team[team_id] = {}
-        timeseries_team[team_id][days_ago] = i
+
+    # days ago of the local day of the points
+    today = timezone.localdate()
+
+    timeseries_all, timeseries_user, timeseries_team = {}, {}, {}
+    user_totals, team_totals = {}, {}
+    user_days = set()
+    for i in points_lst:
+        days_ago = (today - i['day']).days
+        # users in several teams have one row per team
+        if (i['user'], i['day']) not in user_days:
+            user_days.add((i['user'], i['day']))
+            timeseries_all.setdefault(days_ago, {'total': 0})['total'] += i['total']
+            timeseries_user.setdefault(i['user'], {})[days_ago] = {'total': i['total']}
+            user_totals[i['user']] = user_totals.get(i['user'], 0) + i['total']
+        timeseries_team.setdefault(i['competition_team'], {}).setdefault(days_ago, {'total': 0})['total'] += i['total']
+        if i['competition_team'] is not None:
+            team_totals[i['competition_team']] = team_totals.get(i['competition_team'], 0) + i['total']
 
     # Get user data
     user_dict = {i['id']: i for i in CustomUser.objects.filter(my_competitions=competition).values('id', 'username', 'strava_allow_follow', 'strava_athlete_id').order_by('username', 'id')}
@@ -112,44 +113,33 @@ def get_competition_stats(competition, last_seven_days=False):
             value['strava_athlete_id'] = None
 
     # Get user rankings
-    leaderboard_user = (
-        all_points
-        .values('workout__user__id')
-        .annotate(total_capped=Sum('points_capped'))
-        .order_by('-total_capped')
-    )
+    leaderboard_user = [{'workout__user__id': user_id, 'total_capped': total} for user_id, total in user_totals.items()]
     leaderboard_user = _add_rank(leaderboard_user, key="total_capped", enhance_dict=user_dict, id_field='workout__user__id')
     leaderboard_user_dict = {i['id']: i for i in leaderboard_user}
 
     # Get team data
-    team_dict = {i.id: {'id': i.id, 'name': i.name, 'members': [leaderboard_user_dict.get(i.id, {'id': i.id, 'username': 'ERROR', 'total_capped': None}) for i in i.user.all()]} for i in Team.objects.filter(competition=competition).prefetch_related('user')}
+    team_dict = {i.id: {'id': i.id, 'name': i.name, 'members': [leaderboard_user_dict.get(i.id, {'id': i.id, 'username': 'ERROR', 'total_capped': None}) for i in i.user.all()]} for i in competition_obj.team_set.all()}
     for key, value in team_dict.items():
         value['active_member_count'] = sum(1 for i in value.get('members', []) if i.get('total_capped', 0) is not None and i.get('total_capped', 0) > 0)
         value['member_count'] = len(value.get('members', []))
 
     # Get team rankings
-    leaderboard_team = (
-        all_points
-        .values('workout__user__my_teams__id')
-        .annotate(total_capped=Sum('points_capped'))
-        .order_by('-total_capped')
-    )
-    leaderboard_team = [{**i, 'total_capped': i['total_capped'] / max(1, team_dict[i['workout__user__my_teams__id']]['active_member_count'])} for i in leaderboard_team if i['workout__user__my_teams__id'] in team_dict]
+    leaderboard_team = [{'workout__user__my_teams__id': team_id, 'total_capped': total / max(1, team_dict[team_id]['active_member_count'])} for team_id, total in team_totals.items()]
     leaderboard_team = _add_rank(leaderboard_team, key="total_capped", enhance_dict=team_dict, id_field='workout__user__my_teams__id')
     team_dict = {i['id']: i for i in leaderboard_team}
 
     competition_details = {
         'name': competition_obj.name,
-        'owner': user_dict.get(competition_obj.owner.pk, {'id': competition_obj.owner.pk, 'username': 'ERROR', 'total_capped': None}),
-        'members': [user_dict.get(i, {'id': i, 'username': 'ERROR', 'total_capped': None}) for i in list(competition_obj.user.all().values_list('pk', flat=True))],
-        'member_count': competition_obj.user.all().count(),
+        'owner': user_dict.get(competition_obj.owner_id, {'id': competition_obj.owner_id, 'username': 'ERROR', 'total_capped': None}),
+        'members': list(user_dict.values()),
+        'member_count': len(user_dict),
         'active_member_count': len(timeseries_user),
         'start_date': competition_obj.start_date,
         'start_date_count': (datetime.date.today() - competition_obj.start_date).days,
         'end_date': competition_obj.end_date,
         'end_date_count': (datetime.date.today() - competition_obj.end_date).days,
         'has_teams': competition_obj.has_teams,
-        'goals': competition_obj.activitygoal_set.all().values(),
+        'goals': [{field.attname: getattr(goal, field.attname) for field in goal._meta.concrete_fields} for goal in competition_obj.activitygoal_set.all()],
     }
 
     response_obj = {
@@ -167,3 +157,109 @@ def get_competition_stats(competition, last_seven_days=False):
         }
     }
     return response_obj
+
+
+def _leaderboard_slice(leaderboard, competition, kind, member_id, limit, offset, around_me):
+    """ ranked entries at offset - or centered on member_id when around_me (the top if it has no rank) """
+    if around_me and member_id is not None:
+        position = leaderboard.position(competition, member_id, kind=kind)
+        if position is not None:
+            offset = max(position - limit // 2, 0)
+    return leaderboard.page(competition, offset, limit, kind=kind), offset
+
+
+def get_competition_stats_page(competition, user, limit, offset=0, around_me=False):
+    """ get_competition_stats limited to a slice of the user and team leaderboards - ranked with window functions so only the slice is loaded """
+    CustomUser = apps.get_model('custom_user', 'CustomUser')
+    Competition = apps.get_model('competition', 'Competition')
+    DailyPoints = apps.get_model('competition', 'DailyPoints')
+
+    try:
+        competition_obj = Competition.objects.prefetch_related('activitygoal_set').get(id=competition)
+    except Competition.DoesNotExist:
+        return Response({"detail": "Competition not found."}, status=status.HTTP_404_NOT_FOUND)
+    leaderboard = get_leaderboard()
+
+    # slices of both leaderboards
+    my_team = user.my_teams.filter(competition=competition).values_list('pk', flat=True).first() if around_me else None
+    user_slice, user_offset = _leaderboard_slice(leaderboard, competition, 'user', user.pk, limit, offset, around_me)
+    team_slice, team_offset = _leaderboard_slice(leaderboard, competition, 'team', my_team, limit, offset, around_me)
+
+    # members of the teams of the slice with their own rank
+    team_dict = {i['id']: {**i, 'members': []} for i in competition_obj.team_set.filter(pk__in=[i['id'] for i in team_slice]).values('id', 'name')}
+    memberships = list(CustomUser.my_teams.through.objects.filter(team__in=team_dict.keys()).values_list('team', 'customuser'))
+    member_ranks = {i['id']: i for i in leaderboard.ranks(competition, {user_id for _, user_id in memberships} - {i['id'] for i in user_slice})}
+    member_ranks.update({i['id']: {'points': i['points'], 'rank': i['rank']} for i in user_slice})
+
+    # user data of everybody in the slices
+    user_dict = {i['id']: i for i in CustomUser.objects.filter(Q(pk__in=[i['id'] for i in user_slice] + [i for _, i in memberships]) | Q(pk=competition_obj.owner_id)).values('id', 'username', 'strava_allow_follow', 'strava_athlete_id')}
+    for key, value in user_dict.items():
+        if value['strava_allow_follow'] is False:
+            value['strava_athlete_id'] = None
+        value['rank'] = member_ranks.get(key, {}).get('rank')
+        value['points'] = member_ranks.get(key, {}).get('points')
+
+    leaderboard_user = [{'workout__user__id': i['id'], 'total_capped': i['points'], **user_dict[i['id']]} for i in user_slice]
+    for team_id, user_id in memberships:
+        team_dict[team_id]['members'].append({**user_dict[user_id], 'total_capped': user_dict[user_id]['points']})
+    for i in team_slice:
+        members = team_dict[i['id']]['members']
+        team_dict[i['id']].update({
+            'rank': i['rank'],
+            'points': i['points'],
+            'member_count': len(members),
+            'active_member_count': sum(1 for member in members if member['total_capped'] is not None and member['total_capped'] > 0),
+        })
+    leaderboard_team = [{'workout__user__my_teams__id': i['id'], 'total_capped': i['points'], **team_dict[i['id']]} for i in team_slice]
+
+    # timeseries of the whole competition and of the slices only
+    today = timezone.localdate()
+    all_points = DailyPoints.objects.filter(competition=competition)
+    timeseries_all, timeseries_user, timeseries_team = {}, {}, {}
+    for i in all_points.values('day').annotate(total=Sum('points_capped')).order_by('day'):
+        timeseries_all[(today - i['day']).days] = {'total': i['total']}
+    for i in all_points.filter(user__in=[i['id'] for i in user_slice]).values('day', 'user').annotate(total=Sum('points_capped')).order_by('day', 'user'):
+        timeseries_user.setdefault(i['user'], {})[(today - i['day']).days] = {'total': i['total']}
+    team_points = (
+        all_points
+        .annotate(competition_team=FilteredRelation('user__my_teams', condition=Q(user__my_teams__competition=competition)))
+        .filter(competition_team__in=team_dict.keys())
+        .values('day', 'competition_team')
+        .annotate(total=Sum('points_capped'))
+        .order_by('day', 'competition_team')
+    )
+    for i in team_points:
+        timeseries_team.setdefault(i['competition_team'], {})[(today - i['day']).days] = {'total': i['total']}
+
+    competition_details = {
+        'name': competition_obj.name,
+        'owner': user_dict[competition_obj.owner_id],
+        'member_count': competition_obj.user.count(),
+        'active_member_count': leaderboard.count(competition, kind='user'),
+        'start_date': competition_obj.start_date,
+        'start_date_count': (datetime.date.today() - competition_obj.start_date).days,
+        'end_date': competition_obj.end_date,
+        'end_date_count': (datetime.date.today() - competition_obj.end_date).days,
+        'has_teams': competition_obj.has_teams,
+        'goals': [{field.attname: getattr(goal, field.attname) for field in goal._meta.concrete_fields} for goal in competition_obj.activitygoal_set.all()],
+    }
+
+    return {
+        'competition': competition_details,
+        'users': {i['id']: user_dict[i['id']] for i in user_slice},
+        'teams': {i['id']: team_dict[i['id']] for i in team_slice},
+        'timeseries': {
+            'all': timeseries_all,
+            'user': timeseries_user,
+            'team': timeseries_team,
+        },
+        'leaderboard': {
+            'team': leaderboard_team,
+            'individual': leaderboard_user,
+            'team_count': leaderboard.count(competition, kind='team'),
+            'individual_count': competition_details['active_member_count'],
+            'team_offset': team_offset,
+            'individual_offset': user_offset,
+            'limit': limit,
+        }
+    }
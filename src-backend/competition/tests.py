@@ -1,3 +1,675 @@
-from django.test import TestCase
+import datetime
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
+
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models import Sum
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from custom_user.models import CustomUser, RecalcRequest
+from custom_user.point_recalc import recalc_user_goal_points
+from custom_user.tests import RecalcTestCase
+from workouts.models import Workout, bulk_create_workouts
+from .models import Competition, ActivityGoal, Award, Points, DailyPoints, Team, FeedEntry
+from .stats import get_competition_stats, get_cached_competition_stats, get_competition_stats_page
+from .scorer import _calculate_points_raw, _points_raw_expression
+from .side_effects import pending_side_effects, side_effects_atomic
+from .leaderboard import DatabaseLeaderboard, RedisLeaderboard
+from .feed import get_feed, decode_cursor
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
 # Create your tests here.
+class CreatePointsTest(RecalcTestCase):
+    def setUp(self):
+        super().setUp()
+        self.members = [self.user]
+        for i in range(5):
+            member = CustomUser.objects.create_user(email=f'member{i}@test.local', password='password', first_name=f'Member{i}')
+            member.my_competitions.add(self.competition)
+            self.members.append(member)
+        for member in self.members:
+            self.add_workouts(10, user=member)
+        RecalcRequest.objects.all().delete()
+
+    def test_new_goal_points(self):
+        with self.assertNumQueries(9), self.captureOnCommitCallbacks(execute=True):
+            goal = ActivityGoal.objects.create(competition=self.competition, name='Burn', metric='kj', goal=5_000, period='week')
+        self.assertEqual(Points.objects.filter(goal=goal).count(), 60)
+        self.assertEqual(RecalcRequest.objects.filter(goal=goal).count(), len(self.members))
+
+        # already existing points are not created twice
+        goal.count_steps_as_walks = False
+        goal.save()
+        goal.count_steps_as_walks = True
+        goal.save()
+        self.assertEqual(Points.objects.filter(goal=goal).count(), 60)
+
+    def test_join_competition_points(self):
+        member = CustomUser.objects.create_user(email='late@test.local', password='password', first_name='Late')
+        self.add_workouts(10, user=member)
+        with self.captureOnCommitCallbacks(execute=True):
+            member.my_competitions.add(self.competition)
+        self.assertEqual(Points.objects.filter(workout__user=member).count(), 10 * len(self.goals))
+        self.assertEqual(RecalcRequest.objects.filter(user=member).count(), len(self.goals))
+
+    def test_recalc_requests_after_commit(self):
+        # requests of a transaction that is rolled back don't reach the queue
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            try:
+                with transaction.atomic():
+                    ActivityGoal.objects.create(competition=self.competition, name='Burn', metric='kj', goal=5_000, period='week')
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(len(callbacks), 0)
+        self.assertFalse(RecalcRequest.objects.exists())
+
+
+class PointsRawExpressionTest(RecalcTestCase):
+    def setUp(self):
+        super().setUp()
+        for metric, goal in (('num', 3), ('km', 20), ('kj', 7_500)):
+            ActivityGoal.objects.create(competition=self.competition, name=metric, metric=metric, goal=goal, period='week')
+        self.goals = list(self.competition.activitygoal_set.order_by('id'))
+
+        start_datetime = timezone.make_aware(datetime.datetime(2024, 1, 1, 7, 0))
+        with self.captureOnCommitCallbacks(execute=True):
+            for i, sport_type in enumerate(['Run', 'Ride', 'Swim', 'Yoga', 'Walk', 'Workout']):
+                Workout(user=self.user, sport_type=sport_type, intensity_category=1 + i % 3, start_datetime=start_datetime + datetime.timedelta(hours=9 * i), duration=datetime.timedelta(minutes=17 + 11 * i, seconds=7 * i)).save()
+        # workouts without kcal / distance
+        Workout.objects.filter(sport_type='Yoga').update(kcal=None, distance=None)
+
+    def assert_points_raw_match(self):
+        for points in Points.objects.filter(goal__isnull=False).select_related('goal', 'workout__user'):
+            self.assertAlmostEqual(float(points.points_raw), _calculate_points_raw(goal=points.goal, workout=points.workout, user=points.workout.user), delta=0.006)
+
+    def test_expression_parity(self):
+        self.assertEqual({goal.metric for goal in self.goals}, {'min', 'num', 'kcal', 'km', 'kj'})
+        for goal in self.goals:
+            for points in Points.objects.filter(goal=goal).select_related('goal', 'workout__user').annotate(points_raw_sql=_points_raw_expression(goal.metric)):
+                self.assertAlmostEqual(points.points_raw_sql, _calculate_points_raw(goal=goal, workout=points.workout, user=self.user), places=6)
+
+    def test_scaling_change_update(self):
+        RecalcRequest.objects.all().delete()
+        self.user.scaling_kcal = Decimal('1.3')
+        self.user.scaling_distance = Decimal('0.7')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assert_points_raw_match()
+        self.assertEqual(set(RecalcRequest.objects.values_list('goal', flat=True)), {goal.pk for goal in self.goals if goal.metric in ('kcal', 'km', 'kj')})
+
+    def test_goal_change_update(self):
+        for goal in self.goals:
+            goal.goal = goal.goal * 2
+            goal.save()
+        self.assert_points_raw_match()
+
+
+class CompetitionStatsTest(RecalcTestCase):
+    def setUp(self):
+        super().setUp()
+        self.member = CustomUser.objects.create_user(email='member@test.local', password='password', first_name='Member')
+        self.member.my_competitions.add(self.competition)
+        self.team = Team.objects.create(competition=self.competition, name='Team')
+        self.team.user.add(self.user, self.member)
+
+        self.add_workouts(40)
+        self.add_workouts(25, user=self.member)
+        for user in (self.user, self.member):
+            for goal in self.goals:
+                recalc_user_goal_points(user_id=user.pk, goal=goal, start_datetime=self.competition.start_date)
+
+    def user_totals(self):
+        return {i['workout__user']: i['total'] for i in Points.objects.filter(goal__competition=self.competition).values('workout__user').annotate(total=Sum('points_capped'))}
+
+    def test_stats_from_rollup(self):
+        stats = get_competition_stats(self.competition.pk)
+        user_totals = self.user_totals()
+        self.assertEqual({i['workout__user__id']: i['total_capped'] for i in stats['leaderboard']['individual']}, user_totals)
+        self.assertEqual(sum(i['total'] for i in stats['timeseries']['all'].values()), sum(user_totals.values()))
+        self.assertEqual(stats['leaderboard']['team'][0]['total_capped'], sum(user_totals.values()) / 2)
+
+        # the rollup follows later recalcs of a user's goal
+        Points.objects.filter(goal=self.goals[0], workout__user=self.member).update(points_raw=1, points_capped=1)
+        recalc_user_goal_points(user_id=self.member.pk, goal=self.goals[0], start_datetime=self.competition.start_date)
+        stats = get_competition_stats(self.competition.pk)
+        self.assertEqual({i['workout__user__id']: i['total_capped'] for i in stats['leaderboard']['individual']}, self.user_totals())
+
+    def test_rebuild_missing(self):
+        other_competition = Competition.objects.create(owner=self.user, name='Other Competition', start_date=datetime.date(2024, 1, 1), end_date=datetime.date(2024, 3, 31))
+        rows = DailyPoints.objects.filter(competition=self.competition).count()
+        DailyPoints.objects.filter(competition=self.competition, user=self.member).update(points_capped=0)
+
+        # on deploy only competitions without any daily points are filled - the others are left alone
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.my_competitions.add(other_competition)
+        DailyPoints.objects.filter(competition=other_competition).delete()
+        call_command('rebuild_daily_points', '--missing', stdout=StringIO())
+        self.assertTrue(DailyPoints.objects.filter(competition=other_competition).exists())
+        self.assertEqual(DailyPoints.objects.filter(competition=self.competition).count(), rows)
+        self.assertFalse(DailyPoints.objects.filter(competition=self.competition, user=self.member, points_capped__gt=0).exists())
+
+    def test_award_points(self):
+        award = Award.objects.create(competition=self.competition, name='Award', threshold=10, period='day', reward_points=5)
+        workout = Workout.objects.filter(user=self.member).order_by('start_datetime').first()
+        Points.objects.create(award=award, workout=workout, points_raw=5, points_capped=5)
+        user_totals = self.user_totals()
+
+        stats = get_competition_stats(self.competition.pk)
+        self.assertEqual({i['workout__user__id']: i['total_capped'] for i in stats['leaderboard']['individual']}, {**user_totals, self.member.pk: user_totals[self.member.pk] + 5})
+        self.assertEqual(sum(i['total'] for i in stats['timeseries']['all'].values()), sum(user_totals.values()) + 5)
+        self.assertEqual(sum(i['total'] for i in stats['timeseries']['team'][self.team.pk].values()), sum(user_totals.values()) + 5)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            award.delete()
+        stats = get_competition_stats(self.competition.pk)
+        self.assertEqual({i['workout__user__id']: i['total_capped'] for i in stats['leaderboard']['individual']}, user_totals)
+
+    def test_query_count(self):
+        with self.assertNumQueries(6):
+            stats = get_competition_stats(self.competition.pk)
+        self.assertEqual(sum(i['total'] for i in stats['timeseries']['team'][self.team.pk].values()), sum(self.user_totals().values()))
+
+        # independent of the number of members, teams and workouts
+        other_competition = Competition.objects.create(owner=self.user, name='Other Competition', start_date=datetime.date(2024, 1, 1), end_date=datetime.date(2024, 3, 31))
+        Team.objects.create(competition=other_competition, name='Other Team').user.add(self.member)
+        for i in range(5):
+            member = CustomUser.objects.create_user(email=f'member{i}@test.local', password='password', first_name=f'Member{i}')
+            member.my_competitions.add(self.competition)
+            Team.objects.create(competition=self.competition, name=f'Team {i}').user.add(member)
+            self.add_workouts(5, user=member)
+            for goal in self.goals:
+                recalc_user_goal_points(user_id=member.pk, goal=goal, start_datetime=self.competition.start_date)
+        with self.assertNumQueries(6):
+            stats = get_competition_stats(self.competition.pk)
+        self.assertEqual(stats['competition']['member_count'], 7)
+        self.assertEqual(len(stats['leaderboard']['team']), 6)
+        self.assertEqual(sum(i['total'] for i in stats['timeseries']['all'].values()), sum(self.user_totals().values()))
+
+    def test_paged_stats(self):
+        for i in range(6):
+            member = CustomUser.objects.create_user(email=f'member{i}@test.local', password='password', first_name=f'Member{i}')
+            member.my_competitions.add(self.competition)
+            Team.objects.create(competition=self.competition, name=f'Team {i}').user.add(member)
+            self.add_workouts(2 + 3 * i, user=member)
+            for goal in self.goals:
+                recalc_user_goal_points(user_id=member.pk, goal=goal, start_datetime=self.competition.start_date)
+        stats = get_competition_stats(self.competition.pk)
+        ranking = [(i['workout__user__id'], i['rank']) for i in stats['leaderboard']['individual'] if i['rank'] is not None]
+        team_ranking = [(i['workout__user__my_teams__id'], i['rank']) for i in stats['leaderboard']['team'] if i['rank'] is not None]
+
+        with self.assertNumQueries(14):
+            page = page_offset = get_competition_stats_page(self.competition.pk, self.user, limit=3, offset=2)
+        self.assertEqual([(i['workout__user__id'], i['rank']) for i in page['leaderboard']['individual']], ranking[2:5])
+        self.assertEqual([(i['workout__user__my_teams__id'], i['rank']) for i in page['leaderboard']['team']], team_ranking[2:5])
+        self.assertEqual(page['leaderboard']['individual_count'], len(ranking))
+        self.assertEqual(set(page['users'].keys()), {i for i, _ in ranking[2:5]})
+        self.assertEqual(page['timeseries']['all'], stats['timeseries']['all'])
+        for user_id, _ in ranking[2:5]:
+            self.assertEqual(page['timeseries']['user'][user_id], stats['timeseries']['user'][user_id])
+        for team_id, _ in team_ranking[2:5]:
+            self.assertEqual(page['teams'][team_id]['active_member_count'], stats['teams'][team_id]['active_member_count'])
+            self.assertEqual({i['id']: i['rank'] for i in page['teams'][team_id]['members']}, {i['id']: i['rank'] for i in stats['teams'][team_id]['members']})
+
+        # around=me centers the slice on the requesting user
+        last = CustomUser.objects.get(pk=ranking[-1][0])
+        page = get_competition_stats_page(self.competition.pk, last, limit=3, around_me=True)
+        self.assertEqual([i['workout__user__id'] for i in page['leaderboard']['individual']], [i for i, _ in ranking[-2:]])
+
+        client = APIClient()
+        client.force_authenticate(self.member)
+        response = client.get(f'/api/stats/{self.competition.pk}/', {'limit': 2, 'around': 'me'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(self.member.pk, [i['workout__user__id'] for i in response.data['leaderboard']['individual']])
+        self.assertEqual(client.get(f'/api/stats/{self.competition.pk}/', {'limit': 'all'}).status_code, 400)
+
+        # the slices come from the configured leaderboard backend
+        if fakeredis is not None:
+            leaderboard = RedisLeaderboard(connection=fakeredis.FakeRedis())
+            leaderboard.rebuild(self.competition.pk)
+            with mock.patch('competition.stats.get_leaderboard', return_value=leaderboard):
+                redis_page = get_competition_stats_page(self.competition.pk, self.user, limit=3, offset=2)
+                # ties are ordered by id in the database and by reversed id in Redis
+                self.assertEqual(sorted((i['rank'], i['total_capped']) for i in redis_page['leaderboard']['individual']), [(i['rank'], i['total_capped']) for i in page_offset['leaderboard']['individual']])
+                self.assertEqual(redis_page['leaderboard']['team_count'], page_offset['leaderboard']['team_count'])
+                for team_id, team in redis_page['teams'].items():
+                    self.assertEqual({i['id']: i['rank'] for i in team['members']}, {i['id']: i['rank'] for i in stats['teams'][team_id]['members']})
+                redis_page = get_competition_stats_page(self.competition.pk, last, limit=3, around_me=True)
+                self.assertEqual([i['workout__user__id'] for i in redis_page['leaderboard']['individual']], [i for i, _ in ranking[-2:]])
+
+    def test_leave_competition(self):
+        self.member.my_competitions.remove(self.competition)
+        self.assertFalse(DailyPoints.objects.filter(user=self.member).exists())
+        self.assertTrue(DailyPoints.objects.filter(user=self.user).exists())
+
+    def test_versioned_cache(self):
+        stats = get_cached_competition_stats(self.competition.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cached_competition_stats(self.competition.pk), stats)
+
+        # recalcs and membership changes invalidate the cached stats of all members
+        with self.captureOnCommitCallbacks(execute=True):
+            Points.objects.filter(goal=self.goals[0], workout__user=self.member).update(points_raw=1, points_capped=1)
+            recalc_user_goal_points(user_id=self.member.pk, goal=self.goals[0], start_datetime=self.competition.start_date)
+        stats = get_cached_competition_stats(self.competition.pk)
+        self.assertEqual({i['workout__user__id']: i['total_capped'] for i in stats['leaderboard']['individual']}, self.user_totals())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.team.user.remove(self.member)
+        self.assertEqual(get_cached_competition_stats(self.competition.pk)['teams'][self.team.pk]['member_count'], 1)
+
+
+class LeaderboardTest(RecalcTestCase):
+    def setUp(self):
+        super().setUp()
+        self.member = CustomUser.objects.create_user(email='member@test.local', password='password', first_name='Member')
+        self.other = CustomUser.objects.create_user(email='other@test.local', password='password', first_name='Other')
+        for user in (self.member, self.other):
+            user.my_competitions.add(self.competition)
+        self.team = Team.objects.create(competition=self.competition, name='Team')
+        self.team.user.add(self.user, self.member)
+        Team.objects.create(competition=self.competition, name='Other Team').user.add(self.other)
+
+        self.add_workouts(40)
+        self.add_workouts(25, user=self.member)
+        self.add_workouts(10, user=self.other)
+        self.recalc()
+
+    def recalc(self, users=None):
+        for user in users or (self.user, self.member, self.other):
+            for goal in self.goals:
+                recalc_user_goal_points(user_id=user.pk, goal=goal, start_datetime=self.competition.start_date)
+
+    def stats_ranking(self, kind):
+        stats = get_competition_stats(self.competition.pk)
+        if kind == 'user':
+            return [{'id': i['workout__user__id'], 'points': round(float(i['total_capped']), 2), 'rank': i['rank']} for i in stats['leaderboard']['individual'] if i['rank'] is not None]
+        return [{'id': i['workout__user__my_teams__id'], 'points': round(float(i['total_capped']), 2), 'rank': i['rank']} for i in stats['leaderboard']['team'] if i['rank'] is not None]
+
+    def assertRankingEqual(self, entries, ranking):
+        """ team points per member are rounded from cents by Redis and from decimals by the stats """
+        self.assertEqual([(i['id'], i['rank']) for i in entries], [(i['id'], i['rank']) for i in ranking])
+        for entry, expected in zip(entries, ranking):
+            self.assertAlmostEqual(entry['points'], expected['points'], delta=0.011)
+
+    def test_database_leaderboard(self):
+        leaderboard = DatabaseLeaderboard()
+        for kind in ('user', 'team'):
+            ranking = self.stats_ranking(kind)
+            self.assertRankingEqual(leaderboard.top(self.competition.pk, 10, kind=kind), ranking)
+            self.assertRankingEqual(leaderboard.top(self.competition.pk, 1, kind=kind), ranking[:1])
+            self.assertRankingEqual([leaderboard.rank(self.competition.pk, ranking[-1]['id'], kind=kind)], [ranking[-1]])
+            self.assertRankingEqual(leaderboard.around(self.competition.pk, ranking[-1]['id'], 1, kind=kind), ranking[-2:])
+        self.assertIsNone(leaderboard.rank(self.competition.pk, 0))
+        self.assertEqual(leaderboard.around(self.competition.pk, 0, 1), [])
+
+    def test_leaderboard_view(self):
+        client = APIClient()
+        client.force_authenticate(self.other)
+        response = client.get(f'/api/leaderboard/{self.competition.pk}/', {'kind': 'team', 'top': 1, 'around': 1})
+        self.assertEqual(response.status_code, 200)
+        ranking = self.stats_ranking('team')
+        self.assertRankingEqual(response.data['top'], ranking[:1])
+        self.assertEqual(response.data['me']['id'], self.other.my_teams.get().pk)
+        self.assertEqual(client.get(f'/api/leaderboard/{self.competition.pk}/', {'kind': 'goal'}).status_code, 400)
+
+        client.force_authenticate(CustomUser.objects.create_user(email='outsider@test.local', password='password', first_name='Outsider'))
+        self.assertEqual(client.get(f'/api/leaderboard/{self.competition.pk}/').status_code, 403)
+
+    @skipUnless(fakeredis, 'fakeredis[lua] is not installed')
+    def test_redis_leaderboard(self):
+        leaderboard = RedisLeaderboard(connection=fakeredis.FakeRedis())
+        for module in ('custom_user.point_recalc', 'custom_user.models', 'competition.scorer', 'competition.models'):
+            patcher = mock.patch(f'{module}.get_leaderboard', return_value=leaderboard)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        leaderboard.rebuild(self.competition.pk)
+        for kind in ('user', 'team'):
+            self.assertRankingEqual(leaderboard.top(self.competition.pk, 10, kind=kind), self.stats_ranking(kind))
+
+        # recalcs are applied as deltas
+        with self.captureOnCommitCallbacks(execute=True):
+            Points.objects.filter(goal=self.goals[0], workout__user=self.member).update(points_raw=1, points_capped=1)
+            self.add_workouts(30, user=self.other)
+            self.recalc(users=(self.member, self.other))
+        for kind in ('user', 'team'):
+            ranking = self.stats_ranking(kind)
+            self.assertRankingEqual(leaderboard.top(self.competition.pk, 10, kind=kind), ranking)
+            self.assertRankingEqual([leaderboard.rank(self.competition.pk, ranking[-1]['id'], kind=kind)], [ranking[-1]])
+            self.assertRankingEqual(leaderboard.around(self.competition.pk, ranking[0]['id'], 1, kind=kind), ranking[:2])
+        deltas_top = leaderboard.top(self.competition.pk, 10)
+
+        # ... and match a full rebuild
+        leaderboard.rebuild(self.competition.pk)
+        self.assertRankingEqual(leaderboard.top(self.competition.pk, 10), deltas_top)
+
+        # membership changes rebuild the leaderboard
+        with self.captureOnCommitCallbacks(execute=True):
+            self.team.user.remove(self.member)
+            self.member.my_competitions.remove(self.competition)
+        self.assertIsNone(leaderboard.rank(self.competition.pk, self.member.pk))
+        self.assertRankingEqual(leaderboard.top(self.competition.pk, 10, kind='team'), self.stats_ranking('team'))
+
+    @skipUnless(fakeredis, 'fakeredis[lua] is not installed')
+    def test_award_points(self):
+        leaderboard = RedisLeaderboard(connection=fakeredis.FakeRedis())
+        for module in ('custom_user.point_recalc', 'custom_user.models', 'competition.scorer', 'competition.models'):
+            patcher = mock.patch(f'{module}.get_leaderboard', return_value=leaderboard)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        leaderboard.rebuild(self.competition.pk)
+
+        # award points are applied as deltas, are part of a full rebuild and of the database leaderboard
+        award = Award.objects.create(competition=self.competition, name='Award', threshold=10, period='day', reward_points=500)
+        with self.captureOnCommitCallbacks(execute=True):
+            Points.objects.create(award=award, workout=Workout.objects.filter(user=self.other).first(), points_raw=500, points_capped=500)
+        ranking = self.stats_ranking('user')
+        self.assertEqual(ranking[0]['id'], self.other.pk)
+        self.assertRankingEqual(leaderboard.top(self.competition.pk, 10), ranking)
+        self.assertRankingEqual(DatabaseLeaderboard().top(self.competition.pk, 10), ranking)
+        leaderboard.rebuild(self.competition.pk)
+        self.assertRankingEqual(leaderboard.top(self.competition.pk, 10), ranking)
+
+
+class FeedTest(RecalcTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_workouts(12)
+        self.workouts = list(Workout.objects.order_by('-start_datetime', '-pk'))
+
+    def test_keyset_pages(self):
+        with self.assertNumQueries(1):
+            page = get_feed(self.competition.pk, limit=5)
+        self.assertEqual([i['workout'] for i in page['results']], [i.pk for i in self.workouts[:5]])
+        self.assertAlmostEqual(page['results'][0]['points_raw'], float(sum(i.points_raw for i in Points.objects.filter(workout=self.workouts[0]))), delta=0.006)
+
+        seen = [i['workout'] for i in page['results']]
+        while page['next'] is not None:
+            page = get_feed(self.competition.pk, limit=5, cursor=page['next'])
+            seen.extend(i['workout'] for i in page['results'])
+        self.assertEqual(seen, [i.pk for i in self.workouts])
+
+        # workouts outside of the competition are not part of the feed
+        with self.captureOnCommitCallbacks(execute=True):
+            Workout(user=self.user, sport_type='Run', intensity_category=2, start_datetime=timezone.make_aware(datetime.datetime(2025, 1, 1, 7, 0)), duration=datetime.timedelta(minutes=20)).save()
+        self.assertEqual(get_feed(self.competition.pk, limit=1)['results'][0]['workout'], self.workouts[0].pk)
+
+    def test_since(self):
+        latest = get_feed(self.competition.pk, limit=5)['latest']
+        self.assertEqual(get_feed(self.competition.pk, since=latest), {'results': [], 'next': None, 'latest': latest, 'has_newer': False})
+
+        start_datetime, _ = decode_cursor(latest)
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(3):
+                Workout(user=self.user, sport_type='Run', intensity_category=2, start_datetime=start_datetime + datetime.timedelta(hours=i + 1), duration=datetime.timedelta(minutes=20)).save()
+        newer = list(Workout.objects.filter(start_datetime__gt=start_datetime).order_by('-start_datetime').values_list('pk', flat=True))
+
+        page = get_feed(self.competition.pk, limit=2, since=latest)
+        self.assertEqual([i['workout'] for i in page['results']], newer[1:])
+        self.assertTrue(page['has_newer'])
+        page = get_feed(self.competition.pk, limit=2, since=page['latest'])
+        self.assertEqual([i['workout'] for i in page['results']], newer[:1])
+        self.assertFalse(page['has_newer'])
+
+    def test_timeline_follows_points(self):
+        # capped points of a recalc
+        recalc_user_goal_points(user_id=self.user.pk, goal=self.goals[0], start_datetime=self.competition.start_date)
+        entry = get_feed(self.competition.pk, limit=1)['results'][0]
+        self.assertAlmostEqual(entry['points_capped'], float(Points.objects.filter(workout=entry['workout']).aggregate(total=Sum('points_capped'))['total']), delta=0.006)
+
+        # workout and profile changes
+        workout = self.workouts[0]
+        workout.duration = datetime.timedelta(minutes=90)
+        with self.captureOnCommitCallbacks(execute=True):
+            workout.save()
+        self.user.username = 'renamed'
+        self.user.save()
+        entry = get_feed(self.competition.pk, limit=1)['results'][0]
+        self.assertEqual((entry['workout__duration'], entry['workout__user__username']), (str(90 * 60.0), 'renamed'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            workout.delete()
+        self.assertEqual(get_feed(self.competition.pk, limit=1)['results'][0]['workout'], self.workouts[1].pk)
+        self.user.my_competitions.remove(self.competition)
+        self.assertEqual(get_feed(self.competition.pk)['results'], [])
+
+    @override_settings(FEED_TIMELINE_LENGTH=5)
+    def test_trim(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Workout(user=self.user, sport_type='Run', intensity_category=2, start_datetime=self.workouts[0].start_datetime + datetime.timedelta(hours=1), duration=datetime.timedelta(minutes=20)).save()
+        self.assertEqual(FeedEntry.objects.filter(competition=self.competition).count(), 5)
+        self.assertEqual(get_feed(self.competition.pk)['results'][-1]['workout'], self.workouts[3].pk)
+
+        # rebuilding keeps the newest entries only
+        FeedEntry.objects.all().delete()
+        call_command('rebuild_feed', stdout=StringIO())
+        self.assertEqual([i['workout'] for i in get_feed(self.competition.pk)['results']], list(FeedEntry.objects.order_by('-start_datetime', '-workout').values_list('workout', flat=True)))
+        self.assertEqual(FeedEntry.objects.count(), 5)
+
+        # on deploy only competitions without any feed entries are filled
+        FeedEntry.objects.order_by('start_datetime').first().delete()
+        call_command('rebuild_feed', '--missing', stdout=StringIO())
+        self.assertEqual(FeedEntry.objects.count(), 4)
+        FeedEntry.objects.all().delete()
+        call_command('rebuild_feed', '--missing', stdout=StringIO())
+        self.assertEqual(FeedEntry.objects.count(), 5)
+
+    def test_view(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get(f'/api/feed/{self.competition.pk}/', {'limit': 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 3)
+        self.assertEqual(client.get(f'/api/feed/{self.competition.pk}/', {'cursor': 'invalid'}).status_code, 400)
+
+
+class ListPaginationTest(RecalcTestCase):
+    def setUp(self):
+        super().setUp()
+        self.member = CustomUser.objects.create_user(email='member@test.local', password='password', first_name='Member')
+        self.member.my_competitions.add(self.competition)
+        self.add_workouts(12)
+        self.add_workouts(3, user=self.member)
+        self.client = APIClient()
+        self.client.force_authenticate(self.member)
+
+    def fetch_all(self, url, params):
+        ids, response = [], self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            ids.extend(i['id'] for i in response.data['results'])
+            if response.data['next'] is None:
+                return ids
+            response = self.client.get(response.data['next'])
+
+    def test_points(self):
+        # points of all members of the competition - without duplicates of the member join
+        points = list(Points.objects.filter(goal__competition=self.competition).order_by('-workout__start_datetime', '-workout', '-id').values_list('pk', flat=True))
+        self.assertEqual([i['id'] for i in self.client.get('/api/point/').data], points)
+        self.assertEqual(self.fetch_all('/api/point/', {'page_size': 7}), points)
+
+        start = timezone.make_aware(datetime.datetime(2024, 1, 2))
+        filtered = Points.objects.filter(goal__competition=self.competition, workout__start_datetime__gte=start).order_by('-workout__start_datetime', '-workout', '-id')
+        self.assertEqual(self.fetch_all('/api/point/', {'page_size': 2, 'start_datetime__gte': start.isoformat(), 'competition': self.competition.pk}), list(filtered.values_list('pk', flat=True)))
+        self.assertEqual(self.client.get('/api/point/', {'sport_type': 'Ride'}).data, [])
+
+        # points stored before the denormalized start_datetime are filled on deploy
+        Points.objects.filter(pk__in=points[::2]).update(start_datetime=None)
+        call_command('rebuild_points_start_datetime', stdout=StringIO())
+        self.assertEqual(self.fetch_all('/api/point/', {'page_size': 7}), points)
+
+    def test_points_follow_moved_workout(self):
+        self.assertFalse(Points.objects.filter(start_datetime__isnull=True).exists())
+        workout = Workout.objects.filter(user=self.user).order_by('start_datetime').first()
+        with self.captureOnCommitCallbacks(execute=True):
+            workout.start_datetime = timezone.make_aware(datetime.datetime(2024, 3, 1, 7, 0))
+            workout.save()
+        self.assertEqual(set(Points.objects.filter(workout=workout).values_list('start_datetime', flat=True)), {workout.start_datetime})
+        first_page = self.client.get('/api/point/', {'page_size': len(self.goals)}).data['results']
+        self.assertEqual({i['workout'] for i in first_page}, {workout.pk})
+
+    def test_workouts(self):
+        self.client.force_authenticate(self.user)
+        workouts = list(Workout.objects.filter(user=self.user).order_by('-start_datetime', '-id').values_list('pk', flat=True))
+        self.assertEqual(self.fetch_all('/api/workout/', {'page_size': 5}), workouts)
+
+        start = timezone.make_aware(datetime.datetime(2024, 1, 3))
+        self.assertEqual(self.fetch_all('/api/workout/', {'page_size': 5, 'start_datetime__gte': start.isoformat(), 'sport_type': 'Run', 'competition': self.competition.pk}), list(Workout.objects.filter(user=self.user, start_datetime__gte=start).order_by('-start_datetime', '-id').values_list('pk', flat=True)))
+        self.assertEqual(self.client.get('/api/workout/', {'sport_type__in': 'Ride,Walk'}).data, [])
+
+
+class QueryBudgetTest(RecalcTestCase):
+    """ list endpoints need the same number of queries for 10 and 500 rows """
+
+    def populate(self, n):
+        users = CustomUser.objects.bulk_create([CustomUser(email=f'budget{i}@test.local', username=f'budget{i:03}', first_name='Budget') for i in range(n)])
+        competitions = Competition.objects.bulk_create([Competition(owner=users[i], name=f'Budget {i}', join_code=f'BUDGET{i:04}', start_date=datetime.date(2024, 1, 1), end_date=datetime.date(2024, 3, 31)) for i in range(n)])
+        teams = Team.objects.bulk_create([Team(competition=self.competition, name=f'Budget {i}') for i in range(n)])
+        CustomUser.my_competitions.through.objects.bulk_create(
+            [CustomUser.my_competitions.through(customuser=self.user, competition=i) for i in competitions]
+            + [CustomUser.my_competitions.through(customuser=i, competition=self.competition) for i in users]
+            + [CustomUser.my_competitions.through(customuser=i, competition=j) for i, j in zip(users, competitions)]
+        )
+        CustomUser.my_teams.through.objects.bulk_create([CustomUser.my_teams.through(customuser=i, team=j) for i, j in zip(users, teams)] + [CustomUser.my_teams.through(customuser=self.user, team=teams[0])])
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # url -> (queries, rows)
+        budgets = {'/api/competition/': (2, n + 1), '/api/team/': (2, n), '/api/user/': (3, n + 1)}
+        for url, (budget, rows) in budgets.items():
+            with self.subTest(url=url, rows=n), self.assertNumQueries(budget):
+                response = self.client.get(url)
+            self.assertEqual(len(response.data), rows)
+
+    def test_10_rows(self):
+        self.populate(10)
+        competition = self.client.get(f'/api/competition/{self.competition.pk}/').data
+        self.assertEqual([i['username'] for i in competition['user_info']], sorted(i['username'] for i in competition['user_info']))
+        self.assertEqual(sum(1 for i in self.client.get('/api/team/').data if i['my']), 1)
+
+    def test_500_rows(self):
+        self.populate(500)
+
+
+class BulkImportTest(RecalcTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def rows(self, n):
+        start_datetime = datetime.datetime(2024, 1, 1, 7, 0, tzinfo=datetime.timezone.utc)
+        return [{'sport_type': 'Run' if i % 2 else 'Ride', 'start_datetime': (start_datetime + datetime.timedelta(hours=2 * i)).isoformat(), 'duration': str(60 * (20 + i % 40)), 'intensity_category': 1 + i % 3} for i in range(n)]
+
+    def test_json_import(self):
+        with self.assertNumQueries(43), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/workout/bulk/', self.rows(1_000), format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Workout.objects.filter(user=self.user).count(), 1_000)
+        self.assertEqual(Points.objects.filter(goal__competition=self.competition).count(), 1_000 * len(self.goals))
+        self.assertEqual(RecalcRequest.objects.count(), len(self.goals))
+
+        # same defaults as saving the workouts one by one
+        workout = Workout.objects.get(pk=response.data[1]['id'])
+        single = Workout(user=self.user, sport_type=workout.sport_type, start_datetime=workout.start_datetime, duration=workout.duration, intensity_category=workout.intensity_category)
+        single.set_defaults(float(self.user.scaling_kcal), float(self.user.scaling_distance))
+        self.assertAlmostEqual(float(workout.kcal), float(single.kcal), delta=0.006)
+        self.assertAlmostEqual(float(workout.distance), float(single.distance), delta=0.006)
+
+    def test_csv_import(self):
+        body = 'sport_type,start_datetime,duration,steps,kcal\nRun,2024-01-10T08:00:00Z,01:00:00,,\nSteps,2024-01-10T12:00:00Z,0,12000,\n'
+        response = self.client.post('/api/workout/bulk/', body, content_type='text/csv')
+        self.assertEqual(response.status_code, 201)
+        steps = Workout.objects.get(sport_type='Steps')
+        # the 10,000 steps of the hour run are not counted twice
+        self.assertAlmostEqual(float(steps.distance), 0.82 * 2_000 / 1000, places=2)
+
+    @override_settings(TIME_ZONE='Europe/London')
+    def test_steps_on_local_day(self):
+        # 23:30 UTC is already the day of the stored run in London summer time
+        with self.captureOnCommitCallbacks(execute=True):
+            Workout(user=self.user, sport_type='Run', intensity_category=2, start_datetime=datetime.datetime(2024, 6, 11, 7, 0, tzinfo=datetime.timezone.utc), duration=datetime.timedelta(hours=1)).save()
+        with self.captureOnCommitCallbacks(execute=True):
+            steps, = bulk_create_workouts(self.user, [{'sport_type': 'Steps', 'start_datetime': datetime.datetime(2024, 6, 10, 23, 30, tzinfo=datetime.timezone.utc), 'duration': datetime.timedelta(0), 'steps': 12_000}])
+        self.assertAlmostEqual(float(steps.distance), 0.82 * 2_000 / 1000, places=2)
+
+    def test_invalid_rows(self):
+        rows = self.rows(3)
+        rows[1]['sport_type'] = 'Steps'
+        response = self.client.post('/api/workout/bulk/', rows, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('steps', response.data[1])
+        self.assertFalse(Workout.objects.exists())
+
+
+class SideEffectsTest(RecalcTestCase):
+    def setUp(self):
+        super().setUp()
+        self.day = timezone.make_aware(datetime.datetime(2024, 1, 10, 7, 0))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.steps = Workout(user=self.user, sport_type='Steps', steps=12_000, start_datetime=self.day, duration=datetime.timedelta(0))
+            self.steps.save()
+        RecalcRequest.objects.all().delete()
+
+    def run_workout(self, hours=0, minutes=60):
+        return Workout(user=self.user, sport_type='Run', intensity_category=2, start_datetime=self.day + datetime.timedelta(hours=hours), duration=datetime.timedelta(minutes=minutes))
+
+    def test_single_save_budget(self):
+        # the run and the steps of its day are settled with a fixed number of queries
+        with self.assertNumQueries(23), self.captureOnCommitCallbacks(execute=True):
+            self.run_workout().save()
+        self.steps.refresh_from_db()
+        self.assertAlmostEqual(float(self.steps.distance), 0.82 * 2_000 / 1000, places=2)
+        self.assertEqual(RecalcRequest.objects.count(), len(self.goals))
+        self.assertEqual(Points.objects.count(), 2 * len(self.goals))
+
+    def test_transaction_collapses(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks, side_effects_atomic():
+            for i in range(3):
+                workout = self.run_workout(hours=i + 1, minutes=15)
+                workout.save()
+            workout.duration = datetime.timedelta(minutes=30)
+            workout.save()
+        self.assertEqual(len(callbacks), 1)
+        self.steps.refresh_from_db()
+        self.assertAlmostEqual(float(self.steps.distance), 0.82 * 2_000 / 1000, places=2)
+        self.assertEqual(RecalcRequest.objects.count(), len(self.goals))
+        points = Points.objects.get(workout=workout, goal__metric='min')
+        self.assertAlmostEqual(float(points.points_raw), _calculate_points_raw(goal=points.goal, workout=workout, user=self.user), delta=0.006)
+
+        # deleting the runs gives the steps back
+        with self.captureOnCommitCallbacks(execute=True):
+            for workout in Workout.objects.filter(sport_type='Run'):
+                workout.delete()
+        self.steps.refresh_from_db()
+        self.assertAlmostEqual(float(self.steps.distance), 0.82 * 12_000 / 1000, places=2)
+
+    def test_flushed_before_commit(self):
+        # points and recalc requests are written in the transaction - only the recalc trigger waits for the commit
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            self.run_workout().save()
+            self.assertEqual(Points.objects.count(), 2 * len(self.goals))
+            self.assertEqual(RecalcRequest.objects.count(), len(self.goals))
+        self.assertEqual(len(callbacks), 1)
+        with self.assertRaises(RuntimeError):
+            pending_side_effects()
+
+    def test_rollback_discards(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    self.run_workout().save()
+                    raise ValueError
+            except ValueError:
+                pass
+            self.run_workout(hours=2).save()
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(Points.objects.count(), 2 * len(self.goals))
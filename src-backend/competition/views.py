@@ -1,24 +1,25 @@
 from django.conf import settings
-from django.db.models import Q
+from django.db.models import Q, Prefetch
 from django.core.exceptions import PermissionDenied
 from rest_framework import viewsets
 from rest_framework.views import APIView
+from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework import status
-from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
 from rest_framework.permissions import BasePermission
 
-from django.db.models import Sum
-
 from custom_user.views import IsOwnerOrReadOnly
 from custom_user.models import CustomUser
 from custom_user.strava import sync_strava
 from custom_user.point_recalc import recalc_points
+from health_competition.pagination import StartDatetimeCursorPagination
 from .models import Competition, Team, ActivityGoal, Points
+from .filters import PointsFilter
 from .serializers import CompetitionSerializer, TeamSerializer, ActivityGoalSerializer, PointsSerializer
-from .stats import get_competition_stats
+from .stats import get_cached_competition_stats, get_competition_stats_page
+from .feed import FEED_PAGE_SIZE, FEED_MAX_PAGE_SIZE, get_feed
+from .leaderboard import LEADERBOARD_KINDS, get_leaderboard
 
 from celery import current_app
 import json
@@ -32,7 +33,13 @@ class CompetitionViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         # return all competitions the user is owner of or a participant of
         #time.sleep(3)  # throttle for testing
-        return Competition.objects.filter(Q(owner=self.request.user) | Q(user=self.request.user)).distinct().order_by('-end_date', '-start_date', '-id')
+        # memberships as IN subquery instead of a join needing DISTINCT, members prefetched for user / user_info
+        return (
+            Competition.objects
+            .filter(Q(owner=self.request.user) | Q(pk__in=self.request.user.my_competitions.values('pk')))
+            .prefetch_related(Prefetch('user', queryset=CustomUser.objects.only('id', 'username')))
+            .order_by('-end_date', '-start_date', '-id')
+        )
 
     def perform_create(self, serializer):
         # when creating a new competition, set the owner to the request user
@@ -48,7 +55,13 @@ class TeamViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         # return all teams the user is a member of and all teams of competitions the user participates in
         #time.sleep(3)  # throttle for testing
-        return Team.objects.filter(Q(user=self.request.user) | Q(competition__user=self.request.user)).distinct().order_by('name')
+        # memberships as IN subqueries instead of joins needing DISTINCT, members prefetched for user / user_info / my
+        return (
+            Team.objects
+            .filter(Q(pk__in=self.request.user.my_teams.values('pk')) | Q(competition__in=self.request.user.my_competitions.values('pk')))
+            .prefetch_related(Prefetch('user', queryset=CustomUser.objects.only('id', 'username')))
+            .order_by('name')
+        )
 
     def perform_create(self, serializer):
 
@@ -90,12 +103,22 @@ class PointsViewSet(viewsets.ModelViewSet):
     #queryset = Points.objects.all()
     serializer_class = PointsSerializer
 
+    filter_backends = [DjangoFilterBackend]
+    filterset_class = PointsFilter
+    pagination_class = StartDatetimeCursorPagination
+
     permission_classes = [IsOwnerOrReadOnly]
 
     def get_queryset(self):
         # return all points the user is owner of, a participant of, or of his/her own workouts
+        # competitions as IN subquery - joining the members would repeat every point per member and need a DISTINCT
         #time.sleep(3)  # throttle for testing
-        return Points.objects.filter(Q(goal__competition__owner=self.request.user) | Q(goal__competition__user=self.request.user) | Q(workout__user=self.request.user)).distinct().order_by('-workout__start_datetime', '-workout__duration', '-workout', '-workout__user')
+        competitions = Competition.objects.filter(Q(owner=self.request.user) | Q(user=self.request.user)).values('pk')
+        return (
+            Points.objects
+            .filter(Q(goal__competition__in=competitions) | Q(workout__user=self.request.user))
+            .order_by('-start_datetime', '-workout', '-id')
+        )
 
 
 class StatsPermissions(BasePermission):
@@ -200,13 +223,49 @@ class CeleryQueryView(APIView):
 class CompetitionStatsQueryView(APIView):
     permission_classes = [StatsPermissions]
 
-    @method_decorator(cache_page(30))  # cache for 30 seconds
     def get(self, request, competition):
-        response_obj = get_competition_stats(competition)
+        # limit / offset / around=me return only a slice of the leaderboards - all members otherwise
+        if any(i in request.query_params for i in ('limit', 'offset', 'around')):
+            try:
+                limit = min(max(int(request.query_params.get('limit', 25)), 1), 500)
+                offset = max(int(request.query_params.get('offset', 0)), 0)
+            except ValueError:
+                return Response({"message": "limit and offset must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+            if request.query_params.get('around', 'me') != 'me':
+                return Response({"message": "around only supports 'me'."}, status=status.HTTP_400_BAD_REQUEST)
+            self.check_object_permissions(request, None)
+            stats = get_competition_stats_page(competition, request.user, limit, offset=offset, around_me='around' in request.query_params)
+            return stats if isinstance(stats, Response) else Response(stats)
+
+        response_obj = get_cached_competition_stats(competition)
         self.check_object_permissions(request, response_obj)
         return Response(response_obj)
 
 
+class LeaderboardQueryView(APIView):
+    """ API view to get the top of the user/team ranking of a competition and the entries around the request user / their team """
+    permission_classes = [StatsPermissions]
+
+    def get(self, request, competition):
+        self.check_object_permissions(request, None)
+        kind = request.query_params.get('kind', 'user')
+        if kind not in LEADERBOARD_KINDS:
+            return Response({"message": f"kind must be one of {', '.join(LEADERBOARD_KINDS)}."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            top = min(max(int(request.query_params.get('top', 10)), 0), 100)
+            around = min(max(int(request.query_params.get('around', 2)), 0), 50)
+        except ValueError:
+            return Response({"message": "top and around must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+
+        leaderboard = get_leaderboard()
+        member_id = request.user.pk if kind == 'user' else request.user.my_teams.filter(competition=competition).values_list('pk', flat=True).first()
+        return Response({
+            'top': leaderboard.top(competition, top, kind=kind),
+            'me': None if member_id is None else leaderboard.rank(competition, member_id, kind=kind),
+            'around': [] if member_id is None else leaderboard.around(competition, member_id, around, kind=kind),
+        })
+
+
 class FeedPermissions(BasePermission):
     def has_permission(self, request, view):
         # Only authenticated users
@@ -222,26 +281,19 @@ class FeedPermissions(BasePermission):
 
 
 class FeedQueryView(APIView):
-    """ API view to get the activity/point feed for a competition. """
+    """ API view to get the activity/point feed timeline of a competition - newest first in pages of a keyset cursor (cursor=) or only the entries newer than since= """
     permission_classes = [FeedPermissions]
 
     def get(self, request, competition):
-        # Custom query logic
-        #time.sleep(3)  # throttle for testing
-
         competition_obj = Competition.objects.filter(id=competition)
         self.check_object_permissions(request, competition_obj)
 
-        all_points = Points.objects.filter(Q(award__competition__id=competition) | Q(goal__competition_id=competition)).order_by('-workout__start_datetime', '-workout__steps', '-workout__duration', '-workout', '-workout__user')
-
-        grouped_points = {i['workout']: i for i in all_points.values('workout__user', 'workout__user__username', 'workout__user__strava_allow_follow', 'workout', 'workout__sport_type', 'workout__start_datetime', 'workout__duration', 'workout__steps', 'workout__strava_id', 'award').annotate(points_capped=Sum('points_capped'), points_raw=Sum('points_raw')).order_by('-workout__start_datetime', '-workout__duration', '-workout', '-workout__user')}
-
-        for i in all_points.values('workout', 'id', 'goal', 'goal__name', 'award', 'award__name', 'points_capped', 'points_raw'):
-            if 'details' not in grouped_points[i['workout']]:
-                grouped_points[i['workout']]['details'] = []
-            grouped_points[i['workout']]['details'].append(i)
-
-        return Response(list(grouped_points.values()))
+        try:
+            limit = min(max(int(request.query_params.get('limit', FEED_PAGE_SIZE)), 1), FEED_MAX_PAGE_SIZE)
+            feed = get_feed(competition, limit=limit, cursor=request.query_params.get('cursor', None), since=request.query_params.get('since', None))
+        except ValueError as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(feed)
 
 
 
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import CustomUser, RecalcRequest
+from .models import CustomUser, RecalcRequest, ScorerCheckpoint
 
 # Register your models here.
 @admin.register(CustomUser)
@@ -22,4 +22,16 @@ class RecalcRequestAdmin(admin.ModelAdmin):
         "goal",
         "start_datetime",
         "done",
-    ]
\ No newline at end of file
+        "claimed_at",
+    ]
+
+@admin.register(ScorerCheckpoint)
+class ScorerCheckpointAdmin(admin.ModelAdmin):
+    """Admin view of ScorerCheckpoint"""
+
+    list_display = [
+        "user",
+        "goal",
+        "day",
+        "week_points_capped",
+    ]
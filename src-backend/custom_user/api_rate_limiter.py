@@ -1,21 +1,34 @@
 # myapp/monitor.py
-from datetime import datetime, timezone
+import threading
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
 from django.conf import settings
+from django.utils.module_loading import import_string
 
 
 class RateLimitExceeded(Exception):
     """Raised when the API rate limit is exceeded."""
     pass
 
+
 class APIRequestMonitor:
-    """ API request rate limiter"""
-    def __init__(self, limit_15min: int, limit_day: int):
-        self.limit_15min = limit_15min
-        self.limit_day = limit_day
+    """ API request rate limiter - counters of this process only (fallback for dev setups without Redis) """
+
+    # share of the 15min / day limits a kind of traffic may use - workout syncs leave a balance for user linkage
+    RESERVATIONS = {
+        'workout': (0.66, 0.8),
+        'linkage': (1, 1),
+    }
+
+    def __init__(self, limit_15min: int = None, limit_day: int = None):
+        self.limit_15min = settings.STRAVA_LIMIT_15MIN if limit_15min is None else limit_15min
+        self.limit_day = settings.STRAVA_LIMIT_DAY if limit_day is None else limit_day
         self.current_15min_slot = self._get_15min_slot()
         self.current_day = self._get_day()
         self.count_15min = 0
         self.count_day = 0
+        self._lock = threading.Lock()  # counters are shared by the sync threads
 
     def _get_15min_slot(self):
         now = datetime.now(timezone.utc)
@@ -24,6 +37,20 @@ class APIRequestMonitor:
     def _get_day(self):
         return datetime.now(timezone.utc).date()
 
+    def _limits(self, kind):
+        """ (15min, day) limits of a kind of traffic """
+        share_15min, share_day = self.RESERVATIONS[kind]
+        return int(self.limit_15min * share_15min), int(self.limit_day * share_day)
+
+    @staticmethod
+    def _usage(response):
+        """ (15min, day) usage reported by Strava in the X-RateLimit-Usage header - None if missing """
+        try:
+            usage_15min, usage_day = response.headers['X-RateLimit-Usage'].split(',')[:2]
+            return int(usage_15min), int(usage_day)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+
     def _maybe_reset_counters(self):
         now_slot = self._get_15min_slot()
         today = self._get_day()
@@ -36,36 +63,120 @@ class APIRequestMonitor:
             self.current_day = today
             self.count_day = 0
 
-    def log_request(self, response) -> bool:
-        self._maybe_reset_counters()
-        self.count_day += 1
-
+    def acquire(self, kind='workout'):
+        """ reserve one request of the kind's budget before sending it - raises RateLimitExceeded if it is used up """
+        limit_15min, limit_day = self._limits(kind)
+        with self._lock:
+            self._maybe_reset_counters()
+            if self.count_15min >= limit_15min or self.count_day >= limit_day:
+                raise RateLimitExceeded(f"No Strava {kind} API requests allowed anymore")
+            self.count_15min += 1
+            self.count_day += 1
+            print(f'Strava API Request (15min: {self.count_15min} / {self.limit_15min}, day: {self.count_day} / {self.limit_day})')
+
+    def log_response(self, response):
+        """ align the counters with the usage Strava reports - a 429 uses up the current 15min slot """
+        usage = self._usage(response)
+        with self._lock:
+            self._maybe_reset_counters()
+            if usage is not None:
+                self.count_15min = max(self.count_15min, usage[0])
+                self.count_day = max(self.count_day, usage[1])
+            if response.status_code == 429:
+                self.count_15min = self.limit_15min
         if response.status_code == 429:
-            self.count_15min = self.limit_15min
             raise RateLimitExceeded("API rate limit exceeded")
 
-        if self.count_15min >= self.limit_15min or self.count_day >= self.limit_day:
-            raise RateLimitExceeded("API rate limit probably exceeded")
-
-        self.count_15min += 1
-        print(f'Strava API Request (15min: {self.count_15min} / {self.limit_15min}, day: {self.count_day} / {self.limit_day})')
-        return True
-
     def count_requests(self):
-        self._maybe_reset_counters()
-        return {
-            "requests_15min": self.count_15min,
-            "requests_today": self.count_day
-        }
+        with self._lock:
+            self._maybe_reset_counters()
+            return {
+                "requests_15min": self.count_15min,
+                "requests_today": self.count_day
+            }
+
+    def _ok(self, kind):
+        stats = self.count_requests()
+        limit_15min, limit_day = self._limits(kind)
+        return stats["requests_today"] < limit_day and stats["requests_15min"] < limit_15min
 
     def ok_workout_requests(self):
-        stats = self.count_requests()
-        return ((stats["requests_today"] <= self.limit_day * 0.8) & (stats["requests_15min"] <= self.limit_15min * 0.66))
+        return self._ok('workout')
 
     def ok_linkage_requests(self):
-        stats = self.count_requests()
-        return ((stats["requests_today"] <= self.limit_day) & (stats["requests_15min"] <= self.limit_15min))
+        return self._ok('linkage')
+
+
+class RedisAPIRequestMonitor(APIRequestMonitor):
+    """ API request rate limiter with the counters in Redis - one consistent budget for all web and Celery processes """
+
+    KEY_15MIN = 'strava_api:15min:{slot}'  # counter of a 15min slot - expires with the slot
+    KEY_DAY = 'strava_api:day:{day}'  # counter of a UTC day - expires with the day
+
+    # KEYS: 15min counter, day counter - ARGV: 15min limit, day limit, 15min expiry, day expiry
+    ACQUIRE_SCRIPT = """
+        if tonumber(redis.call('GET', KEYS[1]) or '0') >= tonumber(ARGV[1]) or tonumber(redis.call('GET', KEYS[2]) or '0') >= tonumber(ARGV[2]) then
+            return 0
+        end
+        redis.call('INCR', KEYS[1])
+        redis.call('EXPIREAT', KEYS[1], ARGV[3])
+        redis.call('INCR', KEYS[2])
+        redis.call('EXPIREAT', KEYS[2], ARGV[4])
+        return 1
+    """
+
+    # KEYS: 15min counter, day counter - ARGV: 15min usage, day usage, 15min expiry, day expiry
+    USAGE_SCRIPT = """
+        for i = 1, 2 do
+            if tonumber(ARGV[i]) > tonumber(redis.call('GET', KEYS[i]) or '0') then
+                redis.call('SET', KEYS[i], ARGV[i])
+                redis.call('EXPIREAT', KEYS[i], ARGV[i + 2])
+            end
+        end
+    """
+
+    def __init__(self, connection=None, **kwargs):
+        super().__init__(**kwargs)
+        if connection is None:
+            from django_redis import get_redis_connection
+            connection = get_redis_connection('default')
+        self.connection = connection
+        self._acquire = connection.register_script(self.ACQUIRE_SCRIPT)
+        self._set_usage = connection.register_script(self.USAGE_SCRIPT)
+
+    def _slot_keys(self):
+        """ counter keys of the current slots and their expiry timestamps - a minute after the slot ends """
+        slot, day = self._get_15min_slot(), self._get_day()
+        day_start = datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+        keys = [self.KEY_15MIN.format(slot=int(slot.timestamp())), self.KEY_DAY.format(day=day.isoformat())]
+        expiry = [int((slot + timedelta(minutes=16)).timestamp()), int((day_start + timedelta(days=1, minutes=1)).timestamp())]
+        return keys, expiry
+
+    def acquire(self, kind='workout'):
+        keys, expiry = self._slot_keys()
+        if not self._acquire(keys=keys, args=list(self._limits(kind)) + expiry):
+            raise RateLimitExceeded(f"No Strava {kind} API requests allowed anymore")
+
+    def log_response(self, response):
+        usage = self._usage(response) or (0, 0)
+        if response.status_code == 429:
+            usage = (self.limit_15min, usage[1])
+        if usage != (0, 0):
+            keys, expiry = self._slot_keys()
+            self._set_usage(keys=keys, args=list(usage) + expiry)
+        if response.status_code == 429:
+            raise RateLimitExceeded("API rate limit exceeded")
+
+    def count_requests(self):
+        keys, _ = self._slot_keys()
+        count_15min, count_day = self.connection.mget(keys)
+        return {
+            "requests_15min": int(count_15min or 0),
+            "requests_today": int(count_day or 0)
+        }
 
 
-# Singleton instance
-strava_api_monitor = APIRequestMonitor(limit_15min=settings.STRAVA_LIMIT_15MIN, limit_day=settings.STRAVA_LIMIT_DAY)
\ No newline at end of file
+@lru_cache(maxsize=None)
+def get_strava_api_monitor():
+    """ Strava rate limiter configured in settings.STRAVA_RATE_LIMITER_BACKEND """
+    return import_string(settings.STRAVA_RATE_LIMITER_BACKEND)()
@@ -0,0 +1,28 @@
+from django.core.management import BaseCommand
+
+from competition.models import ActivityGoal, Award, DailyPoints
+from custom_user.point_recalc import refresh_daily_points
+
+class Command(BaseCommand):
+    """Rebuild the DailyPoints rollup from the Points table"""
+
+    # Show this when the user types help
+    help = "Rebuild the daily points rollup read by the competition stats (all competitions by default)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("competition", nargs="*", type=int, help="Ids of the competitions to rebuild")
+        parser.add_argument("--missing", action="store_true", help="Only competitions without any daily points yet (run on deploy)")
+
+    def handle(self, *args, **options):
+        """Actual Commandline executed function when manage.py command is called"""
+        goals, awards = ActivityGoal.objects.all(), Award.objects.all()
+        if options["competition"]:
+            goals = goals.filter(competition__in=options["competition"])
+            awards = awards.filter(competition__in=options["competition"])
+        if options["missing"]:
+            goals = goals.exclude(competition__in=DailyPoints.objects.values('competition'))
+            awards = awards.exclude(competition__in=DailyPoints.objects.values('competition'))
+        competitions = set(goals.values_list('competition', flat=True)) | set(awards.values_list('competition', flat=True))
+
+        refresh_daily_points(goals=goals, awards=awards)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt daily points of {len(competitions)} competitions."))
@@ -0,0 +1,27 @@
+from django.core.management import BaseCommand
+
+from competition.models import Competition, FeedEntry
+from competition.feed import refresh_feed
+
+class Command(BaseCommand):
+    """Rebuild the competition feed timelines from the Points table"""
+
+    # Show this when the user types help
+    help = "Rewrite the feed entries of the competitions from their points (all competitions by default)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("competition", nargs="*", type=int, help="Ids of the competitions to rebuild")
+        parser.add_argument("--missing", action="store_true", help="Only competitions without any feed entries yet (run on deploy)")
+
+    def handle(self, *args, **options):
+        """Actual Commandline executed function when manage.py command is called"""
+        competitions = Competition.objects.all()
+        if options["competition"]:
+            competitions = competitions.filter(pk__in=options["competition"])
+        if options["missing"]:
+            competitions = competitions.exclude(pk__in=FeedEntry.objects.values('competition'))
+
+        count = 0
+        for competition_id in competitions.values_list('pk', flat=True):
+            count += refresh_feed(competitions=[competition_id])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {count} feed entries."))
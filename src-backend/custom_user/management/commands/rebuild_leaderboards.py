@@ -0,0 +1,25 @@
+from django.core.management import BaseCommand
+
+from competition.models import Competition
+from competition.leaderboard import get_leaderboard
+
+class Command(BaseCommand):
+    """Rebuild the competition leaderboards from the Points table"""
+
+    # Show this when the user types help
+    help = "Reconcile the leaderboards of the LEADERBOARD_BACKEND with the points (all competitions by default)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("competition", nargs="*", type=int, help="Ids of the competitions to rebuild")
+
+    def handle(self, *args, **options):
+        """Actual Commandline executed function when manage.py command is called"""
+        competitions = Competition.objects.all()
+        if options["competition"]:
+            competitions = competitions.filter(pk__in=options["competition"])
+
+        leaderboard = get_leaderboard()
+        competition_ids = list(competitions.values_list('pk', flat=True))
+        for competition_id in competition_ids:
+            leaderboard.rebuild(competition_id)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt leaderboards of {len(competition_ids)} competitions."))
@@ -0,0 +1,22 @@
+from django.core.management import BaseCommand
+
+from competition.models import Points
+from competition.scorer import _copy_start_datetime
+
+class Command(BaseCommand):
+    """Copy the start_datetime of the workouts onto their points"""
+
+    # Show this when the user types help
+    help = "Fill the start_datetime keyset of the points list from their workouts (only points without one unless --all)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Copy onto all points")
+
+    def handle(self, *args, **options):
+        """Actual Commandline executed function when manage.py command is called"""
+        points = Points.objects.all()
+        if not options["all"]:
+            points = points.filter(start_datetime__isnull=True)
+
+        count = _copy_start_datetime(points)
+        self.stdout.write(self.style.SUCCESS(f"Copied the start_datetime onto {count} points."))
@@ -0,0 +1,39 @@
+import time
+
+import requests
+from django.conf import settings
+from django.core.management import BaseCommand
+
+
+class Command(BaseCommand):
+    """Send a fake Strava push subscription event to the webhook of a running server"""
+
+    # Show this when the user types help
+    help = "Post a fake Strava webhook event (or the subscription validation with --validate) to test the push ingestion locally"
+
+    def add_arguments(self, parser):
+        parser.add_argument("aspect_type", nargs="?", choices=["create", "update", "delete", "deauthorize"], default="create", help="Activity event or athlete deauthorization")
+        parser.add_argument("--object-id", type=int, default=0, help="Strava activity id")
+        parser.add_argument("--owner-id", type=int, default=0, help="Strava athlete id of the linked user")
+        parser.add_argument("--url", default="http://localhost:8000/api/strava/webhook/", help="Webhook url of the server")
+        parser.add_argument("--validate", action="store_true", help="Send the subscription validation handshake instead of an event")
+
+    def handle(self, *args, **options):
+        """Actual Commandline executed function when manage.py command is called"""
+        if options["validate"]:
+            response = requests.get(options["url"], params={'hub.mode': 'subscribe', 'hub.verify_token': settings.STRAVA_WEBHOOK_VERIFY_TOKEN, 'hub.challenge': 'fake-challenge'}, timeout=10)
+        else:
+            deauthorize = options["aspect_type"] == "deauthorize"
+            event = {
+                'object_type': 'athlete' if deauthorize else 'activity',
+                'object_id': options["owner_id"] if deauthorize else options["object_id"],
+                'aspect_type': 'update' if deauthorize else options["aspect_type"],
+                'owner_id': options["owner_id"],
+                'subscription_id': settings.STRAVA_WEBHOOK_SUBSCRIPTION_ID or 0,
+                'event_time': int(time.time()),
+                'updates': {'authorized': 'false'} if deauthorize else {},
+            }
+            response = requests.post(options["url"], json=event, timeout=10)
+
+        style = self.style.SUCCESS if response.ok else self.style.ERROR
+        self.stdout.write(style(f"{response.status_code} {response.text}"))
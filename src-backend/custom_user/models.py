@@ -12,8 +12,11 @@ from django.utils import timezone
 from django.conf import settings
 from django.db.models.signals import m2m_changed
 from django.dispatch import receiver
+from django.apps import apps
 
 from competition.scorer import trigger_user_change
+from competition.leaderboard import get_leaderboard
+from competition.stats import bump_stats_version
 from custom_user.emails.celery_emails import welcome_email
 
 # Create your models here.
@@ -91,7 +94,7 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
 
     email_mid_week = models.BooleanField(default=False)
 
-    strava_athlete_id = models.IntegerField(null=True, blank=True)
+    strava_athlete_id = models.IntegerField(null=True, blank=True, db_index=True)  # owner of Strava webhook events
     strava_allow_follow = models.BooleanField(default=True)
     strava_refresh_token = models.CharField(max_length=40, null=True, blank=True)
     strava_last_synced_at = models.DateTimeField(null=True, blank=True)
@@ -180,6 +183,20 @@ def my_competitions_changed_handler(sender, instance, action, pk_set, **kwargs):
                     trigger_user_change(instance=user_obj, new=False, changes={'my_competitions': ([instance.pk], None)})
 
 
+@receiver(m2m_changed, sender=CustomUser.my_teams.through)
+def my_teams_changed_handler(sender, instance, action, pk_set, **kwargs):
+    """ team memberships are part of the competition stats and the team leaderboard """
+    if 'post' in action:
+        Team = apps.get_model('competition', 'Team')
+        if isinstance(instance, CustomUser):
+            # pk_set is None when all teams of the user are cleared
+            competitions = list(Team.objects.filter(pk__in=pk_set).values_list('competition', flat=True) if pk_set else instance.my_competitions.values_list('pk', flat=True))
+        else: # is instance of Team
+            competitions = [instance.competition_id]
+        bump_stats_version(competitions)
+        get_leaderboard().rebuild_on_commit(competitions)
+
+
 
 def get_strava_auth_url(user_id):
     """ Generate the initial auth url the user clicks, which will re-direct back to this page providing the code."""
@@ -209,7 +226,29 @@ class RecalcRequest(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=False, blank=False)
     goal = models.ForeignKey('competition.ActivityGoal', on_delete=models.CASCADE, null=False, blank=False)
     start_datetime = models.DateTimeField(null=False, blank=False)
-    done = models.BooleanField(default=False, null=False, blank=False)
+    done = models.BooleanField(default=False, null=False, blank=False)  # claimed by a recalc shard
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    due = models.DateTimeField(default=timezone.now, null=False, blank=False)  # end of the debounce - the earliest due of a (user, goal) counts
+
+    def __str__(self):
+        return f'{self.goal} - {self.start_datetime}'
+
+class ScorerCheckpoint(models.Model):
+    """ Running Scorer totals at the end of a day to resume point cap recalcs from there """
+
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=False, blank=False)
+    goal = models.ForeignKey('competition.ActivityGoal', on_delete=models.CASCADE, null=False, blank=False)
+    day = models.DateField(null=False, blank=False)
+
+    day_points_raw = models.FloatField(null=False, default=0)
+    day_points_capped = models.FloatField(null=False, default=0)
+    week_points_raw = models.FloatField(null=False, default=0)
+    week_points_capped = models.FloatField(null=False, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'goal', 'day'], name='unique_user_goal_day')
+        ]
 
     def __str__(self):
-        return f'{self.goal} - {self.start_datetime}'
\ No newline at end of file
+        return f'{self.goal} - {self.day}'
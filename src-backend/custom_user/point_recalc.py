@@ -1,54 +1,196 @@
-import datetime
+import datetime, itertools
+import numpy as np
 
-from django.db.models import Min
+from celery import group
+from django.conf import settings
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
 
 from django.core.cache import cache
-from health_competition.celery import app, is_task_already_executing
+from health_competition.celery import app, singleton_task
 from django.apps import apps
 from django.contrib.auth import get_user_model
 
+from competition.feed import refresh_feed
+from competition.leaderboard import get_leaderboard
+from competition.stats import bump_stats_version
+from .recalc_queue import get_recalc_queue
+from .window_recalc import use_window_recalc, window_recalc_points
 
-def trigger_recalc_points():
-    last_recalc = cache.get('last_recalc_points', None)
 
-    if last_recalc is None or last_recalc < datetime.datetime.now() - datetime.timedelta(seconds=30):
-        cache.set('last_recalc_points', datetime.datetime.now(), 60 * 10)
-        eta = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=10)
+def trigger_recalc_points(eta=None):
+    """ schedule recalc_points - unless a run is already scheduled before eta (it will pick the requests up or re-schedule itself) """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    eta = now + datetime.timedelta(seconds=settings.RECALC_QUEUE_DEBOUNCE) if eta is None else eta
+    scheduled_at = cache.get('recalc_points_scheduled_at', None)
+
+    if scheduled_at is None or scheduled_at < now or scheduled_at > eta:
+        cache.set('recalc_points_scheduled_at', eta, 60 * 10)
         recalc_points.apply_async(eta=eta)
     else:
-        print('Recalc points task skipped because it was triggered less than 30 seconds ago')
+        print(f'Recalc points task not scheduled because it is already scheduled for {scheduled_at.isoformat()}')
 
 
-@app.task(bind=True, time_limit=60 * 30, max_retries=3)  # 30 min time limit
+@app.task(bind=True, time_limit=60 * 5, max_retries=3)  # 5 min time limit
+@singleton_task()
 def recalc_points(self):
-    if is_task_already_executing('recalc_points'):
-        print('Recalc points task skipped because it is already running')
-        return 'Skipped because it is already running.'
-
+    """ claim all due recalc requests and fan them out as one shard task per (user, goal) """
     print('Recalculating points...')
 
-    ActivityGoal = apps.get_model('competition', 'ActivityGoal')
-    Points = apps.get_model('competition', 'Points')
-    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
+    claims, next_due = get_recalc_queue().claim()
 
-    all_tasks = RecalcRequest.objects.filter(done=False)
-    grouped_tasks = all_tasks.values('user', 'goal').annotate(start_datetime=Min('start_datetime'))
-    for task_group in grouped_tasks:
-        points_lst = Points.objects.filter(goal=task_group['goal'], workout__user=task_group['user'], workout__start_datetime__gte=task_group['start_datetime']).order_by('workout__start_datetime')
+    group(
+        recalc_points_shard.s(user_id=i['user'], goal_id=i['goal'], start_datetime=i['start_datetime'].isoformat(), token=i['token'])
+        for i in claims
+    ).apply_async()
 
-        goal = ActivityGoal.objects.get(pk=task_group['goal'])
+    # (user, goal) pairs still waiting for their debounce
+    if next_due is not None:
+        trigger_recalc_points(eta=next_due)
 
-        scorer = Scorer()
-        scorer.set_goal(goal)
+    print(f'Points recalc fanned out to {len(claims)} shards.')
+    return [{'user': str(i['user']), 'goal': str(i['goal']), 'start_datetime': str(i['start_datetime'])} for i in claims]
 
-        for points in points_lst:
-            earned_points = scorer.calculate_points(points)
-            setattr(points, 'points_capped', earned_points)
-            points.save()
 
-    all_tasks.delete()
-    print('All points recalculated.')
-    return [{k: str(v) for k, v in i.items()} for i in grouped_tasks]
+@app.task(bind=True, time_limit=settings.RECALC_QUEUE_CLAIM_TIMEOUT)
+def recalc_points_shard(self, user_id, goal_id, start_datetime, token):
+    """ recalc the points of one (user, goal) pair and mark its claim in the recalc queue as done """
+    ActivityGoal = apps.get_model('competition', 'ActivityGoal')
+    recalc_queue = get_recalc_queue()
+
+    try:
+        goal = ActivityGoal.objects.get(pk=goal_id)
+        cnt_updated = recalc_user_goal_points(user_id=user_id, goal=goal, start_datetime=datetime.datetime.fromisoformat(start_datetime))
+    except ActivityGoal.DoesNotExist:
+        cnt_updated = 0
+    except Exception:
+        # give the claim back so that the next recalc_points run picks it up again
+        recalc_queue.release(token)
+        raise
+
+    # requests for this (user, goal) that came in while the shard was running
+    if recalc_queue.complete(token):
+        trigger_recalc_points()
+    return {'user': user_id, 'goal': goal_id, 'start_datetime': start_datetime, 'updated_points': cnt_updated}
+
+
+def recalc_user_goal_points(user_id, goal, start_datetime, chunk_size=2_000):
+    """ re-score all points of a user for a goal after start_datetime - resumed from the last checkpoint, streamed in chunks and only changed points_capped written back """
+    Points = apps.get_model('competition', 'Points')
+    ScorerCheckpoint = apps.get_model('custom_user', 'ScorerCheckpoint')
+
+    scorer = Scorer()
+    scorer.set_goal(goal)
+
+    # resume after the last checkpoint of the affected week or - if there is none - from the start of the week
+    start_date = start_datetime.astimezone(datetime.timezone.utc).date() if isinstance(start_datetime, datetime.datetime) else start_datetime
+    week_start_date = start_date - datetime.timedelta(days=start_date.weekday())
+    checkpoint = ScorerCheckpoint.objects.filter(user=user_id, goal=goal, day__gte=week_start_date, day__lt=start_date).order_by('-day').first()
+    if use_window_recalc(goal):
+        # window functions restart at the beginning of the week - checkpoints of the recalculated days are outdated
+        week_start_datetime = datetime.datetime.combine(week_start_date, datetime.time.min, tzinfo=datetime.timezone.utc)
+        with transaction.atomic():
+            ScorerCheckpoint.objects.filter(user=user_id, goal=goal, day__gte=week_start_date).delete()
+            cnt_updated = window_recalc_points(user_id=user_id, goal_id=goal.pk, start_datetime=week_start_datetime)
+            refresh_daily_points(goals=[goal], user_id=user_id, start_datetime=week_start_datetime)
+            return cnt_updated
+    elif checkpoint is None:
+        resume_date = week_start_date
+    else:
+        scorer.restore_memory(checkpoint)
+        resume_date = checkpoint.day + datetime.timedelta(days=1)
+    resume_datetime = datetime.datetime.combine(resume_date, datetime.time.min, tzinfo=datetime.timezone.utc)
+
+    points_lst = (
+        Points.objects
+        .filter(goal=goal, workout__user=user_id, workout__start_datetime__gte=resume_datetime)
+        .order_by('workout__start_datetime', 'workout__id')
+        .values_list('id', 'points_raw', 'points_capped', 'workout__start_datetime')
+        .iterator(chunk_size=chunk_size)
+    )
+
+    cnt_updated = 0
+    with transaction.atomic():
+        ScorerCheckpoint.objects.filter(user=user_id, goal=goal, day__gte=resume_date).delete()
+        while chunk := list(itertools.islice(points_lst, chunk_size)):
+            ids, raw_points, old_capped_points, timestamps = zip(*chunk)
+            # numpy floats rounded to the DecimalField - unchanged points compare equal and are not written
+            earned_points_lst = [Decimal(i).quantize(Decimal('0.01')) for i in scorer.calculate_batch(raw_points=raw_points, timestamps=timestamps).tolist()]
+
+            changed_points = [
+                Points(id=points_id, points_capped=earned_points)
+                for points_id, old_capped, earned_points in zip(ids, old_capped_points, earned_points_lst)
+                if old_capped != earned_points
+            ]
+            Points.objects.bulk_update(changed_points, ['points_capped'], batch_size=500)
+            cnt_updated += len(changed_points)
+
+            # a day can continue in the next chunk - its checkpoint is overwritten with the later totals
+            ScorerCheckpoint.objects.bulk_create(
+                [ScorerCheckpoint(user_id=user_id, goal=goal, **day_totals) for day_totals in scorer.day_totals],
+                batch_size=500,
+                update_conflicts=True,
+                unique_fields=['user', 'goal', 'day'],
+                update_fields=['day_points_raw', 'day_points_capped', 'week_points_raw', 'week_points_capped'],
+            )
+
+        refresh_daily_points(goals=[goal], user_id=user_id, start_datetime=resume_datetime)
+
+    return cnt_updated
+
+
+def refresh_daily_points(goals=(), awards=(), user_id=None, start_datetime=None):
+    """ rebuild the DailyPoints rollup of the goals and awards (optionally only of one user) from the local day of start_datetime on """
+    Points = apps.get_model('competition', 'Points')
+    DailyPoints = apps.get_model('competition', 'DailyPoints')
+
+    goals, awards = list(goals), list(awards)
+    points = Points.objects.filter(Q(goal__in=goals) | Q(award__in=awards))
+    daily_points = DailyPoints.objects.filter(Q(goal__in=goals) | Q(award__in=awards))
+    if user_id is not None:
+        points = points.filter(workout__user=user_id)
+        daily_points = daily_points.filter(user=user_id)
+    start_of_day = None
+    if start_datetime is not None:
+        start_day = timezone.localtime(start_datetime).date() if isinstance(start_datetime, datetime.datetime) else start_datetime
+        start_of_day = timezone.make_aware(datetime.datetime.combine(start_day, datetime.time.min))
+        points = points.filter(workout__start_datetime__gte=start_of_day)
+        daily_points = daily_points.filter(day__gte=start_day)
+
+    rows = (
+        points
+        .values('goal', 'award', 'workout__user', competition=Coalesce('goal__competition', 'award__competition'), day=TruncDate('workout__start_datetime'))
+        .annotate(points_capped=Coalesce(Sum('points_capped'), Decimal(0)))
+        .order_by()
+    )
+    competitions = {i.competition_id for i in goals + awards}
+    leaderboard = get_leaderboard()
+    with transaction.atomic(savepoint=False):
+        # the leaderboard is kept up to date with the difference of the rebuilt days
+        deltas = {}
+        if leaderboard.tracks_deltas:
+            for i in daily_points.values('competition', 'user').annotate(total=Sum('points_capped')).order_by():
+                deltas.setdefault(i['competition'], {}).setdefault(i['user'], Decimal(0))
+                deltas[i['competition']][i['user']] -= i['total']
+
+        daily_points.delete()
+        new_daily_points = DailyPoints.objects.bulk_create([
+            DailyPoints(competition_id=i['competition'], goal_id=i['goal'], award_id=i['award'], user_id=i['workout__user'], day=i['day'], points_capped=i['points_capped'])
+            for i in rows
+        ], batch_size=1_000)
+
+        if leaderboard.tracks_deltas:
+            for i in new_daily_points:
+                deltas.setdefault(i.competition_id, {}).setdefault(i.user_id, Decimal(0))
+                deltas[i.competition_id][i.user_id] += i.points_capped
+            transaction.on_commit(lambda: [leaderboard.apply_deltas(competition_id, user_deltas) for competition_id, user_deltas in deltas.items()])
+
+        # the capped points of the feed entries
+        refresh_feed(competitions=competitions, user_id=user_id, start_datetime=start_of_day)
+    bump_stats_version(competitions)
 
 
 
@@ -62,6 +204,7 @@ class Scorer:
         self.memory_this_week = None
         self.memory_week_points_raw = 0
         self.memory_week_points_capped = 0
+        self.day_totals = []
 
     def set_goal(self, goal):
         self.goal = goal
@@ -117,61 +260,111 @@ class Scorer:
         self.memory_week_points_capped += earned_points
         return earned_points
 
+    def calculate_batch(self, raw_points, timestamps):
+        """ calculate the capped points of a whole (user, goal) series at once - same result as calling calculate_points for every entry in order """
+        raw = np.asarray([float(i) for i in raw_points], dtype=float)
+        self.day_totals = []
+        if len(raw) == 0:
+            return raw
+
+        # day / week of each workout - new group whenever it differs from the previous workout (same as calculate_points)
+        days = np.array([i.replace(tzinfo=None) for i in timestamps], dtype='datetime64[D]')
+        thursdays = days - (days.astype(int) + 3) % 7 + 3  # 1970-01-01 was a Thursday
+        weeks = (thursdays - thursdays.astype('datetime64[Y]').astype('datetime64[D]')).astype(int) // 7 + 1
+        day_starts = np.concatenate(([True], days[1:] != days[:-1]))
+        week_starts = np.concatenate(([True], weeks[1:] != weeks[:-1]))
+
+        # continue the memory if the first workout is on the same day / week as the last calculated one
+        first_day, first_week = days[0].astype(datetime.date), int(weeks[0])
+        today_raw, today_capped = (float(self.memory_today_points_raw), float(self.memory_today_points_capped)) if first_day == self.memory_today else (0., 0.)
+        week_raw, week_capped = (float(self.memory_week_points_raw), float(self.memory_week_points_capped)) if first_week == self.memory_this_week else (0., 0.)
+
+        floor_workout, cap_workout = float(self.floor_workout), None if self.cap_workout is None else float(self.cap_workout)
+        floor_day, cap_day = float(self.floor_day), None if self.cap_day is None else float(self.cap_day)
+        floor_week, cap_week = float(self.floor_week), None if self.cap_week is None else float(self.cap_week)
+
+        day_raw_cum = _grouped_cumsum(raw, day_starts, today_raw)
+        week_raw_cum = _grouped_cumsum(raw, week_starts, week_raw)
+
+        # workout floor + cap
+        earned_points = np.maximum(raw - floor_workout, 0)
+        if cap_workout is not None:
+            earned_points = np.minimum(earned_points, cap_workout - floor_workout)
 
-class DummyObject:
-    def __init__(self, **kwargs):
-        self.min_per_workout = None
-        self.max_per_workout = None
-        self.min_per_day = None
-        self.max_per_day = None
-        self.min_per_week = None
-        self.max_per_week = None
-        for key, value in kwargs.items():
-            setattr(self, key, value)
-
-
-def test_scorer():
-
-    for goal_kwargs, points, expected_result in (
-        ({'goal': 100, 'min_per_workout': 10}, [10], 0),
-        ({'goal': 100, 'min_per_workout': 10}, [20], 10),
-        ({'goal': 100, 'max_per_workout': 30}, [30], 30),
-        ({'goal': 100, 'max_per_workout': 30}, [40], 30),
-        ({'goal': 100, 'min_per_workout': 10, 'max_per_workout': 30}, [40], 20),
-        ({'goal': 100, 'min_per_day': 10}, [10], 0),
-        ({'goal': 100, 'min_per_day': 10}, [20], 10),
-        ({'goal': 100, 'min_per_day': 10}, [8, 8], 6),
-        ({'goal': 100, 'max_per_day': 30}, [20], 20),
-        ({'goal': 100, 'max_per_day': 30}, [20, 20], 30),
-        ({'goal': 100, 'min_per_day': 10, 'max_per_day': 30}, [8, 12, 8, 8, 14], 20),
-        ({'goal': 100, 'min_per_week': 10}, [10], 0),
-        ({'goal': 100, 'min_per_week': 10}, [20], 10),
-        ({'goal': 100, 'max_per_week': 30}, [20], 20),
-        ({'goal': 100, 'max_per_week': 30}, [20, 20], 30),
-        ({'goal': 100, 'min_per_week': 10, 'max_per_week': 30}, [8, 12, 8, 8, 14], 20),
-        ({'goal': 100, 'min_per_workout': 10, 'min_per_day': 20}, [5, 20, 5, 20], 15),
-        ({'goal': 100, 'min_per_workout': 20, 'min_per_day': 10}, [5, 30, 30], 20),
-        ({'goal': 100, 'max_per_workout': 20, 'max_per_day': 30}, [20, 25, 25, 25], 30),
-        ({'goal': 100, 'max_per_workout': 30, 'max_per_day': 20}, [20, 25, 25, 25], 20),
-        ({'goal': 100, 'min_per_workout': 10, 'max_per_day': 15}, [5, 5, 5, 5], 0),
-        ({'goal': 100, 'min_per_workout': 10, 'max_per_day': 30}, [15, 35, 5, 15], 30),
-    ):
-        workout = DummyObject(start_datetime=datetime.datetime.fromisoformat('2023-01-01T00:00:00'))
-        goal = DummyObject(**goal_kwargs)
-        scorer = Scorer()
-        scorer.set_goal(goal)
-
-        earned_points = 0
-        for point in points:
-            point_obj = DummyObject(points_raw=point, workout = workout)
-            earned_points += scorer.calculate_points(point_obj)
-
-        assert earned_points == expected_result, f'Expected {expected_result}, got {earned_points} for goal {goal_kwargs}'
-
-
-
-
-
-if __name__ == '__main__':
-    test_scorer()
+        # day floor
+        earned_points = np.maximum(np.minimum(earned_points, day_raw_cum - floor_day), 0)
+
+        if cap_day is not None and floor_week != 0:
+            # the week floor depends on the capped day total - needs to be calculated workout by workout
+            earned_points = _sequential_day_week_caps(earned_points, day_starts, week_starts, week_raw_cum, today_capped, week_capped, cap_day - floor_day, floor_week, None if cap_week is None else cap_week - floor_week)
+        else:
+            # day cap
+            if cap_day is not None:
+                earned_points = _grouped_capped_increments(earned_points, day_starts, cap_day - floor_day, today_capped)
+            # week floor
+            earned_points = np.maximum(np.minimum(earned_points, week_raw_cum - floor_week), 0)
+            # week cap
+            if cap_week is not None:
+                earned_points = _grouped_capped_increments(earned_points, week_starts, cap_week - floor_week, week_capped)
+
+        day_capped_cum = _grouped_cumsum(earned_points, day_starts, today_capped)
+        week_capped_cum = _grouped_cumsum(earned_points, week_starts, week_capped)
+
+        # running totals at the end of every day - to be able to resume from there later
+        day_ends = np.concatenate((day_starts[1:], [True]))
+        self.day_totals = [
+            {'day': day, 'day_points_raw': day_raw, 'day_points_capped': day_capped, 'week_points_raw': week_raw, 'week_points_capped': week_capped}
+            for day, day_raw, day_capped, week_raw, week_capped in zip(days[day_ends].tolist(), day_raw_cum[day_ends].tolist(), day_capped_cum[day_ends].tolist(), week_raw_cum[day_ends].tolist(), week_capped_cum[day_ends].tolist())
+        ]
+
+        self.memory_today = days[-1].astype(datetime.date)
+        self.memory_today_points_raw = day_raw_cum[-1]
+        self.memory_today_points_capped = day_capped_cum[-1]
+        self.memory_this_week = int(weeks[-1])
+        self.memory_week_points_raw = week_raw_cum[-1]
+        self.memory_week_points_capped = week_capped_cum[-1]
+        return earned_points
 
+    def restore_memory(self, checkpoint):
+        """ continue scoring after the day of a ScorerCheckpoint """
+        self.memory_today = checkpoint.day
+        self.memory_today_points_raw = checkpoint.day_points_raw
+        self.memory_today_points_capped = checkpoint.day_points_capped
+        self.memory_this_week = checkpoint.day.isocalendar()[1]
+        self.memory_week_points_raw = checkpoint.week_points_raw
+        self.memory_week_points_capped = checkpoint.week_points_capped
+
+
+def _grouped_cumsum(values, group_starts, offset=0.):
+    """ cumulative sum restarting at every group start - the first group starts at offset """
+    cumsum = np.cumsum(values)
+    group_idx = np.cumsum(group_starts) - 1
+    group_base = (cumsum - values)[group_starts][group_idx]
+    group_base[group_idx == 0] -= offset
+    return cumsum - group_base
+
+
+def _grouped_capped_increments(values, group_starts, cap, offset=0.):
+    """ points earned per entry if the running total of each group can't exceed cap - the first group starts at offset """
+    group_offset = np.where(np.cumsum(group_starts) == 1, offset, 0.)
+    capped_cum = np.maximum(group_offset, np.minimum(_grouped_cumsum(values, group_starts, offset), cap))
+    previous_capped_cum = np.where(group_starts, group_offset, np.concatenate(([0.], capped_cum[:-1])))
+    return capped_cum - previous_capped_cum
+
+
+def _sequential_day_week_caps(values, day_starts, week_starts, week_raw_cum, today_capped, week_capped, max_day, floor_week, max_week):
+    """ day cap, week floor and week cap applied workout by workout - fallback if the week floor depends on the day cap """
+    earned_points_lst = np.empty_like(values)
+    for idx, earned_points in enumerate(values.tolist()):
+        if idx > 0 and day_starts[idx]:
+            today_capped = 0.
+        if idx > 0 and week_starts[idx]:
+            week_capped = 0.
+        earned_points = max(min(earned_points, max_day - today_capped), 0)
+        earned_points = max(min(earned_points, week_raw_cum[idx] - floor_week), 0)
+        if max_week is not None:
+            earned_points = max(min(earned_points, max_week - week_capped), 0)
+        today_capped += earned_points
+        week_capped += earned_points
+        earned_points_lst[idx] = earned_points
+    return earned_points_lst
@@ -0,0 +1,232 @@
+import datetime
+from functools import lru_cache
+
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Exists, Min, OuterRef
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+def _to_datetime(value):
+    """ RecalcRequest start_datetime can be a date, a naive/aware datetime or an ISO string """
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time.min)
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
+
+
+class BaseRecalcQueue:
+    """ Queue of pending point cap recalcs keyed by (user, goal) """
+
+    def __init__(self, debounce=None, claim_timeout=None):
+        self.debounce = settings.RECALC_QUEUE_DEBOUNCE if debounce is None else debounce  # seconds a (user, goal) waits for more changes
+        self.claim_timeout = settings.RECALC_QUEUE_CLAIM_TIMEOUT if claim_timeout is None else claim_timeout  # seconds after which a claim counts as crashed
+
+    def enqueue(self, user_id, goal_id, start_datetime):
+        """ request a recalc of the user's goal points from start_datetime on """
+        self.enqueue_many([(user_id, goal_id, start_datetime)])
+
+    def enqueue_many(self, requests):
+        """ request recalcs for a list of (user_id, goal_id, start_datetime) """
+        raise NotImplementedError
+
+    transactional = False  # whether enqueue_many writes are part of the current database transaction
+
+    def enqueue_on_commit(self, requests):
+        """ enqueue_many once the current transaction is committed - a shard must not recalc uncommitted or rolled back points """
+        requests = list(requests)
+        if len(requests) == 0:
+            return
+        if self.transactional:
+            # committed or rolled back together with the points
+            self.enqueue_many(requests)
+        else:
+            transaction.on_commit(lambda: self.enqueue_many(requests))
+
+    def claim(self):
+        """ claim all due (user, goal) pairs that are not claimed yet - returns (claims, next_due) """
+        raise NotImplementedError
+
+    def complete(self, token):
+        """ remove a finished claim - returns whether new requests for the (user, goal) came in meanwhile """
+        raise NotImplementedError
+
+    def release(self, token):
+        """ give a failed claim back to the queue """
+        raise NotImplementedError
+
+
+class DatabaseRecalcQueue(BaseRecalcQueue):
+    """ RecalcRequest table as queue - fallback for SQLite-only dev setups without Redis """
+
+    transactional = True
+
+    def enqueue_many(self, requests):
+        RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
+        due = timezone.now() + datetime.timedelta(seconds=self.debounce)
+        RecalcRequest.objects.bulk_create([RecalcRequest(user_id=user_id, goal_id=goal_id, start_datetime=_to_datetime(start_datetime), due=due) for user_id, goal_id, start_datetime in requests])
+
+    def claim(self):
+        RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
+
+        # claim open requests of due (user, goal) pairs (and requests of crashed shards) - skipping pairs a shard is still working on
+        # like the Redis queue a pair is due once the debounce of its first open request is over
+        now = timezone.now()
+        stale_claim = now - datetime.timedelta(seconds=self.claim_timeout)
+        with transaction.atomic():
+            in_flight = RecalcRequest.objects.filter(done=True, claimed_at__gte=stale_claim, user=OuterRef('user'), goal=OuterRef('goal'))
+            pair_due = RecalcRequest.objects.filter(done=False, due__lte=now, user=OuterRef('user'), goal=OuterRef('goal'))
+            claimable = RecalcRequest.objects.filter((Q(done=False) & Exists(pair_due)) | Q(done=True, claimed_at__lt=stale_claim)).exclude(Exists(in_flight))
+            claimed = list(claimable.select_for_update(skip_locked=True).values_list('id', 'user', 'goal', 'start_datetime'))
+            RecalcRequest.objects.filter(pk__in=[i[0] for i in claimed]).update(done=True, claimed_at=now)
+            next_due = RecalcRequest.objects.filter(done=False).exclude(Exists(in_flight)).aggregate(due=Min('due'))['due']
+
+        claims = {}
+        for request_id, user_id, goal_id, start_datetime in claimed:
+            claim = claims.setdefault((user_id, goal_id), {'user': user_id, 'goal': goal_id, 'start_datetime': start_datetime, 'token': []})
+            claim['start_datetime'] = min(claim['start_datetime'], start_datetime)
+            claim['token'].append(request_id)
+        return list(claims.values()), next_due
+
+    def complete(self, token):
+        RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
+        claimed = RecalcRequest.objects.filter(pk__in=token)
+        pending = RecalcRequest.objects.filter(done=False, user__in=claimed.values('user'), goal__in=claimed.values('goal')).exists()
+        claimed.delete()
+        return pending
+
+    def release(self, token):
+        RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
+        RecalcRequest.objects.filter(pk__in=token).update(done=False, claimed_at=None, due=timezone.now())
+
+
+class RedisRecalcQueue(BaseRecalcQueue):
+    """ Redis hashes as queue - one entry per (user, goal) keeping only the earliest start_datetime """
+
+    PENDING_KEY = 'recalc_queue:pending'  # hash (user:goal) -> earliest start timestamp
+    DUE_KEY = 'recalc_queue:due'  # sorted set (user:goal) -> timestamp when the debounce is over
+    CLAIMED_KEY = 'recalc_queue:claimed'  # hash (user:goal) -> "claimed at timestamp|start timestamp"
+
+    ENQUEUE_SCRIPT = """
+        for i = 1, #ARGV - 1, 2 do
+            local pending = redis.call('HGET', KEYS[1], ARGV[i])
+            if (not pending) or tonumber(ARGV[i + 1]) < tonumber(pending) then
+                redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+            end
+            redis.call('ZADD', KEYS[2], 'NX', ARGV[#ARGV], ARGV[i])
+        end
+    """
+
+    CLAIM_SCRIPT = """
+        local now = tonumber(ARGV[1])
+        local stale = tonumber(ARGV[2])
+
+        -- give the requests of crashed shards back to the queue
+        local claimed = redis.call('HGETALL', KEYS[3])
+        for i = 1, #claimed, 2 do
+            local claimed_at, start = string.match(claimed[i + 1], '([^|]+)|(.+)')
+            if tonumber(claimed_at) < stale then
+                redis.call('HDEL', KEYS[3], claimed[i])
+                local pending = redis.call('HGET', KEYS[1], claimed[i])
+                if (not pending) or tonumber(start) < tonumber(pending) then
+                    redis.call('HSET', KEYS[1], claimed[i], start)
+                end
+                redis.call('ZADD', KEYS[2], 'NX', now, claimed[i])
+            end
+        end
+
+        -- claim everything that is due and not claimed by a running shard
+        local due_lst = redis.call('ZRANGE', KEYS[2], 0, -1, 'WITHSCORES')
+        local next_due = ''
+        local result = {}
+        for i = 1, #due_lst, 2 do
+            local key = due_lst[i]
+            if redis.call('HEXISTS', KEYS[3], key) == 0 then
+                if tonumber(due_lst[i + 1]) > now then
+                    if next_due == '' then next_due = due_lst[i + 1] end
+                else
+                    local start = redis.call('HGET', KEYS[1], key)
+                    redis.call('HDEL', KEYS[1], key)
+                    redis.call('ZREM', KEYS[2], key)
+                    if start then
+                        redis.call('HSET', KEYS[3], key, ARGV[1] .. '|' .. start)
+                        table.insert(result, key)
+                        table.insert(result, start)
+                    end
+                end
+            end
+        end
+        table.insert(result, 1, next_due)
+        return result
+    """
+
+    # give a claim back - the claimed start is merged into the pending start and the pair is due right away
+    RELEASE_SCRIPT = """
+        local claimed = redis.call('HGET', KEYS[3], ARGV[1])
+        if not claimed then return 0 end
+        local start = string.match(claimed, '[^|]+|(.+)')
+        redis.call('HDEL', KEYS[3], ARGV[1])
+        local pending = redis.call('HGET', KEYS[1], ARGV[1])
+        if (not pending) or tonumber(start) < tonumber(pending) then
+            redis.call('HSET', KEYS[1], ARGV[1], start)
+        end
+        redis.call('ZADD', KEYS[2], 'NX', ARGV[2], ARGV[1])
+        return 1
+    """
+
+    COMPLETE_SCRIPT = """
+        redis.call('HDEL', KEYS[3], ARGV[1])
+        return redis.call('HEXISTS', KEYS[1], ARGV[1])
+    """
+
+    def __init__(self, connection=None, **kwargs):
+        super().__init__(**kwargs)
+        if connection is None:
+            from django_redis import get_redis_connection
+            connection = get_redis_connection('default')
+        self.connection = connection
+        self._enqueue = connection.register_script(self.ENQUEUE_SCRIPT)
+        self._claim = connection.register_script(self.CLAIM_SCRIPT)
+        self._complete = connection.register_script(self.COMPLETE_SCRIPT)
+        self._release = connection.register_script(self.RELEASE_SCRIPT)
+
+    @property
+    def keys(self):
+        return [self.PENDING_KEY, self.DUE_KEY, self.CLAIMED_KEY]
+
+    def enqueue_many(self, requests, due=None):
+        if len(requests) == 0:
+            return
+        due = timezone.now().timestamp() + self.debounce if due is None else due
+        args = []
+        for user_id, goal_id, start_datetime in requests:
+            args.extend([f'{user_id}:{goal_id}', _to_datetime(start_datetime).timestamp()])
+        self._enqueue(keys=self.keys, args=args + [due])
+
+    def claim(self):
+        now = timezone.now().timestamp()
+        next_due, *claimed = self._claim(keys=self.keys, args=[now, now - self.claim_timeout])
+        claims = []
+        for key, start in zip(claimed[::2], claimed[1::2]):
+            key = key.decode() if isinstance(key, bytes) else key
+            user_id, goal_id = key.split(':')
+            claims.append({'user': int(user_id), 'goal': int(goal_id), 'start_datetime': datetime.datetime.fromtimestamp(float(start), tz=datetime.timezone.utc), 'token': key})
+        next_due = None if next_due in ('', b'') else datetime.datetime.fromtimestamp(float(next_due), tz=datetime.timezone.utc)
+        return claims, next_due
+
+    def complete(self, token):
+        return bool(self._complete(keys=self.keys, args=[token]))
+
+    def release(self, token):
+        self._release(keys=self.keys, args=[token, timezone.now().timestamp()])
+
+
+@lru_cache(maxsize=None)
+def get_recalc_queue():
+    """ recalc queue backend configured in settings.RECALC_QUEUE_BACKEND """
+    return import_string(settings.RECALC_QUEUE_BACKEND)()
@@ -1,5 +1,8 @@
 import requests
-import time, datetime
+import atexit, threading, time, datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from celery.signals import worker_process_shutdown
 
 from django.core.cache import cache
 from django.contrib.auth import get_user_model
@@ -7,12 +10,61 @@ from django.conf import settings
 from django.utils import timezone
 from rest_framework.response import Response
 from rest_framework import status
+from django import db
 from django.db import IntegrityError
-from health_competition.celery import app, is_task_already_executing
+from health_competition.celery import app, singleton_task
 from django.db.models import Q
 
-from workouts.models import Workout
-from .api_rate_limiter import strava_api_monitor, RateLimitExceeded  # Import to trigger initialization
+from workouts.models import Workout, bulk_upsert_workouts
+from .api_rate_limiter import get_strava_api_monitor, RateLimitExceeded
+
+
+_pool_lock = threading.Lock()
+_pool = {}  # shared keep-alive session and detail fetch executor of this process - created on first use
+_in_flight = threading.BoundedSemaphore(settings.STRAVA_SYNC_CONCURRENCY)
+
+
+def _session():
+    """ keep-alive HTTP session shared by all threads of the process - its connection pool holds STRAVA_SYNC_CONCURRENCY connections """
+    with _pool_lock:
+        if 'session' not in _pool:
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=settings.STRAVA_SYNC_CONCURRENCY))
+            _pool['session'] = session
+        return _pool['session']
+
+
+def _detail_executor():
+    """ threads fetching activity details - one pool for all syncs of the process instead of one per page and user """
+    with _pool_lock:
+        if 'executor' not in _pool:
+            _pool['executor'] = ThreadPoolExecutor(max_workers=settings.STRAVA_SYNC_CONCURRENCY, thread_name_prefix='strava_details')
+        return _pool['executor']
+
+
+@worker_process_shutdown.connect
+def close_strava_pool(**kwargs):
+    """ close the shared session and executor when the process shuts down """
+    with _pool_lock:
+        executor, session = _pool.pop('executor', None), _pool.pop('session', None)
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+    if session is not None:
+        session.close()
+
+
+atexit.register(close_strava_pool)
+
+
+def _strava_request(method, url, **kwargs):
+    """ Strava API call counted against the workout budget - at most STRAVA_SYNC_CONCURRENCY calls of this process are in flight """
+    monitor = get_strava_api_monitor()
+    monitor.acquire('workout')  # leaves enough balance for user linkage
+    with _in_flight:
+        response = _session().request(method, url, timeout=60, **kwargs)
+    monitor.log_response(response)
+    response.raise_for_status()
+    return response.json()
 
 
 def _seconds_until_next_interval():
@@ -34,10 +86,8 @@ def _seconds_until_next_interval():
 
 
 @app.task(bind=True, time_limit=60 * 60 * 3, max_retries=10)  # 3 hour time limit
+@singleton_task()
 def daily_strava_sync(self, refresh_all=False):
-    if is_task_already_executing('daily_strava_sync'):
-        return 'Task already executing. Skipping.'
-
     CustomUser = get_user_model()
     user_lst = CustomUser.objects.filter(
         strava_refresh_token__isnull=False,
@@ -45,7 +95,7 @@ def daily_strava_sync(self, refresh_all=False):
     )
     if refresh_all is False:
         user_lst = user_lst.filter(
-            Q(strava_last_synced_at__lt=timezone.now() - datetime.timedelta(hours=6)) |
+            Q(strava_last_synced_at__lt=timezone.now() - datetime.timedelta(hours=settings.STRAVA_POLL_INTERVAL_HOURS)) |
             Q(strava_last_synced_at__isnull=True)
         )
     user_lst = user_lst.order_by('strava_last_synced_at', 'pk')
@@ -53,66 +103,101 @@ def daily_strava_sync(self, refresh_all=False):
     user_lst_names = [{'pk': i.pk, 'username': i.username, 'email': i.email} for i in user_lst]
     print(f'Syncing Strava for {len(user_lst)} users: {user_lst_names}')
 
-    for user in user_lst:
-        try:
-            sync_strava(user__id=user.id)
-        except RateLimitExceeded as exc:
-            sleep_time = _seconds_until_next_interval() + 60
-            print(f'Strava sync rate limit exceeded - sleeping for {sleep_time // 60 } mins')
-            raise self.retry(exc=exc, countdown=sleep_time)  # retry in next Strava 15min api period
-        except Exception as exc:
-            print(f'Strava sync failed for user {user.email} - {exc}')
+    # users are synced in parallel - the shared budget of the Strava rate limiter stops all of them
+    with ThreadPoolExecutor(max_workers=settings.STRAVA_SYNC_CONCURRENCY) as executor:
+        futures = {executor.submit(_sync_strava_thread, user.id): user for user in user_lst}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except RateLimitExceeded as exc:
+                executor.shutdown(wait=True, cancel_futures=True)
+                sleep_time = _seconds_until_next_interval() + 60
+                print(f'Strava sync rate limit exceeded - sleeping for {sleep_time // 60 } mins')
+                raise self.retry(exc=exc, countdown=sleep_time)  # retry in next Strava 15min api period
+            except Exception as exc:
+                print(f'Strava sync failed for user {futures[future].email} - {exc}')
 
     print('Finished syncing Strava.')
     return user_lst_names
 
 
 
+def _access_token(user, refresh=False):
+    """ cached Strava access token of a user - refreshed with the refresh token if expired (or refresh is set) """
+    access_token = None if refresh else cache.get(f"strava_access_token_{user.pk}")
+    if access_token is None:
+        strava_tokens = _strava_request(
+            'post',
+            url='https://www.strava.com/oauth/token',
+            data={
+                'client_id': settings.STRAVA_CLIENT_ID,
+                'client_secret': settings.STRAVA_CLIENT_SECRET,
+                'grant_type': 'refresh_token',
+                'refresh_token': user.strava_refresh_token,
+            }
+        )
+        access_token = strava_tokens.get('access_token', None)
+        cache.set(f"strava_access_token_{user.pk}", access_token, int(strava_tokens.get('expires_in', 21600)) - 60)
+    return access_token
+
+
+def _activity_props(activity, activity_details=None):
+    """ Workout fields of a Strava activity - kcal and intensity only from the details of new activities """
+    props = {
+        'strava_id': activity.get('id'),
+        'sport_type': activity.get('sport_type'),
+        'start_datetime': datetime.datetime.fromisoformat(activity.get('start_date')),
+        'duration': datetime.timedelta(seconds=activity.get('moving_time')),
+        'distance': None if activity.get('distance') == 0 else activity.get('distance') / 1_000,
+    }
+
+    # if a new workout - use activity details
+    if activity_details is not None:
+        avg_heart_rate = activity_details.get('average_heartrate', 0)
+        props['kcal'] = kcal = activity_details.get('calories', activity_details.get('kilojoules', 0) / 4.18)
+        props['strava_intensity_avg_watts'] = avg_watt = activity_details.get('average_watts', 0)
+
+        # estimate intensity
+        max_heart_rate = 180
+        kcal_per_ten_minute = kcal / (max(activity.get('moving_time', 60 * 30), 60) / (60 * 10))
+        if avg_heart_rate > max_heart_rate * 0.85 or kcal_per_ten_minute > 120 or avg_watt > 300:
+            props['intensity_category'] = 4
+        elif avg_heart_rate > max_heart_rate * 0.70 or kcal_per_ten_minute > 90 or avg_watt > 275:
+            props['intensity_category'] = 3
+        elif avg_heart_rate > max_heart_rate * 0.60 or kcal_per_ten_minute > 75 or avg_watt > 225:
+            props['intensity_category'] = 2
+        else:
+            props['intensity_category'] = 1
+    return props
+
+
+def _sync_strava_thread(user__id):
+    """ sync_strava in a worker thread - the thread's database connection is closed afterwards """
+    try:
+        return sync_strava(user__id=user__id)
+    finally:
+        db.connection.close()
+
+
 @app.task(bind=True)
 def sync_strava(self, user__id, start_datetime=None):
-    access_token = cache.get(f"strava_access_token_{user__id}")
     CustomUser = get_user_model()
     user = CustomUser.objects.get(id=user__id)
 
-    all_existing_strava_activities = set(Workout.objects.all().values_list('strava_id', flat=True))
-
     cnt_new_strava_activities = 0
     cnt_updated_strava_activities = 0
 
-    if strava_api_monitor.ok_workout_requests() is False:
+    if get_strava_api_monitor().ok_workout_requests() is False:
         raise RateLimitExceeded("No Strava Workout API requests allowed anymore to keep enough balance for user linkage")
 
-    # refresh access token if expired
-    if access_token is None:
-        refresh_token = user.strava_refresh_token
-        client_id = settings.STRAVA_CLIENT_ID
-        client_secret = settings.STRAVA_CLIENT_SECRET
-
-        response = requests.post(
-            url='https://www.strava.com/oauth/token',
-            data={
-                'client_id': client_id,
-                'client_secret': client_secret,
-                'grant_type': 'refresh_token',
-                'refresh_token': refresh_token,
-            }
-        )
-        strava_api_monitor.log_request(response)
-        response.raise_for_status()
-
-        strava_tokens = response.json()
-        access_token = strava_tokens.get('access_token', None)
-        cache.set(f"strava_access_token_{user__id}", access_token, int(strava_tokens.get('expires_in', 21600)) - 60)
-
+    access_token = _access_token(user)
 
     # get activities
     page = 1
     per_page = 200
     while True:
-        if strava_api_monitor.ok_workout_requests() is False:
-            raise RateLimitExceeded("No Strava Workout API requests allowed anymore to keep enough balance for user linkage")
-
-        response = requests.get(
+        activities = _strava_request(
+            'get',
             url='https://www.strava.com/api/v3/athlete/activities',
             headers={
                 'Authorization': f'Bearer {access_token}',
@@ -123,63 +208,19 @@ def sync_strava(self, user__id, start_datetime=None):
                 'per_page': per_page,
             }
         )
-        strava_api_monitor.log_request(response)
-        response.raise_for_status()
-        activities = response.json()
-
-        for activity in activities:
-            activity_id = activity.get('id')
-
-            props = {
-                'user': user,
-                'strava_id': activity_id,
-                'sport_type': activity.get('sport_type'),
-                'start_datetime': datetime.datetime.fromisoformat(activity.get('start_date')),
-                'duration': datetime.timedelta(seconds=activity.get('moving_time')),
-                'distance': None if activity.get('distance') == 0 else activity.get('distance') / 1_000,
-            }
 
-            # if existing workout - update activity details
-            if activity_id in all_existing_strava_activities:
-                workout = Workout.objects.get(strava_id=activity_id)
-                for key, value in props.items():
-                    setattr(workout, key, value)
-                workout.save()
-                cnt_updated_strava_activities += 1
-
-            # if a new workout - get activity details
-            else:
-                if strava_api_monitor.ok_workout_requests() is False:
-                    raise RateLimitExceeded("No Strava Workout API requests allowed anymore to keep enough balance for user linkage")
-
-                response = requests.get(
-                    url=f'https://www.strava.com/api/v3/activities/{activity_id}',
-                    headers={
-                        'Authorization': f'Bearer {access_token}',
-                    },
-                )
-                strava_api_monitor.log_request(response)
-                response.raise_for_status()
-                activity_details = response.json()
-
-                avg_heart_rate = activity_details.get('average_heartrate', 0)
-                props['kcal'] = kcal = activity_details.get('calories', activity_details.get('kilojoules', 0) / 4.18)
-                props['strava_intensity_avg_watts'] = avg_watt = activity_details.get('average_watts', 0)
-
-                # estimate intensity
-                max_heart_rate = 180
-                kcal_per_ten_minute = kcal / (max(activity.get('moving_time', 60 * 30), 60) / (60 * 10))
-                if avg_heart_rate > max_heart_rate * 0.85 or kcal_per_ten_minute > 120 or avg_watt > 300:
-                    props['intensity_category'] = 4
-                elif avg_heart_rate > max_heart_rate * 0.70 or kcal_per_ten_minute > 90 or avg_watt > 275:
-                    props['intensity_category'] = 3
-                elif avg_heart_rate > max_heart_rate * 0.60 or kcal_per_ten_minute > 75 or avg_watt > 225:
-                    props['intensity_category'] = 2
-                else:
-                    props['intensity_category'] = 1
-
-                Workout.objects.create(**props)
-                cnt_new_strava_activities += 1
+        # stored workouts of the activities on this page - looked up by the unique strava_id
+        existing_workouts = {i.strava_id: i for i in Workout.objects.filter(user=user, strava_id__in=[activity.get('id') for activity in activities])}
+
+        # details of the new activities are fetched in parallel - the executor is shared with the other users synced in parallel
+        new_ids = [activity.get('id') for activity in activities if activity.get('id') not in existing_workouts]
+        details = dict(zip(new_ids, _detail_executor().map(lambda activity_id: _strava_request('get', url=f'https://www.strava.com/api/v3/activities/{activity_id}', headers={'Authorization': f'Bearer {access_token}'}), new_ids)))
+
+        # insert new and update changed workouts of the page at once - unchanged activities are not written
+        props_lst = [_activity_props(activity, details.get(activity.get('id'))) for activity in activities]
+        created, updated = bulk_upsert_workouts(user, props_lst, existing=existing_workouts)
+        cnt_new_strava_activities += len(created)
+        cnt_updated_strava_activities += len(updated)
 
         if len(activities) < per_page:
             break
@@ -191,4 +232,70 @@ def sync_strava(self, user__id, start_datetime=None):
         user.save()
     print(f'User {user__id} - fetched {cnt_new_strava_activities} new strava activities and updated {cnt_updated_strava_activities} existing strava activities')
 
-    return {'user': user__id, 'total_activities': (page - 1) * per_page + len(activities), 'new_activities': cnt_new_strava_activities, 'updated_activities': cnt_updated_strava_activities, 'sync_time': strava_last_synced_at}
\ No newline at end of file
+    return {'user': user__id, 'total_activities': (page - 1) * per_page + len(activities), 'new_activities': cnt_new_strava_activities, 'updated_activities': cnt_updated_strava_activities, 'sync_time': strava_last_synced_at}
+
+
+def deauthorize_strava(user):
+    """ forget the Strava linkage of a user """
+    setattr(user, 'strava_refresh_token', None)
+    setattr(user, 'strava_athlete_id', None)
+    user.save()
+    cache.delete(f"strava_access_token_{user.pk}")
+
+
+@app.task(bind=True, max_retries=10)
+def process_strava_event(self, event):
+    """ apply one event of the Strava push subscription - only the changed activity is fetched """
+    CustomUser = get_user_model()
+    user = CustomUser.objects.filter(strava_athlete_id=event.get('owner_id'), strava_refresh_token__isnull=False).first()
+    if user is None:
+        print(f"Strava event for unlinked athlete {event.get('owner_id')} ignored")
+        return None
+
+    # events are not signed - anybody knowing an athlete id can post one, so deletions and deauthorizations are confirmed with Strava first
+    object_id = event.get('object_id')
+    if event.get('object_type') == 'athlete':
+        if str((event.get('updates') or {}).get('authorized', '')).lower() != 'false':
+            return None
+        try:
+            _access_token(user, refresh=True)
+        except RateLimitExceeded as exc:
+            raise self.retry(exc=exc, countdown=_seconds_until_next_interval() + 60)  # retry in next Strava 15min api period
+        except requests.HTTPError as exc:
+            if exc.response is None or exc.response.status_code not in (400, 401):
+                raise
+            deauthorize_strava(user)
+            print(f'User {user.pk} - deauthorized Strava')
+            return {'user': user.pk, 'deauthorized': True}
+        print(f'User {user.pk} - Strava deauthorization event ignored as the refresh token is still valid')
+        return {'user': user.pk, 'deauthorized': False}
+
+    try:
+        activity = _strava_request(
+            'get',
+            url=f'https://www.strava.com/api/v3/activities/{object_id}',
+            headers={
+                'Authorization': f'Bearer {_access_token(user)}',
+            },
+        )
+    except RateLimitExceeded as exc:
+        raise self.retry(exc=exc, countdown=_seconds_until_next_interval() + 60)  # retry in next Strava 15min api period
+    except requests.HTTPError as exc:
+        if exc.response is None or exc.response.status_code != 404:
+            raise
+        activity = None
+
+    # only an activity Strava does not know anymore is deleted - otherwise the event is applied like an update
+    if activity is None:
+        deleted = 0
+        for workout in Workout.objects.filter(user=user, strava_id=object_id):
+            workout.delete()
+            deleted += 1
+        print(f'User {user.pk} - deleted {deleted} strava activities')
+        return {'user': user.pk, 'deleted_activities': deleted}
+
+    # the activity details are all fields of the activity - kcal and intensity are only taken for new workouts like in sync_strava
+    existing_workouts = {i.strava_id: i for i in Workout.objects.filter(user=user, strava_id=object_id)}
+    created, updated = bulk_upsert_workouts(user, [_activity_props(activity, None if object_id in existing_workouts else activity)], existing=existing_workouts)
+    print(f'User {user.pk} - strava event {event.get("aspect_type")} of activity {object_id}: {len(created)} new, {len(updated)} updated')
+    return {'user': user.pk, 'new_activities': len(created), 'updated_activities': len(updated)}
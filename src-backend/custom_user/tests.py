@@ -1,3 +1,514 @@
-from django.test import TestCase
+import datetime, random, time
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+
+import requests
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from competition.models import Competition, ActivityGoal, Points
+from workouts.models import Workout
+from .models import CustomUser, ScorerCheckpoint, RecalcRequest
+from health_competition.celery import singleton_task, _RedisLease
+from .recalc_queue import DatabaseRecalcQueue, RedisRecalcQueue, get_recalc_queue
+from .point_recalc import recalc_user_goal_points, recalc_points, recalc_points_shard, Scorer
+from .window_recalc import use_window_recalc, window_recalc_capable, window_recalc_points
+from .api_rate_limiter import APIRequestMonitor, RedisAPIRequestMonitor, RateLimitExceeded, get_strava_api_monitor
+from .strava import sync_strava, process_strava_event, close_strava_pool, _session, _detail_executor
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+# in-process backends - the tests do not depend on DEBUG or a running Redis
+local_backends = override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    RECALC_QUEUE_BACKEND='custom_user.recalc_queue.DatabaseRecalcQueue',
+    STRAVA_RATE_LIMITER_BACKEND='custom_user.api_rate_limiter.APIRequestMonitor',
+)
+
 
 # Create your tests here.
+class ScorerTest(SimpleTestCase):
+    LIMITS = {key: None for key in ('min_per_workout', 'max_per_workout', 'min_per_day', 'max_per_day', 'min_per_week', 'max_per_week')}
+
+    def test_scorer(self):
+        for goal_kwargs, points, expected_result in (
+            ({'goal': 100, 'min_per_workout': 10}, [10], 0),
+            ({'goal': 100, 'min_per_workout': 10}, [20], 10),
+            ({'goal': 100, 'max_per_workout': 30}, [30], 30),
+            ({'goal': 100, 'max_per_workout': 30}, [40], 30),
+            ({'goal': 100, 'min_per_workout': 10, 'max_per_workout': 30}, [40], 20),
+            ({'goal': 100, 'min_per_day': 10}, [10], 0),
+            ({'goal': 100, 'min_per_day': 10}, [20], 10),
+            ({'goal': 100, 'min_per_day': 10}, [8, 8], 6),
+            ({'goal': 100, 'max_per_day': 30}, [20], 20),
+            ({'goal': 100, 'max_per_day': 30}, [20, 20], 30),
+            ({'goal': 100, 'min_per_day': 10, 'max_per_day': 30}, [8, 12, 8, 8, 14], 20),
+            ({'goal': 100, 'min_per_week': 10}, [10], 0),
+            ({'goal': 100, 'min_per_week': 10}, [20], 10),
+            ({'goal': 100, 'max_per_week': 30}, [20], 20),
+            ({'goal': 100, 'max_per_week': 30}, [20, 20], 30),
+            ({'goal': 100, 'min_per_week': 10, 'max_per_week': 30}, [8, 12, 8, 8, 14], 20),
+            ({'goal': 100, 'min_per_workout': 10, 'min_per_day': 20}, [5, 20, 5, 20], 15),
+            ({'goal': 100, 'min_per_workout': 20, 'min_per_day': 10}, [5, 30, 30], 20),
+            ({'goal': 100, 'max_per_workout': 20, 'max_per_day': 30}, [20, 25, 25, 25], 30),
+            ({'goal': 100, 'max_per_workout': 30, 'max_per_day': 20}, [20, 25, 25, 25], 20),
+            ({'goal': 100, 'min_per_workout': 10, 'max_per_day': 15}, [5, 5, 5, 5], 0),
+            ({'goal': 100, 'min_per_workout': 10, 'max_per_day': 30}, [15, 35, 5, 15], 30),
+        ):
+            with self.subTest(goal=goal_kwargs, points=points):
+                workout = SimpleNamespace(start_datetime=datetime.datetime.fromisoformat('2023-01-01T00:00:00'))
+                goal = SimpleNamespace(**{**self.LIMITS, **goal_kwargs})
+
+                scorer = Scorer()
+                scorer.set_goal(goal)
+                self.assertEqual(sum(scorer.calculate_points(SimpleNamespace(points_raw=point, workout=workout)) for point in points), expected_result)
+
+                scorer = Scorer()
+                scorer.set_goal(goal)
+                self.assertEqual(scorer.calculate_batch(raw_points=points, timestamps=[workout.start_datetime] * len(points)).sum(), expected_result)
+
+
+@local_backends
+class SingletonTaskTest(SimpleTestCase):
+    def test_skip_while_running(self):
+        @singleton_task(lease=1)
+        def task(nested=False):
+            if nested:
+                return 'ran'
+            time.sleep(1.5)  # outlives the lease - kept alive by the heartbeat
+            return task(nested=True)
+
+        self.assertEqual(task(), 'Skipped because it is already running.')
+        self.assertEqual(task(nested=True), 'ran')
+
+
+@skipUnless(fakeredis, 'fakeredis[lua] is not installed')
+class RedisLeaseTest(SimpleTestCase):
+    def test_compare_and_expire(self):
+        connection = fakeredis.FakeRedis()
+        lease = _RedisLease('lease', connection=connection)
+        self.assertTrue(lease.acquire('a', 60))
+        self.assertFalse(lease.acquire('b', 60))
+
+        # a lease taken over by another run is neither renewed nor released
+        connection.set('lease', 'b', px=60_000)
+        self.assertFalse(lease.renew('a', 120))
+        lease.release('a')
+        self.assertEqual(connection.get('lease'), b'b')
+
+        self.assertTrue(lease.renew('b', 120))
+        self.assertGreater(connection.pttl('lease'), 60_000)
+        lease.release('b')
+        self.assertFalse(connection.exists('lease'))
+
+@local_backends
+class RecalcTestCase(TestCase):
+    """ test case with a competition and a user - celery tasks are not sent to the broker """
+
+    def setUp(self):
+        for target in ('custom_user.models.welcome_email', 'custom_user.point_recalc.recalc_points.apply_async'):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        cache.clear()
+        get_recalc_queue.cache_clear()
+        get_strava_api_monitor.cache_clear()
+
+        self.user = CustomUser.objects.create_user(email='user@test.local', password='password', first_name='Test')
+        self.competition = Competition.objects.create(owner=self.user, name='Test Competition', start_date=datetime.date(2024, 1, 1), end_date=datetime.date(2024, 3, 31))
+        self.goals = list(self.competition.activitygoal_set.order_by('id'))
+
+    def add_workouts(self, n, user=None):
+        start_datetime = timezone.make_aware(datetime.datetime(2024, 1, 1, 7, 0))
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(n):
+                Workout(user=self.user if user is None else user, sport_type='Run', intensity_category=2, start_datetime=start_datetime + datetime.timedelta(hours=9 * i), duration=datetime.timedelta(minutes=20 + i % 50)).save()
+
+    def assert_points_match_scorer(self, goal, user=None):
+        scorer = Scorer()
+        scorer.set_goal(goal)
+        for points in Points.objects.filter(goal=goal, workout__user=self.user if user is None else user).select_related('workout').order_by('workout__start_datetime', 'workout__id'):
+            self.assertAlmostEqual(float(points.points_capped), float(scorer.calculate_points(points)), places=2)
+
+
+class RecalcPointsTest(RecalcTestCase):
+    def test_recalc_matches_scorer(self):
+        self.add_workouts(60)
+        goal = self.goals[0]
+
+        with self.assertNumQueries(18):
+            recalc_user_goal_points(user_id=self.user.pk, goal=goal, start_datetime=self.competition.start_date, chunk_size=25)
+        self.assert_points_match_scorer(goal)
+
+        with self.assertNumQueries(13):
+            self.assertEqual(recalc_user_goal_points(user_id=self.user.pk, goal=goal, start_datetime=self.competition.start_date), 0)
+
+    def test_recalc_resumes_from_checkpoint(self):
+        self.add_workouts(60)
+        goal = self.goals[0]
+        recalc_user_goal_points(user_id=self.user.pk, goal=goal, start_datetime=self.competition.start_date)
+
+        # edit a workout in the middle of a week - only that week needs to be scored again
+        points = Points.objects.filter(goal=goal).select_related('workout').order_by('workout__start_datetime')[30]
+        Points.objects.filter(pk=points.pk).update(points_raw=55, points_capped=55)
+        start_date = points.workout.start_datetime.date()
+        self.assertTrue(ScorerCheckpoint.objects.filter(user=self.user, goal=goal, day__lt=start_date, day__gte=start_date - datetime.timedelta(days=start_date.weekday())).exists())
+
+        recalc_user_goal_points(user_id=self.user.pk, goal=goal, start_datetime=points.workout.start_datetime)
+        self.assert_points_match_scorer(goal)
+
+
+class RecalcShardTest(RecalcTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('custom_user.point_recalc.group')
+        self.group = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_claim_and_fan_out(self):
+        self.add_workouts(20)
+        RecalcRequest.objects.all().delete()
+        for goal in self.goals:
+            RecalcRequest(user=self.user, goal=goal, start_datetime=timezone.now() - datetime.timedelta(days=1)).save()
+            RecalcRequest(user=self.user, goal=goal, start_datetime=timezone.make_aware(datetime.datetime(2024, 1, 1))).save()
+
+        recalc_points()
+        shards = list(self.group.call_args.args[0])
+        self.assertEqual(len(shards), len(self.goals))
+        self.assertFalse(RecalcRequest.objects.filter(done=False).exists())
+
+        # claimed (user, goal) pairs are not handed out twice while their shard is running
+        RecalcRequest(user=self.user, goal=self.goals[0], start_datetime=timezone.now()).save()
+        recalc_points()
+        self.assertEqual(list(self.group.call_args.args[0]), [])
+
+        for shard in shards:
+            shard.apply()
+        self.assertEqual(RecalcRequest.objects.filter(done=True).count(), 0)
+        self.assertEqual(RecalcRequest.objects.filter(done=False).count(), 1)
+        self.assert_points_match_scorer(self.goals[0])
+
+    def test_debounce(self):
+        RecalcRequest.objects.all().delete()
+        queue = DatabaseRecalcQueue()
+        queue.enqueue_many([(self.user.pk, self.goals[0].pk, timezone.now())])
+
+        # nothing is claimed before the debounce is over - the next run is scheduled for the due time
+        claims, next_due = queue.claim()
+        self.assertEqual(claims, [])
+        self.assertEqual(next_due, RecalcRequest.objects.get().due)
+        self.assertGreater(next_due, timezone.now())
+
+        RecalcRequest.objects.update(due=timezone.now())
+        claims, next_due = queue.claim()
+        self.assertEqual([(i['user'], i['goal']) for i in claims], [(self.user.pk, self.goals[0].pk)])
+        self.assertIsNone(next_due)
+
+        # a released claim is due right away
+        queue.release(claims[0]['token'])
+        claims, _ = queue.claim()
+        self.assertEqual(len(claims), 1)
+
+
+class WindowRecalcTest(RecalcTestCase):
+    """ differential test of the window function engine against the Scorer on randomized workout streams """
+
+    def random_goal(self, rng):
+        limits = {}
+        for period in ('workout', 'day', 'week'):
+            floor = rng.choice([None, None, rng.uniform(1, 15)])
+            cap = rng.choice([None, None, rng.uniform(10, 80)])
+            limits[f'min_per_{period}'] = None if floor is None else round(floor, 2)
+            limits[f'max_per_{period}'] = None if cap is None else round(cap + (floor or 0), 2)
+        return ActivityGoal(competition=self.competition, name='Random', metric='min', goal=rng.choice([50, 100, 150]), period='week', **limits)
+
+    def random_stream(self, rng, user, n):
+        start_datetime = timezone.make_aware(datetime.datetime(2024, 1, 1, 0, 0))
+        workouts = []
+        for _ in range(n):
+            start_datetime += datetime.timedelta(hours=rng.choice([0, 1, 3, 8, 20, 30, 100]))
+            workouts.append(Workout(user=user, sport_type='Run', intensity_category=2, start_datetime=start_datetime, duration=datetime.timedelta(minutes=30)))
+        return Workout.objects.bulk_create(workouts)
+
+    def test_matches_scorer(self):
+        rng = random.Random(42)
+        users = [self.user] + [CustomUser.objects.create_user(email=f'user{i}@test.local', password='password', first_name=f'User{i}') for i in range(2)]
+        goals = ActivityGoal.objects.bulk_create([self.random_goal(rng) for _ in range(40)])
+        goals = list(ActivityGoal.objects.filter(pk__in=[goal.pk for goal in goals]))  # limits as Decimal like in production
+        workouts = [workout for user in users for workout in self.random_stream(rng, user, 40)]
+        Points.objects.bulk_create([Points(goal=goal, workout=workout, points_raw=round(rng.choice([0, rng.uniform(0, 40)]), 2)) for goal in goals for workout in workouts])
+
+        with self.assertNumQueries(1):
+            window_recalc_points()
+
+        for goal in goals:
+            if window_recalc_capable(goal):
+                for user in users:
+                    self.assert_points_match_scorer(goal, user)
+            else:
+                self.assertFalse(Points.objects.filter(goal=goal, points_capped__isnull=False).exists())
+
+    def test_week_start(self):
+        self.add_workouts(60)
+        goal = self.goals[0]
+        recalc_user_goal_points(user_id=self.user.pk, goal=goal, start_datetime=self.competition.start_date)
+        Points.objects.filter(goal=goal).update(points_capped=None)
+
+        # only the points after the week start are touched
+        week_start = timezone.make_aware(datetime.datetime(2024, 1, 15))
+        window_recalc_points(user_id=self.user.pk, goal_id=goal.pk, start_datetime=week_start)
+        self.assertFalse(Points.objects.filter(goal=goal, workout__start_datetime__gte=week_start, points_capped__isnull=True).exists())
+        self.assertFalse(Points.objects.filter(goal=goal, workout__start_datetime__lt=week_start, points_capped__isnull=False).exists())
+        scorer_points = {points.pk: float(points.points_capped) for points in Points.objects.filter(goal=goal, workout__start_datetime__gte=week_start)}
+        recalc_user_goal_points(user_id=self.user.pk, goal=goal, start_datetime=self.competition.start_date)
+        for points in Points.objects.filter(goal=goal, workout__start_datetime__gte=week_start):
+            self.assertAlmostEqual(float(points.points_capped), scorer_points[points.pk], places=2)
+
+
+    @skipUnless(connection.vendor == 'postgresql', 'the window engine only runs on Postgres - run the tests with POSTGRES_HOST set')
+    @override_settings(RECALC_ENGINE='window')
+    def test_postgres_engine(self):
+        self.add_workouts(60)
+        for goal in self.goals:
+            self.assertEqual(use_window_recalc(goal), window_recalc_capable(goal))
+            recalc_user_goal_points(user_id=self.user.pk, goal=goal, start_datetime=self.competition.start_date)
+            self.assert_points_match_scorer(goal)
+
+@skipUnless(fakeredis, 'fakeredis[lua] is not installed')
+class RedisRecalcQueueTest(SimpleTestCase):
+    def setUp(self):
+        self.queue = RedisRecalcQueue(connection=fakeredis.FakeRedis(), debounce=0, claim_timeout=60)
+
+    def test_coalesce_and_claim(self):
+        now = timezone.now()
+        self.queue.enqueue_many([(1, 2, now), (1, 2, now - datetime.timedelta(days=3)), (1, 3, now)])
+        claims, next_due = self.queue.claim()
+        self.assertEqual(sorted((i['user'], i['goal']) for i in claims), [(1, 2), (1, 3)])
+        self.assertEqual({i['goal']: i['start_datetime'] for i in claims}[2], now - datetime.timedelta(days=3))
+        self.assertIsNone(next_due)
+
+        # claimed pairs are skipped until the shard completes
+        self.queue.enqueue(1, 2, now - datetime.timedelta(days=10))
+        self.assertEqual(self.queue.claim()[0], [])
+        self.assertTrue(self.queue.complete('1:2'))
+        self.assertFalse(self.queue.complete('1:3'))
+        self.assertEqual([i['start_datetime'] for i in self.queue.claim()[0]], [now - datetime.timedelta(days=10)])
+
+        # failed shards give their claim back
+        self.queue.release('1:2')
+        self.assertEqual([i['token'] for i in self.queue.claim()[0]], ['1:2'])
+
+    def test_debounce_per_key(self):
+        self.queue.debounce = 60
+        self.queue.enqueue(1, 2, timezone.now())
+        claims, next_due = self.queue.claim()
+        self.assertEqual(claims, [])
+        self.assertGreater(next_due, timezone.now())
+
+
+class StravaTestCase(RecalcTestCase):
+    """ test case with a fake Strava API """
+
+    def setUp(self):
+        super().setUp()
+        self.activities = [
+            {'id': 1_000 + i, 'sport_type': 'Run', 'start_date': f'2024-01-{10 + i}T07:00:00+00:00', 'moving_time': 60 * (30 + i), 'distance': 5_000.0 + i}
+            for i in range(5)
+        ]
+        self.requested = []
+        self.token_revoked = False
+        patcher = mock.patch('custom_user.strava._session', return_value=mock.Mock(request=mock.Mock(side_effect=self.fake_request)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.monitor = APIRequestMonitor(limit_15min=1_000, limit_day=10_000)
+        patcher = mock.patch('custom_user.strava.get_strava_api_monitor', return_value=self.monitor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.set(f'strava_access_token_{self.user.pk}', 'token')
+
+    def fake_request(self, method, url, headers=None, params=None, **kwargs):
+        self.requested.append(url)
+        if url.endswith('/oauth/token'):
+            if self.token_revoked:
+                return self.error_response(400)
+            body = {'access_token': 'token', 'expires_in': 21600}
+        elif url.endswith('/athlete/activities'):
+            per_page = params['per_page']
+            body = self.activities[(params['page'] - 1) * per_page:params['page'] * per_page]
+        else:
+            activity_id = int(url.rsplit('/', 1)[1])
+            activity = next((i for i in self.activities if i['id'] == activity_id), None)
+            if activity is None:
+                return self.error_response(404)
+            body = dict(activity, calories=300, average_heartrate=120)
+        return mock.Mock(status_code=200, json=mock.Mock(return_value=body), raise_for_status=mock.Mock())
+
+    @staticmethod
+    def error_response(status_code):
+        response = mock.Mock(status_code=status_code, headers={})
+        response.raise_for_status = mock.Mock(side_effect=requests.HTTPError(response=response))
+        return response
+
+
+class StravaSyncTest(StravaTestCase):
+    def sync(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return sync_strava(user__id=self.user.pk)
+
+    def test_sync(self):
+        result = self.sync()
+        self.assertEqual((result['new_activities'], result['updated_activities']), (5, 0))
+        self.assertEqual(Workout.objects.filter(user=self.user).count(), 5)
+        self.assertEqual(Points.objects.filter(workout__user=self.user).count(), 5 * len(self.goals))
+
+        # changed activities update the stored workouts - the existence check only reads the ids of this user's page
+        self.activities[0]['moving_time'] = 60 * 90
+        with CaptureQueriesContext(connection) as context:
+            result = self.sync()
+        self.assertFalse([i['sql'] for i in context.captured_queries if i['sql'].startswith('SELECT') and i['sql'].endswith('FROM "workouts_workout"')])
+        self.assertEqual((result['new_activities'], result['updated_activities']), (0, 1))
+        self.assertEqual(Workout.objects.get(strava_id=1_000).duration, datetime.timedelta(minutes=90))
+        self.assertEqual(len([i for i in self.requested if not i.endswith('/athlete/activities')]), 5)
+        self.assertEqual(self.monitor.count_requests()['requests_today'], len(self.requested))
+        self.assertAlmostEqual(float(Points.objects.get(workout__strava_id=1_000, goal__metric='min').points_raw), 90 / float(Points.objects.get(workout__strava_id=1_000, goal__metric='min').goal.goal) * 100, delta=0.006)
+
+    def test_resync_without_changes(self):
+        self.sync()
+        RecalcRequest.objects.all().delete()
+
+        # only the sync time of the user is written
+        with CaptureQueriesContext(connection) as context:
+            result = self.sync()
+        self.assertEqual((result['new_activities'], result['updated_activities']), (0, 0))
+        writes = [i['sql'] for i in context.captured_queries if i['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+        self.assertEqual([i for i in writes if 'custom_user_customuser' not in i.split(' SET ')[0]], [])
+        self.assertFalse(RecalcRequest.objects.exists())
+
+
+class StravaPoolTest(SimpleTestCase):
+    def test_shared_session_and_executor(self):
+        self.addCleanup(close_strava_pool)
+        session = _session()
+        self.assertIs(_session(), session)
+        self.assertEqual(session.get_adapter('https://www.strava.com')._pool_maxsize, settings.STRAVA_SYNC_CONCURRENCY)
+        self.assertIs(_detail_executor(), _detail_executor())
+
+        # closed on shutdown - recreated on the next use
+        close_strava_pool()
+        self.assertIsNot(_session(), session)
+
+
+@override_settings(STRAVA_WEBHOOK_VERIFY_TOKEN='verify', STRAVA_WEBHOOK_SUBSCRIPTION_ID=7)
+class StravaWebhookTest(StravaTestCase):
+    def setUp(self):
+        super().setUp()
+        CustomUser.objects.filter(pk=self.user.pk).update(strava_athlete_id=42, strava_refresh_token='refresh')
+        # the worker processes the queued events right away
+        patcher = mock.patch('custom_user.views.process_strava_event.delay', side_effect=lambda event: process_strava_event(event=event))
+        self.queued = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+
+    def send(self, aspect_type, object_id=1_000, object_type='activity', **event):
+        event = dict({'object_type': object_type, 'object_id': object_id, 'aspect_type': aspect_type, 'owner_id': 42, 'subscription_id': 7, 'event_time': 0, 'updates': {}}, **event)
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/strava/webhook/', event, format='json')
+
+    def test_validation(self):
+        response = self.client.get('/api/strava/webhook/', {'hub.mode': 'subscribe', 'hub.verify_token': 'verify', 'hub.challenge': 'abc'})
+        self.assertEqual((response.status_code, response.data), (200, {'hub.challenge': 'abc'}))
+        self.assertEqual(self.client.get('/api/strava/webhook/', {'hub.mode': 'subscribe', 'hub.verify_token': 'wrong', 'hub.challenge': 'abc'}).status_code, 403)
+        self.assertEqual(self.send('create', subscription_id=8).status_code, 403)
+        self.assertEqual(self.send('archive').status_code, 400)
+        self.queued.assert_not_called()
+
+    def test_activity_events(self):
+        self.assertEqual(self.send('create').status_code, 200)
+        workout = Workout.objects.get(user=self.user, strava_id=1_000)
+        self.assertEqual(Points.objects.filter(workout=workout).count(), len(self.goals))
+        # only the changed activity is fetched
+        self.assertEqual(self.requested, ['https://www.strava.com/api/v3/activities/1000'])
+
+        self.activities[0]['moving_time'] = 60 * 90
+        self.send('update')
+        workout.refresh_from_db()
+        self.assertEqual(workout.duration, datetime.timedelta(minutes=90))
+        self.assertEqual(Workout.objects.filter(user=self.user).count(), 1)
+
+        del self.activities[0]
+        self.send('delete')
+        self.assertFalse(Workout.objects.filter(user=self.user).exists())
+        self.assertFalse(Points.objects.exists())
+
+    def test_forged_events(self):
+        # a delete of an activity Strava still has is applied like an update
+        self.send('create')
+        self.send('delete')
+        self.assertTrue(Workout.objects.filter(user=self.user, strava_id=1_000).exists())
+        self.assertEqual(self.requested[-1], 'https://www.strava.com/api/v3/activities/1000')
+
+        # a deauthorization is ignored while Strava still accepts the refresh token
+        self.send('update', object_type='athlete', object_id=42, updates={'authorized': 'false'})
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.strava_refresh_token)
+        self.assertEqual(self.requested[-1], 'https://www.strava.com/oauth/token')
+
+        # events are only accepted with the configured subscription
+        with override_settings(STRAVA_WEBHOOK_SUBSCRIPTION_ID=None):
+            self.assertEqual(self.send('delete').status_code, 403)
+
+    def test_deauthorization(self):
+        # athlete events without updates change nothing
+        self.assertIsNone(process_strava_event(event={'object_type': 'athlete', 'object_id': 42, 'aspect_type': 'update', 'owner_id': 42}))
+        self.assertEqual(self.send('update', object_type='athlete', object_id=42, updates=None).status_code, 200)
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.strava_refresh_token)
+
+        self.token_revoked = True
+        self.send('update', object_type='athlete', object_id=42, updates={'authorized': 'false'})
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.strava_refresh_token, self.user.strava_athlete_id), (None, None))
+        self.assertIsNone(cache.get(f'strava_access_token_{self.user.pk}'))
+
+        # events of unlinked athletes are ignored
+        self.send('create')
+        self.assertFalse(Workout.objects.exists())
+
+
+@skipUnless(fakeredis, 'fakeredis[lua] is not installed')
+class RedisAPIRequestMonitorTest(SimpleTestCase):
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        # two monitors on one Redis stand for two worker processes
+        self.monitors = [RedisAPIRequestMonitor(connection=fakeredis.FakeRedis(server=server), limit_15min=10, limit_day=100) for _ in range(2)]
+
+    def test_shared_budget(self):
+        for i in range(6):
+            self.monitors[i % 2].acquire('workout')
+        self.assertEqual(self.monitors[0].count_requests(), {'requests_15min': 6, 'requests_today': 6})
+        with self.assertRaises(RateLimitExceeded):
+            self.monitors[1].acquire('workout')
+        self.assertFalse(self.monitors[0].ok_workout_requests())
+
+        # the linkage reservation is still available
+        self.assertTrue(self.monitors[1].ok_linkage_requests())
+        for i in range(4):
+            self.monitors[i % 2].acquire('linkage')
+        with self.assertRaises(RateLimitExceeded):
+            self.monitors[0].acquire('linkage')
+
+    def test_strava_usage(self):
+        self.monitors[0].log_response(mock.Mock(status_code=200, headers={'X-RateLimit-Usage': '4,50'}))
+        self.assertEqual(self.monitors[1].count_requests(), {'requests_15min': 4, 'requests_today': 50})
+        with self.assertRaises(RateLimitExceeded):
+            self.monitors[0].log_response(mock.Mock(status_code=429, headers={}))
+        self.assertFalse(self.monitors[1].ok_linkage_requests())
@@ -3,7 +3,7 @@ import requests
 from rest_framework import viewsets
 from rest_framework.permissions import BasePermission, IsAdminUser, SAFE_METHODS, AllowAny
 from rest_framework.permissions import IsAuthenticated
-from django.db.models import Q
+from django.db.models import Q, Prefetch
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
@@ -11,6 +11,7 @@ from celery.exceptions import TimeoutError
 from django.utils import timezone
 from django_filters.rest_framework import DjangoFilterBackend
 from django.shortcuts import get_object_or_404
+from django.apps import apps
 from django.conf import settings
 from django.core.cache import cache
 
@@ -18,7 +19,8 @@ from .serializers import PasswordResetSerializer, PasswordResetConfirmSerializer
 from .models import CustomUser
 from .serializers import CustomUserSerializer
 from .filters import CustomUserFilter
-from .strava import sync_strava
+from .strava import sync_strava, process_strava_event, deauthorize_strava
+from .api_rate_limiter import get_strava_api_monitor, RateLimitExceeded
 
 class IsOwnerOrReadOnly(BasePermission):
     """ Permission class to only allow admins and owner to edit or delete entry """
@@ -71,7 +73,17 @@ class CustomUserViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         # return all competitions the user is owner of or a participant of
         #time.sleep(3)  # throttle for testing
-        return CustomUser.objects.filter(Q(pk=self.request.user.pk) | Q(my_competitions__in=self.request.user.my_competitions.all())).distinct().order_by('username', 'id')
+        Competition = apps.get_model('competition', 'Competition')
+        Team = apps.get_model('competition', 'Team')
+
+        # co-members as IN subquery instead of a join needing DISTINCT, m2m ids prefetched for my_competitions / my_teams
+        co_members = CustomUser.my_competitions.through.objects.filter(competition__in=self.request.user.my_competitions.values('pk')).values('customuser')
+        return (
+            CustomUser.objects
+            .filter(Q(pk=self.request.user.pk) | Q(pk__in=co_members))
+            .prefetch_related(Prefetch('my_competitions', queryset=Competition.objects.only('id')), Prefetch('my_teams', queryset=Team.objects.only('id')))
+            .order_by('username', 'id')
+        )
 
     def get_object(self):
         lookup_value = self.kwargs.get(self.lookup_field)
@@ -117,15 +129,22 @@ class LinkStravaView(APIView):
         if client_id == 1234321 or client_secret == "ReplaceWithClientSecret":
             return Response({"message": "Sever configuration error - STRAVA_CLIENT_ID and/or STRAVA_CLIENT_SECRET are not set."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-        response = requests.post(
-            url='https://www.strava.com/oauth/token',
-            data={
-                'client_id': client_id,
-                'client_secret': client_secret,
-                'code': code,
-                'grant_type': 'authorization_code'
-            }
-        )
+        # linkage has its own reservation of the Strava budget that workout syncs can't use up
+        strava_api_monitor = get_strava_api_monitor()
+        try:
+            strava_api_monitor.acquire('linkage')
+            response = requests.post(
+                url='https://www.strava.com/oauth/token',
+                data={
+                    'client_id': client_id,
+                    'client_secret': client_secret,
+                    'code': code,
+                    'grant_type': 'authorization_code'
+                }
+            )
+            strava_api_monitor.log_response(response)
+        except RateLimitExceeded:
+            return Response({"message": "Too many requests to Strava at the moment. Please try again in 15 minutes."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
         if response.ok is False:
             return Response({"message": "Invalid Strava linkage code"}, status=status.HTTP_400_BAD_REQUEST)
@@ -156,14 +175,38 @@ class UnlinkStravaView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        user = request.user
-        setattr(user, 'strava_refresh_token', None)
-        setattr(user, 'strava_athlete_id', None)
-        user.save()
+        deauthorize_strava(request.user)
 
         return Response({"message": "Successfully unlinked Strava."}, status=status.HTTP_200_OK)
 
 
+class StravaWebhookView(APIView):
+    """ API view for the Strava push subscription - validation handshake (get) and activity / athlete events (post). """
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+    def get(self, request):
+        verify_token = settings.STRAVA_WEBHOOK_VERIFY_TOKEN
+        if verify_token is None or request.query_params.get('hub.mode') != 'subscribe' or request.query_params.get('hub.verify_token') != verify_token:
+            return Response({"message": "Invalid Strava webhook verification."}, status=status.HTTP_403_FORBIDDEN)
+        return Response({"hub.challenge": request.query_params.get('hub.challenge')}, status=status.HTTP_200_OK)
+
+    def post(self, request):
+        if settings.STRAVA_WEBHOOK_VERIFY_TOKEN is None:
+            return Response({"message": "Strava webhook is not configured."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        event = {key: request.data.get(key) for key in ('object_type', 'object_id', 'aspect_type', 'owner_id', 'subscription_id', 'event_time', 'updates')}
+        subscription_id = settings.STRAVA_WEBHOOK_SUBSCRIPTION_ID
+        if subscription_id is None or event['subscription_id'] != subscription_id:
+            return Response({"message": "Unknown Strava subscription."}, status=status.HTTP_403_FORBIDDEN)
+        if event['object_type'] not in ('activity', 'athlete') or event['aspect_type'] not in ('create', 'update', 'delete') or event['object_id'] is None or event['owner_id'] is None:
+            return Response({"message": "Invalid Strava event."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Strava expects an answer within 2 seconds - the event is processed by a worker
+        process_strava_event.delay(event=event)
+        return Response({"message": "Event received."}, status=status.HTTP_200_OK)
+
+
 class SyncStravaView(APIView):
     """ API get view for users to sync Strava. """
     permission_classes = [IsAuthenticated]
@@ -0,0 +1,133 @@
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+
+
+# points_capped of every selected point as running sums - same steps as Scorer.calculate_batch:
+# workout floor/cap -> day floor -> day cap -> week floor -> week cap
+# a cap is applied as the capped running total of its day/week minus the capped running total before the workout
+WINDOW_RECALC_SQL = """
+WITH base AS (
+    SELECT
+        p.id, w.user_id, p.goal_id, w.start_datetime, w.id AS workout_id,
+        CAST(ROUND(p.points_raw, 2) AS {float}) AS points_raw,
+        {day} AS day, {week} AS week,
+        CAST(COALESCE(g.min_per_workout, 0) * 100.0 / g.goal AS {float}) AS floor_workout,
+        CAST(g.max_per_workout * 100.0 / g.goal AS {float}) AS cap_workout,
+        CAST(COALESCE(g.min_per_day, 0) * 100.0 / g.goal AS {float}) AS floor_day,
+        CAST(g.max_per_day * 100.0 / g.goal AS {float}) AS cap_day,
+        CAST(COALESCE(g.min_per_week, 0) * 100.0 / g.goal AS {float}) AS floor_week,
+        CAST(g.max_per_week * 100.0 / g.goal AS {float}) AS cap_week
+    FROM {points_table} p
+    JOIN {workout_table} w ON w.id = p.workout_id
+    JOIN {goal_table} g ON g.id = p.goal_id
+    WHERE {where} AND NOT (g.max_per_day IS NOT NULL AND COALESCE(g.min_per_week, 0) <> 0)
+),
+week_changes AS (
+    -- like the Scorer a new week starts whenever the week number differs from the previous workout
+    SELECT *, CASE WHEN LAG(week) OVER series = week THEN 0 ELSE 1 END AS new_week
+    FROM base
+    WINDOW series AS (PARTITION BY user_id, goal_id ORDER BY start_datetime, workout_id)
+),
+weeks AS (
+    SELECT *, SUM(new_week) OVER series AS week_id
+    FROM week_changes
+    WINDOW series AS (PARTITION BY user_id, goal_id ORDER BY start_datetime, workout_id ROWS UNBOUNDED PRECEDING)
+),
+day_floor AS (
+    SELECT *,
+        {greatest}({least}(
+            {least}({greatest}(points_raw - floor_workout, 0), COALESCE(cap_workout - floor_workout, {greatest}(points_raw - floor_workout, 0))),
+            SUM(points_raw) OVER day_window - floor_day
+        ), 0) AS points_day_floor,
+        SUM(points_raw) OVER week_window AS week_points_raw
+    FROM weeks
+    WINDOW
+        day_window AS (PARTITION BY user_id, goal_id, day ORDER BY start_datetime, workout_id ROWS UNBOUNDED PRECEDING),
+        week_window AS (PARTITION BY user_id, goal_id, week_id ORDER BY start_datetime, workout_id ROWS UNBOUNDED PRECEDING)
+),
+day_cap_totals AS (
+    SELECT *, {greatest}({least}(SUM(points_day_floor) OVER day_window, cap_day - floor_day), 0) AS day_points_capped
+    FROM day_floor
+    WINDOW day_window AS (PARTITION BY user_id, goal_id, day ORDER BY start_datetime, workout_id ROWS UNBOUNDED PRECEDING)
+),
+week_floor AS (
+    SELECT *,
+        {greatest}({least}(
+            CASE WHEN cap_day IS NULL THEN points_day_floor ELSE day_points_capped - COALESCE(LAG(day_points_capped) OVER day_window, 0) END,
+            week_points_raw - floor_week
+        ), 0) AS points_week_floor
+    FROM day_cap_totals
+    WINDOW day_window AS (PARTITION BY user_id, goal_id, day ORDER BY start_datetime, workout_id)
+),
+week_cap_totals AS (
+    SELECT *, {greatest}({least}(SUM(points_week_floor) OVER week_window, cap_week - floor_week), 0) AS week_points_capped
+    FROM week_floor
+    WINDOW week_window AS (PARTITION BY user_id, goal_id, week_id ORDER BY start_datetime, workout_id ROWS UNBOUNDED PRECEDING)
+),
+capped AS (
+    SELECT id, ROUND(CAST(
+        CASE WHEN cap_week IS NULL THEN points_week_floor ELSE week_points_capped - COALESCE(LAG(week_points_capped) OVER week_window, 0) END
+    AS NUMERIC), 2) AS points_capped
+    FROM week_cap_totals
+    WINDOW week_window AS (PARTITION BY user_id, goal_id, week_id ORDER BY start_datetime, workout_id)
+)
+UPDATE {points_table} SET points_capped = capped.points_capped
+FROM capped
+WHERE {points_table}.id = capped.id AND ({points_table}.points_capped IS NULL OR {points_table}.points_capped <> capped.points_capped)
+"""
+
+DIALECTS = {
+    'postgresql': {
+        'float': 'double precision',
+        'day': "CAST(w.start_datetime AT TIME ZONE 'UTC' AS date)",
+        'week': "EXTRACT(WEEK FROM w.start_datetime AT TIME ZONE 'UTC')",
+        'greatest': 'GREATEST',
+        'least': 'LEAST',
+    },
+    'sqlite': {
+        'float': 'REAL',
+        'day': 'date(w.start_datetime)',
+        # ISO week number = week of the year of the Thursday of the week
+        'week': "(CAST(strftime('%%j', date(w.start_datetime, '-3 days', 'weekday 4')) AS INTEGER) - 1) / 7 + 1",
+        'greatest': 'MAX',
+        'least': 'MIN',
+    },
+}
+
+
+def window_recalc_capable(goal):
+    """ whether the window functions can cap the goal - a week floor together with a day cap needs the sequential Scorer """
+    return goal.max_per_day is None or not goal.min_per_week
+
+
+def use_window_recalc(goal):
+    """ whether the points of the goal should be capped with window functions (settings.RECALC_ENGINE) """
+    return settings.RECALC_ENGINE == 'window' and connection.vendor == 'postgresql' and window_recalc_capable(goal)
+
+
+def window_recalc_points(user_id=None, goal_id=None, start_datetime=None):
+    """ set points_capped of all matching goal points with a single UPDATE - start_datetime has to be the start of a week - returns the number of changed points """
+    Points = apps.get_model('competition', 'Points')
+    Workout = apps.get_model('workouts', 'Workout')
+    ActivityGoal = apps.get_model('competition', 'ActivityGoal')
+
+    where, params = ['p.goal_id IS NOT NULL'], []
+    for condition, value in (('w.user_id = %s', user_id), ('p.goal_id = %s', goal_id)):
+        if value is not None:
+            where.append(condition)
+            params.append(value)
+    if start_datetime is not None:
+        where.append('w.start_datetime >= %s')
+        params.append(connection.ops.adapt_datetimefield_value(start_datetime))
+
+    sql = WINDOW_RECALC_SQL.format(
+        points_table=Points._meta.db_table,
+        workout_table=Workout._meta.db_table,
+        goal_table=ActivityGoal._meta.db_table,
+        where=' AND '.join(where),
+        **DIALECTS[connection.vendor],
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
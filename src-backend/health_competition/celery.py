@@ -1,6 +1,9 @@
 """Celery task config"""
 
 import os
+import functools
+import threading
+import uuid
 
 from celery import Celery
 from celery.schedules import crontab
@@ -20,7 +23,7 @@ app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
 
 app.conf.beat_schedule = {
-    # every morning import users strava workouts
+    # every morning import users strava workouts - only a reconciliation fallback with the Strava webhook (STRAVA_POLL_INTERVAL_HOURS)
     "strava_sync": {
         "task": "custom_user.strava.daily_strava_sync",
         "schedule": crontab(minute="44", hour="4"),
@@ -59,19 +62,109 @@ app.conf.beat_schedule = {
 }
 
 
-def is_task_already_executing(task_name: str) -> bool:
-    """Returns whether the task with given task_name is already being executed.
+class _CacheLease:
+    """Lease in the Django cache - check-then-act, only good enough for the single process LocMem cache of DEBUG setups"""
+
+    def __init__(self, key):
+        from django.core.cache import cache
+        self.cache = cache
+        self.key = key
+
+    def acquire(self, token, lease):
+        return self.cache.add(self.key, token, lease)
+
+    def renew(self, token, lease):
+        return self.cache.get(self.key) == token and self.cache.touch(self.key, lease)
+
+    def release(self, token):
+        if self.cache.get(self.key) == token:
+            self.cache.delete(self.key)
+
+
+class _RedisLease:
+    """Lease in Redis - renewed and released with compare-and-expire / compare-and-delete scripts"""
+
+    RENEW_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+        end
+        return 0
+    """
+
+    RELEASE_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, key, connection=None):
+        if connection is None:
+            from django.core.cache import cache
+            from django_redis import get_redis_connection
+            connection = get_redis_connection('default')
+            key = cache.make_key(key)
+        self.connection = connection
+        self.key = key
+        self._renew = connection.register_script(self.RENEW_SCRIPT)
+        self._release = connection.register_script(self.RELEASE_SCRIPT)
+
+    def acquire(self, token, lease):
+        return bool(self.connection.set(self.key, token, nx=True, px=int(lease * 1000)))
+
+    def renew(self, token, lease):
+        return bool(self._renew(keys=[self.key], args=[token, int(lease * 1000)]))
+
+    def release(self, token):
+        self._release(keys=[self.key], args=[token])
+
+
+def _lease(key):
+    """Lease of a singleton task - in Redis with django-redis, in the cache otherwise (DEBUG)"""
+    from django.conf import settings
+    if settings.CACHES['default']['BACKEND'].startswith('django_redis.'):
+        return _RedisLease(key)
+    return _CacheLease(key)
+
+
+def singleton_task(lease=60):
+    """Decorator letting only one instance of a Celery task run at a time.
+
+    The running task holds an expiring lease in Redis (SET NX) which a heartbeat
+    thread renews every lease / 3 seconds. If the worker dies, the lease runs out
+    and the next run of the task can start again.
 
     Args:
-        task_name: Name of the task to check if it is running currently.
-    Returns: A boolean indicating whether the task with the given task name is
-        running currently.
+        lease: Seconds the lock is held without a heartbeat.
+    Returns: The decorator - a skipped call returns 'Skipped because it is already running.'
     """
-    active_tasks = app.control.inspect().active()
-    task_count = 0
-    for worker, running_tasks in active_tasks.items():
-        for task in running_tasks:
-            if task["name"] == task_name:
-                task_count += 1
-
-    return task_count > 1
\ No newline at end of file
+    def decorator(func):
+        lock_key = f"celery_singleton_{func.__module__}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            lock = _lease(lock_key)
+            token = uuid.uuid4().hex
+            if not lock.acquire(token, lease):
+                print(f"Task {func.__name__} skipped because it is already running")
+                return "Skipped because it is already running."
+
+            stop_heartbeat = threading.Event()
+
+            def heartbeat():
+                while not stop_heartbeat.wait(lease / 3):
+                    if not lock.renew(token, lease):
+                        return
+
+            heartbeat_thread = threading.Thread(target=heartbeat, name=f"{lock_key}_heartbeat", daemon=True)
+            heartbeat_thread.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stop_heartbeat.set()
+                heartbeat_thread.join()
+                # only remove our own lease - it might have expired and been taken over meanwhile
+                lock.release(token)
+
+        return wrapper
+    return decorator
@@ -0,0 +1,14 @@
+from rest_framework.pagination import CursorPagination
+
+
+class StartDatetimeCursorPagination(CursorPagination):
+    """ keyset pagination newest first on start_datetime - only when a cursor or page_size is requested, the full list otherwise """
+    ordering = ('-start_datetime', '-id')
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params and self.page_size_query_param not in request.query_params:
+            return None
+        return super().paginate_queryset(queryset, request, view=view)
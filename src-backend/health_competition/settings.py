@@ -14,6 +14,7 @@ import os
 import datetime, pytz
 from pathlib import Path
 from urllib.parse import urlparse
+from django.core.exceptions import ImproperlyConfigured
 import sentry_sdk
 from sentry_sdk.integrations.django import DjangoIntegration
 from sentry_sdk.integrations.celery import CeleryIntegration
@@ -210,6 +211,19 @@ CACHES = {
 }
 
 
+# Points recalc queue - Redis in production, the RecalcRequest table as fallback for SQLite-only dev setups
+RECALC_QUEUE_BACKEND = os.environ.get("RECALC_QUEUE_BACKEND", 'custom_user.recalc_queue.DatabaseRecalcQueue' if DEBUG else 'custom_user.recalc_queue.RedisRecalcQueue')
+RECALC_QUEUE_DEBOUNCE = int(os.environ.get("RECALC_QUEUE_DEBOUNCE", 10))  # seconds
+RECALC_QUEUE_CLAIM_TIMEOUT = 60 * 30  # seconds - time limit of a recalc shard
+RECALC_ENGINE = os.environ.get("RECALC_ENGINE", "scorer")  # 'scorer' (Python) or 'window' (SQL window functions - Postgres only)
+
+# Competition leaderboards - ranked from the DailyPoints rollup by default or kept in Redis sorted sets
+LEADERBOARD_BACKEND = os.environ.get("LEADERBOARD_BACKEND", 'competition.leaderboard.DatabaseLeaderboard')
+
+# Feed entries kept per competition - older workouts drop out of the feed
+FEED_TIMELINE_LENGTH = int(os.environ.get("FEED_TIMELINE_LENGTH", 1_000))
+
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/4.2/howto/static-files/
 
@@ -227,6 +241,13 @@ STRAVA_CLIENT_ID = int(os.environ.get("STRAVA_CLIENT_ID", 1234321))
 STRAVA_CLIENT_SECRET = os.environ.get("STRAVA_CLIENT_SECRET", "ReplaceWithClientSecret")
 STRAVA_LIMIT_15MIN = int(os.environ.get("STRAVA_LIMIT_15MIN", 100))
 STRAVA_LIMIT_DAY = int(os.environ.get("STRAVA_LIMIT_DAY", 1000))
+STRAVA_SYNC_CONCURRENCY = int(os.environ.get("STRAVA_SYNC_CONCURRENCY", 4))  # parallel Strava API calls per process
+STRAVA_RATE_LIMITER_BACKEND = os.environ.get("STRAVA_RATE_LIMITER_BACKEND", 'custom_user.api_rate_limiter.APIRequestMonitor' if DEBUG else 'custom_user.api_rate_limiter.RedisAPIRequestMonitor')
+STRAVA_WEBHOOK_VERIFY_TOKEN = os.environ.get("STRAVA_WEBHOOK_VERIFY_TOKEN", None)  # push subscription enabled if set
+STRAVA_WEBHOOK_SUBSCRIPTION_ID = int(os.environ["STRAVA_WEBHOOK_SUBSCRIPTION_ID"]) if os.environ.get("STRAVA_WEBHOOK_SUBSCRIPTION_ID") else None
+if STRAVA_WEBHOOK_VERIFY_TOKEN is not None and STRAVA_WEBHOOK_SUBSCRIPTION_ID is None:
+    raise ImproperlyConfigured("STRAVA_WEBHOOK_SUBSCRIPTION_ID is required with STRAVA_WEBHOOK_VERIFY_TOKEN - events of other subscriptions must be rejected")
+STRAVA_POLL_INTERVAL_HOURS = int(os.environ.get("STRAVA_POLL_INTERVAL_HOURS", 6 if STRAVA_WEBHOOK_VERIFY_TOKEN is None else 24 * 7))  # daily sync polls users not synced for this long
 
 
 # Sentry
@@ -21,9 +21,9 @@ from rest_framework_simplejwt.views import (
     TokenRefreshView,
 )
 from rest_framework.routers import DefaultRouter
-from competition.views import CompetitionViewSet, TeamViewSet, ActivityGoalViewSet, PointsViewSet, CompetitionStatsQueryView, FeedQueryView, JoinCompetitionView, JoinTeamView, CeleryQueryView
+from competition.views import CompetitionViewSet, TeamViewSet, ActivityGoalViewSet, PointsViewSet, CompetitionStatsQueryView, LeaderboardQueryView, FeedQueryView, JoinCompetitionView, JoinTeamView, CeleryQueryView
 from workouts.views import WorkoutViewSet
-from custom_user.views import CustomUserViewSet, LinkStravaView, UnlinkStravaView, SyncStravaView, PasswordResetView, PasswordResetConfirmView
+from custom_user.views import CustomUserViewSet, LinkStravaView, UnlinkStravaView, SyncStravaView, StravaWebhookView, PasswordResetView, PasswordResetConfirmView
 
 router = DefaultRouter()
 router.register(r'competition', CompetitionViewSet, basename='competition')
@@ -37,12 +37,14 @@ urlpatterns = [
     path('api/', include([
         path('', include(router.urls)),
         path('stats/<int:competition>/', CompetitionStatsQueryView.as_view(), name='competition-stats'),
+        path('leaderboard/<int:competition>/', LeaderboardQueryView.as_view(), name='competition-leaderboard'),
         path('feed/<int:competition>/', FeedQueryView.as_view(), name='competition-feed'),
         path('join/competition/<str:join_code>/', JoinCompetitionView.as_view(), name='join-competition'),
         path('join/team/', JoinTeamView.as_view(), name='join-team'),
         path('strava/link/<str:code>/', LinkStravaView.as_view(), name='strava-link'),
         path('strava/unlink/', UnlinkStravaView.as_view(), name='strava-unlink'),
         path('strava/sync/', SyncStravaView.as_view(), name='strava-sync'),
+        path('strava/webhook/', StravaWebhookView.as_view(), name='strava-webhook'),
         path('celery/tasks/', CeleryQueryView.as_view(), name='celery-task-list'),
         path('celery/tasks/<str:task_id>/', CeleryQueryView.as_view(), name='celery-task-status'),
         path('celery/', CeleryQueryView.as_view(), name='celery-task-run'),
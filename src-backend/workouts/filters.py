@@ -1,13 +1,24 @@
 # filters.py
 import django_filters
+from django.apps import apps
+from django.db.models import Q, Exists, OuterRef
 from .models import Workout
 
 class WorkoutFilter(django_filters.FilterSet):
     my = django_filters.CharFilter(method='filter_my')
+    competition = django_filters.NumberFilter(method='filter_competition')
 
     def filter_my(request, queryset, *args, **kwargs):
         return queryset.filter(id=request.request.user.id)
 
+    def filter_competition(self, queryset, name, value):
+        """ workouts with points in the competition """
+        Points = apps.get_model('competition', 'Points')
+        return queryset.filter(Exists(Points.objects.filter(Q(goal__competition=value) | Q(award__competition=value), workout=OuterRef('pk'))))
+
     class Meta:
         model = Workout
-        fields = {}
+        fields = {
+            'start_datetime': ['gte', 'lt'],
+            'sport_type': ['exact', 'in'],
+        }
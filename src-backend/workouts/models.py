@@ -4,10 +4,12 @@ from decimal import Decimal
 from django.utils import timezone
 from django.conf import settings
 from django.db import models
-from django.db.models import Sum
+from django.db.models import Q, Sum
+from django.db.models.functions import TruncDate
 
 from custom_user.models import CustomUser
 from competition.scorer import trigger_workout_change, trigger_workout_delete
+from competition.side_effects import pending_side_effects, side_effects_atomic
 
 # Create your models here.
 
@@ -155,6 +157,12 @@ class Workout(models.Model):
     strava_id = models.BigIntegerField(unique=True, null=True)
     strava_intensity_avg_watts = models.DecimalField(null=True, max_digits=7, decimal_places=2)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['start_datetime', 'id'], name='workout_start_datetime_id'),  # keyset of the feed
+            models.Index(fields=['user', 'start_datetime', 'id'], name='workout_user_start_datetime'),  # keyset of a user's workouts
+        ]
+
     @property
     def duration_seconds(self):
         return self.duration.seconds
@@ -182,17 +190,16 @@ class Workout(models.Model):
             if v != current.get(k)
         }
 
-    def save(self, *args, **kwargs):
-        """ trigger recalculation of points_capped if workout changes """
-        is_create = self.pk is None
-        scaling_kcal = float((1 if kwargs.get('user', None) is None else kwargs.get('user').scaling_kcal) if self.user is None else self.user.scaling_kcal)
-        scaling_distance = float((1 if kwargs.get('user', None) is None else kwargs.get('user').scaling_distance) if self.user is None else self.user.scaling_distance)
+    def set_defaults(self, scaling_kcal, scaling_distance, recorded_walks=None, recorded_runs=None):
+        """ estimate missing kcal / distance with MET values - recorded_walks / recorded_runs are the durations on the day of Steps (queried if None) """
         if self.sport_type == "Steps":
             self.intensity_category = 1
 
             # Subtract the steps from walks and runs from the daily total steps to not double count
-            recorded_walks = Workout.objects.filter(user=self.user, start_datetime__date=self.start_datetime, sport_type='Walk').aggregate(duration=Sum('duration'))['duration']
-            recorded_runs = Workout.objects.filter(user=self.user, start_datetime__date=self.start_datetime, sport_type='Run').aggregate(duration=Sum('duration'))['duration']
+            if recorded_walks is None or recorded_runs is None:
+                recorded = Workout.objects.filter(user=self.user, start_datetime__date=self.start_datetime).aggregate(walks=Sum('duration', filter=Q(sport_type='Walk')), runs=Sum('duration', filter=Q(sport_type='Run')))
+                recorded_walks = recorded['walks'] if recorded_walks is None else recorded_walks
+                recorded_runs = recorded['runs'] if recorded_runs is None else recorded_runs
             recorded_steps_walks = 0 if recorded_walks is None else 6_000 / (60 * 60) * recorded_walks.seconds
             recorded_steps_runs = 0 if recorded_runs is None else 10_000 / (60 * 60) * recorded_runs.seconds
             self.distance = 0.82 * scaling_distance * max(self.steps - recorded_steps_walks - recorded_steps_runs, 0) / 1000
@@ -204,56 +211,106 @@ class Workout(models.Model):
             server_time = datetime.datetime.combine(self.start_datetime.date(), datetime.time(23, 59, 0))
             self.start_datetime = timezone.make_aware(server_time).astimezone(datetime.timezone.utc)
 
+        # default intensity 2
+        if self.intensity_category is None or self.intensity_category == "":
+            self.intensity_category = 2
+
         if self.sport_type in ["Ride", "EBikeRide", "GravelRide", "Handcycle", "Velomobile", "VirtualRide", "MountainBikeRide", "EMountainBikeRide", "Run", "TrailRun", "VirtualRun", "Walk"]:
             # estimate distance using database MET values
             if self.distance is None or self.distance == "":
                 self.distance = SPORT_MET.get(self.sport_type, SPORT_MET['Workout'])[self.intensity_category] * (self.duration.seconds / (60 * 60)) * scaling_distance # default human 1000m scaled up/down by scaler
 
-        # default intensity 2
-        if self.intensity_category is None or self.intensity_category == "":
-            self.intensity_category = 2
-
         # estimate kcal using database MET values
         if self.kcal is None or self.kcal == "":
             self.kcal = SPORT_MET.get(self.sport_type, SPORT_MET['Workout'])[self.intensity_category] * 75 * (self.duration.seconds / (60 * 60)) * scaling_kcal # default human 75kg scaled up/down by scaler
 
-        super().save(*args, **kwargs)
-        changed = self.get_changed_fields()
-        trigger_workout_change(
-            instance=self,
-            new=is_create,
-            changes=changed
-        )
-        self._original = self._dict()  # reset
+    def save(self, *args, **kwargs):
+        """ trigger recalculation of points_capped if workout changes - points, steps and recalcs are flushed before the transaction commits """
+        is_create = self.pk is None
+        scaling_kcal = float((1 if kwargs.get('user', None) is None else kwargs.get('user').scaling_kcal) if self.user is None else self.user.scaling_kcal)
+        scaling_distance = float((1 if kwargs.get('user', None) is None else kwargs.get('user').scaling_distance) if self.user is None else self.user.scaling_distance)
+        self.set_defaults(scaling_kcal, scaling_distance)
 
-        # if workout is run or walk and steps were recorded on the same day, update steps to avoid double counting
-        if self.sport_type in ['Run', 'Walk']:
-            if 'start_datetime' in changed:
-                date_lst = datetime.datetime.fromisoformat(changed['start_datetime']) if type(changed['start_datetime']) is str else changed['start_datetime']
-                date_lst = list(date_lst)
-            else:
-                date_lst = datetime.datetime.fromisoformat(self.start_datetime) if type(self.start_datetime) is str else self.start_datetime
-                date_lst = [date_lst]
-            recorded_steps = Workout.objects.filter(user=self.user, start_datetime__date__in=date_lst, sport_type='Steps')
-            if len(recorded_steps) > 0:
-                for steps in recorded_steps:
-                    setattr(steps, 'distance', None)
-                    setattr(steps, 'kcal', None)
-                    steps.save()
+        with side_effects_atomic():
+            super().save(*args, **kwargs)
+            trigger_workout_change(
+                instance=self,
+                new=is_create,
+                changes=self.get_changed_fields()
+            )
+        self._original = self._dict()  # reset
 
     def delete(self, *args, **kwargs):
-        """ trigger recalculation of points_capped if workout deleted """
-        deleted_run_or_walk = self.sport_type in ['Run', 'Walk']
-        trigger_workout_delete(
-            instance=self
-        )
-        super().delete(*args, **kwargs)
-        # if deleted workout was run or walk, update steps to give back counting
-        if deleted_run_or_walk:
-            recorded_steps = Workout.objects.filter(user=self.user, start_datetime__date=self.start_datetime, sport_type='Steps')
-            if len(recorded_steps) > 0:
-                for steps in recorded_steps:
-                    setattr(steps, 'distance', None)
-                    setattr(steps, 'kcal', None)
-                    setattr(steps, 'duration', datetime.timedelta(seconds=0))
-                    steps.save()
\ No newline at end of file
+        """ trigger recalculation of points_capped if workout deleted - a deleted run or walk gives the steps of its day back """
+        with side_effects_atomic():
+            trigger_workout_delete(
+                instance=self
+            )
+            return super().delete(*args, **kwargs)
+
+
+def bulk_create_workouts(user, data_lst):
+    """ create many workouts of a user at once - MET defaults of the whole batch, points inserted in bulk and one recalc per (user, goal) """
+    workouts = [Workout(user=user, **data) for data in data_lst]
+    scaling_kcal, scaling_distance = float(user.scaling_kcal), float(user.scaling_distance)
+
+    # durations of walks and runs per day (stored and imported) for the steps of that day
+    recorded = {}
+    steps_days = {timezone.localdate(i.start_datetime) for i in workouts if i.sport_type == 'Steps'}
+    if len(steps_days) > 0:
+        recorded_lst = Workout.objects.filter(user=user, sport_type__in=['Walk', 'Run']).annotate(day=TruncDate('start_datetime')).filter(day__in=steps_days).values('day', 'sport_type').annotate(duration=Sum('duration')).order_by()
+        recorded = {(i['day'], i['sport_type']): i['duration'] for i in recorded_lst}
+    walk_run_days = set()
+    for workout in workouts:
+        if workout.sport_type in ['Walk', 'Run']:
+            day = timezone.localdate(workout.start_datetime)
+            walk_run_days.add(day)
+            recorded[(day, workout.sport_type)] = recorded.get((day, workout.sport_type), datetime.timedelta(0)) + workout.duration
+
+    for workout in workouts:
+        day = timezone.localdate(workout.start_datetime)
+        workout.set_defaults(scaling_kcal, scaling_distance, recorded_walks=recorded.get((day, 'Walk'), datetime.timedelta(0)), recorded_runs=recorded.get((day, 'Run'), datetime.timedelta(0)))
+
+    # points of the competitions the batch overlaps with and one recalc request per (user, goal) are flushed before the block commits
+    with side_effects_atomic():
+        workouts = Workout.objects.bulk_create(workouts, batch_size=500)
+        effects = pending_side_effects()
+        for workout in workouts:
+            effects.workout_created(workout)
+
+        # stored steps on the days of imported walks and runs must not count them twice (like Workout.save)
+        if len(walk_run_days) > 0:
+            effects.reconcile_steps(user.pk, walk_run_days)
+
+    print(f"User ({user.pk}) imported {len(workouts)} workouts triggering point cap recalc")
+    return workouts
+
+
+def bulk_upsert_workouts(user, data_lst, existing=None):
+    """ insert new and update changed workouts of a user matched by strava_id - unchanged workouts are not written - returns (created, updated) """
+    if existing is None:
+        existing = {i.strava_id: i for i in Workout.objects.filter(user=user, strava_id__in=[data['strava_id'] for data in data_lst])}
+    scaling_kcal, scaling_distance = float(user.scaling_kcal), float(user.scaling_distance)
+
+    new_lst, changed_lst, changed_fields = [], [], set()
+    with side_effects_atomic():
+        for data in data_lst:
+            workout = existing.get(data['strava_id'])
+            if workout is None:
+                new_lst.append(data)
+                continue
+
+            for key, value in data.items():
+                setattr(workout, key, value)
+            workout.set_defaults(scaling_kcal, scaling_distance)
+            changes = workout.get_changed_fields()
+            if len(changes) > 0:
+                trigger_workout_change(instance=workout, new=False, changes=changes)
+                workout._original = workout._dict()  # reset
+                changed_lst.append(workout)
+                changed_fields.update(changes.keys())
+
+        if len(changed_lst) > 0:
+            Workout.objects.bulk_update(changed_lst, list(changed_fields), batch_size=500)
+        created = bulk_create_workouts(user, new_lst) if len(new_lst) > 0 else []
+    return created, changed_lst
@@ -0,0 +1,22 @@
+import csv, io
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+def read_csv(stream, encoding='utf-8'):
+    """ rows of a CSV file with header as list of dicts - empty cells are left out to count as missing """
+    try:
+        reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig' if encoding.lower() == 'utf-8' else encoding))
+        return [{key.strip(): value.strip() for key, value in row.items() if key is not None and value not in (None, '')} for row in reader]
+    except (csv.Error, UnicodeDecodeError) as e:
+        raise ParseError(f'CSV parse error - {e}')
+
+
+class CSVParser(BaseParser):
+    """ text/csv request bodies as list of dicts """
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', 'utf-8')
+        return read_csv(io.BytesIO(stream.read()), encoding=encoding)
@@ -1,13 +1,21 @@
 import time
 from django.db.models import Q
-from rest_framework import viewsets
+from rest_framework import viewsets, status
+from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser, MultiPartParser
+from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
 
 from custom_user.views import IsOwnerOrReadOnly
-from .models import Workout
+from .models import Workout, bulk_create_workouts
+from .parsers import CSVParser, read_csv
 from competition.scorer import trigger_workout_change
 from .serializers import WorkoutSerializer
 from .filters import WorkoutFilter
+from health_competition.pagination import StartDatetimeCursorPagination
+
+
+BULK_IMPORT_MAX_ROWS = 5_000
 
 
 class WorkoutViewSet(viewsets.ModelViewSet):
@@ -16,6 +24,7 @@ class WorkoutViewSet(viewsets.ModelViewSet):
 
     filter_backends = [DjangoFilterBackend]
     filterset_class = WorkoutFilter
+    pagination_class = StartDatetimeCursorPagination
 
     permission_classes = [IsOwnerOrReadOnly]
 
@@ -26,3 +35,17 @@ class WorkoutViewSet(viewsets.ModelViewSet):
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
+
+    @action(detail=False, methods=['post'], url_path='bulk', parser_classes=[JSONParser, CSVParser, MultiPartParser])
+    def bulk(self, request):
+        """ import many workouts at once - JSON list, text/csv body or a CSV upload as file """
+        rows = read_csv(request.FILES['file'].file) if 'file' in request.FILES else request.data
+        if not isinstance(rows, list):
+            return Response({"message": "Expected a list of workouts or a CSV file."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > BULK_IMPORT_MAX_ROWS:
+            return Response({"message": f"At most {BULK_IMPORT_MAX_ROWS} workouts can be imported at once."}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = self.get_serializer(data=rows, many=True)
+        serializer.is_valid(raise_exception=True)
+        workouts = bulk_create_workouts(request.user, serializer.validated_data)
+        return Response(self.get_serializer(workouts, many=True).data, status=status.HTTP_201_CREATED)
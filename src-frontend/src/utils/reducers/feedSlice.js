@@ -14,8 +14,8 @@ export const feedApi = createApi({
                 method: 'GET',
             }),
             transformResponse: (response) => {
-                // Convert timezone for all activites in the response
-                return response.map(activity => {
+                // Convert timezone for all activites in the response (first page of the feed)
+                return response.results.map(activity => {
                     return {
                         ...activity,
                         workout__start_datetime_fmt: dateFormatter(activity.workout__start_datetime, activity.workout__sport_type === 'Steps'), // format datetime